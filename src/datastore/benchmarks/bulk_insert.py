@@ -0,0 +1,103 @@
+#+
+# Copyright 2017 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+"""
+Compares inserting documents one by one with insert() against a single
+insert_many() call, for both a uuid and a serial keyed collection, as well
+as update() against update_many() on the same documents.
+
+Needs a running mongod, the benchmark creates and removes its own scratch
+collections.
+
+Usage: python3 benchmarks/bulk_insert.py [--dsn mongodb://127.0.0.1:27017] [--count 100000]
+"""
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'drivers', 'mongodb'))
+
+from mongodb import MongodbDatastore
+
+
+def document(i):
+    return {
+        'seqno': i,
+        'priority': 'INFO',
+        'facility': 'DAEMON',
+        'identifier': 'benchmark',
+        'message': 'benchmark message number {0}'.format(i)
+    }
+
+
+def timed(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dsn', default='mongodb://127.0.0.1:27017')
+    parser.add_argument('--database', default='benchmark')
+    parser.add_argument('--count', type=int, default=100000)
+    args = parser.parse_args()
+
+    ds = MongodbDatastore()
+    ds.connect(args.dsn, args.database)
+    docs = [document(i) for i in range(args.count)]
+
+    print('{0:<24} {1:>12} {2:>12}'.format('operation', 'seconds', 'docs/s'))
+    for pkey_type in ('uuid', 'serial'):
+        name = 'benchmark.bulk_insert.{0}'.format(pkey_type)
+        results = []
+
+        ds.collection_delete(name)
+        ds.collection_create(name, pkey_type)
+        results.append(('insert', timed(lambda: [ds.insert(name, d) for d in docs])))
+        ids = ds.query(name, select='id')
+        results.append(('update', timed(lambda: [ds.update(name, i, d) for i, d in zip(ids, docs)])))
+
+        ds.collection_delete(name)
+        ds.collection_create(name, pkey_type)
+        results.append(('insert_many', timed(lambda: ds.insert_many(name, docs))))
+        ids = ds.query(name, select='id')
+        results.append(('update_many', timed(lambda: ds.update_many(name, zip(ids, docs)))))
+        results.append(('delete_many', timed(lambda: ds.delete_many(name, ids))))
+
+        ds.collection_delete(name)
+        for op, elapsed in results:
+            print('{0:<24} {1:>12.2f} {2:>12.0f}'.format('{0} ({1})'.format(op, pkey_type), elapsed, args.count / elapsed))
+
+    ds.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+#+
+# Copyright 2017 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+"""
+Counts MongoDB round trips per datastore operation with the collection
+metadata cache enabled and with the cache dropped before every operation
+(which is what every call used to cost).
+
+Needs a running mongod, the benchmark creates and removes its own scratch
+collection.
+
+Usage: python3 benchmarks/collection_metadata.py [--dsn mongodb://127.0.0.1:27017] [--calls 1000]
+"""
+
+import os
+import sys
+import time
+import argparse
+import pymongo.monitoring
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'drivers', 'mongodb'))
+
+from mongodb import MongodbDatastore
+
+
+COLLECTION = 'benchmark.collection_metadata'
+
+
+class CommandCounter(pymongo.monitoring.CommandListener):
+    def __init__(self):
+        self.count = 0
+
+    def started(self, event):
+        self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def measure(ds, counter, calls, fn, uncached):
+    counter.count = 0
+    start = time.perf_counter()
+    for i in range(calls):
+        if uncached:
+            ds.collection_invalidate(COLLECTION)
+
+        fn(i)
+
+    elapsed = time.perf_counter() - start
+    return counter.count / calls, elapsed / calls * 1000000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dsn', default='mongodb://127.0.0.1:27017')
+    parser.add_argument('--database', default='benchmark')
+    parser.add_argument('--calls', type=int, default=1000)
+    args = parser.parse_args()
+
+    counter = CommandCounter()
+    pymongo.monitoring.register(counter)
+
+    ds = MongodbDatastore()
+    ds.connect(args.dsn, args.database)
+    ds.collection_delete(COLLECTION)
+    ds.collection_create(COLLECTION, 'serial')
+
+    ops = [
+        ('insert', lambda i: ds.insert(COLLECTION, {'value': i})),
+        ('get_by_id', lambda i: ds.get_by_id(COLLECTION, i + 1)),
+        ('query', lambda i: ds.query(COLLECTION, ('value', '=', i))),
+        ('update', lambda i: ds.update(COLLECTION, i + 1, {'value': -i})),
+    ]
+
+    print('{0:<12} {1:>16} {2:>12} {3:>16} {4:>12}'.format(
+        'operation', 'uncached trips', 'us/op', 'cached trips', 'us/op'
+    ))
+
+    try:
+        for name, fn in ops:
+            uncached = measure(ds, counter, args.calls, fn, True)
+            cached = measure(ds, counter, args.calls, fn, False)
+
+            print('{0:<12} {1:>16.2f} {2:>12.1f} {3:>16.2f} {4:>12.1f}'.format(name, *(uncached + cached)))
+    finally:
+        ds.collection_delete(COLLECTION)
+        ds.close()
+
+
+if __name__ == '__main__':
+    main()
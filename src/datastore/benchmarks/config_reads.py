@@ -0,0 +1,126 @@
+#+
+# Copyright 2017 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+"""
+Measures ConfigStore.get() with and without the key cache, and subtree
+reads through ConfigNode with the single prefix query compared with the
+old node by node traversal. Reports MongoDB round trips and latency.
+
+Needs a running mongod, the benchmark fills a 'config' collection in a
+scratch database.
+
+Usage: python3 benchmarks/config_reads.py [--dsn mongodb://127.0.0.1:27017] [--calls 1000]
+"""
+
+import os
+import sys
+import time
+import argparse
+import pymongo.monitoring
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'drivers', 'mongodb'))
+
+from mongodb import MongodbDatastore
+from datastore.config import ConfigStore, ConfigNode
+
+
+SERVICES = 30
+KEYS_PER_SERVICE = 25
+
+
+class CommandCounter(pymongo.monitoring.CommandListener):
+    def __init__(self):
+        self.count = 0
+
+    def started(self, event):
+        self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def legacy_getstate(node):
+    if not node.has_children:
+        return node.value
+
+    return {k: legacy_getstate(node[k]) for k in node.children}
+
+
+def measure(counter, calls, fn):
+    counter.count = 0
+    start = time.perf_counter()
+    for i in range(calls):
+        fn()
+
+    elapsed = (time.perf_counter() - start) / calls * 1000000
+    return counter.count / calls, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dsn', default='mongodb://127.0.0.1:27017')
+    parser.add_argument('--database', default='benchmark')
+    parser.add_argument('--calls', type=int, default=1000)
+    args = parser.parse_args()
+
+    counter = CommandCounter()
+    pymongo.monitoring.register(counter)
+
+    ds = MongodbDatastore()
+    ds.connect(args.dsn, args.database)
+    ds.collection_delete('config')
+    ds.collection_create('config', 'string', {'configstore': True})
+    keys = ['service.svc{0}.opt{1}'.format(s, k) for s in range(SERVICES) for k in range(KEYS_PER_SERVICE)]
+    ds.insert_many('config', ['value'] * len(keys), pkeys=keys, config=True)
+
+    plain = ConfigStore(ds)
+    cached = ConfigStore(ds, cache=True)
+    key = 'service.svc0.opt0'
+
+    results = [
+        ('get', measure(counter, args.calls, lambda: plain.get(key))),
+        ('get (cached)', measure(counter, args.calls, lambda: cached.get(key))),
+        ('subtree (node by node)', measure(counter, args.calls // 10, lambda: legacy_getstate(ConfigNode('service.svc0', plain)))),
+        ('subtree', measure(counter, args.calls, lambda: ConfigNode('service.svc0', plain).__getstate__())),
+        ('subtree (cached)', measure(counter, args.calls, lambda: ConfigNode('service.svc0', cached).__getstate__())),
+    ]
+
+    ds.collection_delete('config')
+    ds.close()
+
+    print('{0} keys per subtree'.format(KEYS_PER_SERVICE))
+    print('{0:<24} {1:>14} {2:>12}'.format('operation', 'round trips', 'us/op'))
+    for name, (trips, elapsed) in results:
+        print('{0:<24} {1:>14.2f} {2:>12.1f}'.format(name, trips, elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+#+
+# Copyright 2017 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+"""
+Measures bytes received from MongoDB and latency of a disk.query style
+query with select, with the select pushed down as a native projection and
+with full documents fetched and trimmed in Python.
+
+Runs against a scratch collection of synthetic disk documents by default,
+or read-only against an existing collection given with --collection.
+
+Usage: python3 benchmarks/query_projection.py [--dsn mongodb://127.0.0.1:27017] [--disks 500] [--collection disks]
+"""
+
+import os
+import sys
+import time
+import argparse
+import bson
+import pymongo.monitoring
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'drivers', 'mongodb'))
+
+from mongodb import MongodbDatastore
+
+
+COLLECTION = 'benchmark.query_projection'
+SELECT = ('id', 'path')
+
+
+class ReplySize(pymongo.monitoring.CommandListener):
+    def __init__(self):
+        self.bytes = 0
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        if event.command_name in ('find', 'getMore'):
+            self.bytes += len(bson.BSON.encode(event.reply))
+
+    def failed(self, event):
+        pass
+
+
+def disk(i):
+    return {
+        'id': 'serial:WD-{0:08d}'.format(i),
+        'path': '/dev/ada{0}'.format(i),
+        'name': 'ada{0}'.format(i),
+        'serial': 'WD-{0:08d}'.format(i),
+        'mediasize': 4000787030016,
+        'smart': True,
+        'smart_options': '',
+        'standby_mode': None,
+        'apm_mode': None,
+        'acoustic_level': 'DISABLED',
+        'status': {
+            'description': 'WDC WD40EFRX-68WT0N0',
+            'model': 'WDC WD40EFRX-68WT0N0',
+            'max_rotation': 5400,
+            'is_ssd': False,
+            'is_multipath': False,
+            'is_encrypted': False,
+            'schema': 'GPT',
+            'partitions': [
+                {
+                    'name': 'ada{0}p{1}'.format(i, p),
+                    'paths': ['/dev/ada{0}p{1}'.format(i, p), '/dev/gptid/{0:032x}'.format(i * 8 + p)],
+                    'mediasize': 2147483648 * p,
+                    'uuid': '{0:032x}'.format(i * 8 + p),
+                    'type': 'freebsd-zfs'
+                }
+                for p in range(1, 3)
+            ]
+        }
+    }
+
+
+def measure(ds, listener, collection, repeat, **kwargs):
+    listener.bytes = 0
+    start = time.perf_counter()
+    for i in range(repeat):
+        result = list(ds.query_stream(collection, select=SELECT, **kwargs))
+
+    elapsed = (time.perf_counter() - start) / repeat * 1000
+    return listener.bytes / repeat, elapsed, len(result)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dsn', default='mongodb://127.0.0.1:27017')
+    parser.add_argument('--database', default='benchmark')
+    parser.add_argument('--collection', default=None)
+    parser.add_argument('--disks', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=100)
+    args = parser.parse_args()
+
+    listener = ReplySize()
+    pymongo.monitoring.register(listener)
+
+    ds = MongodbDatastore()
+    ds.connect(args.dsn, args.database)
+    collection = args.collection
+    if not collection:
+        collection = COLLECTION
+        ds.collection_delete(collection)
+        ds.collection_create(collection, 'string')
+        ds.insert_many(collection, [disk(i) for i in range(args.disks)])
+
+    try:
+        # A callback without `depends` disables the projection, which is how
+        # select used to be evaluated for every query
+        full = measure(ds, listener, collection, args.repeat, callback=lambda o: o)
+        projected = measure(ds, listener, collection, args.repeat)
+    finally:
+        if not args.collection:
+            ds.collection_delete(collection)
+
+        ds.close()
+
+    print('{0} documents, select {1}'.format(full[2], ', '.join(SELECT)))
+    print('{0:<24} {1:>14} {2:>12}'.format('', 'bytes/query', 'ms/query'))
+    print('{0:<24} {1:>14.0f} {2:>12.2f}'.format('fetch and trim', full[0], full[1]))
+    print('{0:<24} {1:>14.0f} {2:>12.2f}'.format('native projection', projected[0], projected[1]))
+
+
+if __name__ == '__main__':
+    main()
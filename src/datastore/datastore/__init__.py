@@ -42,6 +42,13 @@ class DuplicateKeyException(DatastoreException):
     pass
 
 
+class BulkWriteException(DatastoreException):
+    def __init__(self, message, errors=None, ids=None):
+        super(BulkWriteException, self).__init__(message)
+        self.errors = errors or []
+        self.ids = ids or []
+
+
 def parse_config(path):
     try:
         f = open(path, 'r')
@@ -26,9 +26,33 @@
 #####################################################################
 
 import re
+import copy
+import time
 from datastore import DatastoreException
 
 
+CONFIG_CACHE_INTERVAL = 1
+_missing = object()
+
+
+def build_tree(path, items):
+    # Assembles a flat {key: value} mapping of the keys under `path` into
+    # nested dicts, the same way ConfigNode exposes them
+    children = {}
+    for key, value in items.items():
+        if key == path:
+            continue
+
+        child = key[len(path) + 1:].partition('.')[0]
+        if child:
+            children.setdefault(child, {})[key] = value
+
+    if not children:
+        return items.get(path)
+
+    return {k: build_tree(path + '.' + k, v) for k, v in children.items()}
+
+
 class ConfigNode(object):
     def __init__(self, path, root):
         self.path = path
@@ -58,10 +82,7 @@ class ConfigNode(object):
         return result
 
     def __getstate__(self):
-        if not self.has_children:
-            return self.value
-
-        return {k: self[k].__getstate__() for k in self.children}
+        return build_tree(self.path, self.root.list_subtree(self.path))
 
     def __getitem__(self, item):
         return ConfigNode(self.path + '.' + item, self.root)
@@ -90,24 +111,111 @@ class ConfigNode(object):
 
 
 class ConfigStore(object):
-    def __init__(self, datastore):
+    def __init__(self, datastore, cache=False, on_change=None):
         self.__datastore = datastore
+        self.__cache = {} if cache else None
+        self.__subtrees = {}
+        self.__version = None
+        self.__version_checked = 0
+        self.__on_change = on_change
         if not self.__datastore.collection_exists('config'):
             raise DatastoreException("'config' collection doesn't exist")
 
+        # Drivers which cannot run the prefix query get walked node by node
+        supported = getattr(datastore, 'supports_predicate', None)
+        self.__prefix_query = bool(supported and supported('or', [('id', '=', 'a'), ('id', '~', '^a\\.')]))
+
+    def __check_version(self):
+        # Writers bump the 'config' collection version, so that caches in
+        # other processes get dropped within CONFIG_CACHE_INTERVAL
+        now = time.monotonic()
+        if now - self.__version_checked < CONFIG_CACHE_INTERVAL:
+            return
+
+        self.__version_checked = now
+        version = self.__datastore.collection_get_version('config')
+        if version != self.__version:
+            self.__cache.clear()
+            self.__subtrees.clear()
+            self.__version = version
+
+    def invalidate(self, key=None):
+        if self.__cache is None:
+            return
+
+        if key is None:
+            self.__cache.clear()
+            self.__subtrees.clear()
+            self.__version = None
+            self.__version_checked = 0
+            return
+
+        self.__cache.pop(key, None)
+        for i in [i for i in self.__subtrees if key == i or key.startswith(i + '.')]:
+            del self.__subtrees[i]
+
     @staticmethod
     def create(datastore):
         datastore.collection_create('config', 'ltree', 'config')
 
     def exists(self, key):
+        if self.__cache is not None:
+            return self.get(key, _missing) is not _missing
+
         return self.__datastore.exists('config', ('id', '=', key))
 
     def get(self, key, default=None):
-        ret = self.__datastore.get_one('config', ('id', '=', key))
-        return ret['value'] if ret is not None else default
+        if self.__cache is None:
+            ret = self.__datastore.get_one('config', ('id', '=', key))
+            return ret['value'] if ret is not None else default
+
+        self.__check_version()
+        if key not in self.__cache:
+            ret = self.__datastore.get_one('config', ('id', '=', key))
+            self.__cache[key] = ret['value'] if ret is not None else _missing
+
+        value = self.__cache[key]
+        return default if value is _missing else copy.deepcopy(value)
 
     def set(self, key, value):
         self.__datastore.upsert('config', key, value, config=True)
+        self.__datastore.collection_bump_version('config')
+        if self.__cache is not None:
+            self.invalidate(key)
+            self.__cache[key] = copy.deepcopy(value)
+
+        if self.__on_change:
+            self.__on_change(key)
+
+    def list_subtree(self, key):
+        """
+        Returns a flat {key: value} dict of `key` and every key under it,
+        fetched with a single prefix query where the driver supports it.
+        """
+        if self.__cache is not None:
+            self.__check_version()
+            if key in self.__subtrees:
+                return copy.deepcopy(self.__subtrees[key])
+
+        if self.__prefix_query:
+            result = dict(self.__datastore.query(
+                'config',
+                ('or', [('id', '=', key), ('id', '~', '^' + re.escape(key) + '\\.')]),
+                select=('id', 'value')
+            ))
+        else:
+            result = {}
+            children = ConfigNode(key, self).children
+            if not children:
+                result[key] = self.get(key)
+
+            for i in children:
+                result.update(self.list_subtree(key + '.' + i))
+
+        if self.__cache is not None:
+            self.__subtrees[key] = copy.deepcopy(result)
+
+        return result
 
     def list_children(self, key=None):
         if key is None:
@@ -138,22 +138,31 @@ def migrate_collection(ds, dump, directory, force=False):
 
     # Update pkey type for collection
     ds.collection_set_pkey_type(name, metadata['pkey-type'])
+    ds.collection_ensure_indexes(name, metadata['attributes'].get('indexes', []))
 
     if metadata['migration'] == 'keep':
         return
 
-    for key, row in list(data.items()):
-        pkey = int(key) if integer else key
-        if metadata['migration'] == 'merge-preserve':
-            if not ds.exists(name, ('id', '=', pkey)):
-                try:
-                    ds.insert(name, row, pkey=pkey, config=configstore)
-                except DatastoreException:
-                    pass
-
-            continue
+    rows = [(int(key) if integer else key, row) for key, row in data.items()]
+    if metadata['migration'] == 'merge-preserve':
+        existing = set(ds.query(name, select='id'))
+        rows = [(pkey, row) for pkey, row in rows if pkey not in existing]
+        try:
+            ds.insert_many(
+                name,
+                [row for _, row in rows],
+                pkeys=[pkey for pkey, _ in rows],
+                config=configstore,
+                ordered=False
+            )
+        except DatastoreException:
+            pass
+
+        ds.collection_reseed_keys(name)
+        return
 
-        ds.update(name, pkey, row, upsert=upsert, config=configstore)
+    ds.update_many(name, rows, upsert=upsert, config=configstore)
+    ds.collection_reseed_keys(name)
 
 
 def migrate_db(ds, dump, migpath=None, types=None, force=False):
@@ -175,9 +184,12 @@ def migrate_db(ds, dump, migpath=None, types=None, force=False):
 
         if not ds.collection_exists(name):
             ds.collection_create(name, metadata['pkey-type'], metadata['attributes'])
-            for key, row in list(data.items()):
-                pkey = int(key) if integer else key
-                ds.insert(name, row, pkey=pkey)
+            ds.insert_many(
+                name,
+                list(data.values()),
+                pkeys=[int(key) if integer else key for key in data.keys()]
+            )
+            ds.collection_reseed_keys(name)
 
             print("Created missing collection {0}".format(name))
 
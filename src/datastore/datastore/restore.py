@@ -38,9 +38,13 @@ def restore_collection(ds, dump):
     ds.collection_create(name, metadata['pkey-type'], metadata['attributes'])
     configstore = metadata['attributes'].get('configstore', False)
 
-    for key, row in list(data.items()):
-        pkey = int(key) if integer else key
-        ds.insert(name, row, pkey=pkey, config=configstore)
+    ds.insert_many(
+        name,
+        list(data.values()),
+        pkeys=[int(key) if integer else key for key in data.keys()],
+        config=configstore
+    )
+    ds.collection_reseed_keys(name)
 
 
 def restore_db(ds, dump, types=None, progress_callback=None):
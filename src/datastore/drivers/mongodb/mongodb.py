@@ -25,6 +25,7 @@
 #
 #####################################################################
 
+import re
 import time
 import copy
 import uuid
@@ -34,12 +35,18 @@ import pymongo
 import pymongo.errors
 import pymongo.cursor
 from datetime import datetime
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument, InsertOne, ReplaceOne, DeleteOne
 from six import string_types
-from datastore import DatastoreException, DuplicateKeyException
+from datastore import DatastoreException, DuplicateKeyException, BulkWriteException
 from freenas.utils.query import get, delete
 
 
+GENERATION_COLLECTION = 'collections_generation'
+COUNTERS_COLLECTION = 'collections_counters'
+METADATA_REFRESH_INTERVAL = 1
+DUPLICATE_KEY_ERRORS = (11000, 11001)
+
+
 def auto_retry(fn):
     def wrapped(*args, **kwargs):
         for i in range(0, 15):
@@ -58,11 +65,40 @@ def auto_retry(fn):
     return wrapped
 
 
+def single_attempt(fn):
+    # Bulk writes must not be repeated as a whole: part of them may have been
+    # applied already, and auto-generated keys would change on the second run.
+    # Wait for the connection like auto_retry, but leave retries to the caller.
+    def wrapped(*args, **kwargs):
+        self = args[0]
+        for i in range(0, 15):
+            if self.connected:
+                break
+
+            time.sleep(1)
+        else:
+            raise DatastoreException('Cannot connect to MongoDB instance')
+
+        try:
+            return fn(*args, **kwargs)
+        except (pymongo.errors.AutoReconnect, pymongo.errors.ConnectionFailure, pymongo.errors.OperationFailure) as err:
+            raise DatastoreException('{0} interrupted, some documents may have been written: {1}'.format(
+                fn.__name__, err
+            ))
+
+    return wrapped
+
+
 class MongodbDatastore(object):
     def __init__(self):
         self.conn_db = None
         self.db = None
         self.connected = False
+        self.collections = {}
+        self.generation = None
+        self.generation_checked = 0
+        self.counters_seeded = set()
+        self.serials = {}
         self.operators_table = {
             '>': '$gt',
             '<': '$lt',
@@ -121,6 +157,21 @@ class MongodbDatastore(object):
 
             return {name: {self.operators_table[op]: value}}
 
+    def supports_predicate(self, *args):
+        # Tells whether _predicate() can translate a filter rule, the ones
+        # it cannot are left out of the query
+        if len(args) == 2:
+            op, value = args
+            return op in ('or', 'nor', 'and') and all(self.supports_predicate(*i) for i in value)
+
+        if len(args) in (3, 4):
+            if len(args) == 4 and args[3] and args[3] not in self.conversions_table:
+                return False
+
+            return args[1] == '=' or args[1] in self.operators_table
+
+        return False
+
     def _joint_predicate(self, op, value):
         if op in self.clauses_table:
             return self.clauses_table[op](value)
@@ -134,9 +185,141 @@ class MongodbDatastore(object):
 
         return {'$and': result} if len(result) > 0 else {}
 
+    def _check_generation(self):
+        # Other processes (dsmigrate, dsrestore, other datastore clients) bump
+        # the generation counter whenever they change collection metadata.
+        # Re-reading it at most once per METADATA_REFRESH_INTERVAL keeps the
+        # cache coherent without a round trip per operation.
+        now = time.monotonic()
+        if now - self.generation_checked < METADATA_REFRESH_INTERVAL:
+            return
+
+        self.generation_checked = now
+        item = self.db[GENERATION_COLLECTION].find_one({'_id': 'collections'})
+        generation = item['generation'] if item else 0
+        if generation != self.generation:
+            self.collections.clear()
+            self.counters_seeded.clear()
+            self.generation = generation
+
+    def _get_collection(self, name):
+        self._check_generation()
+        item = self.collections.get(name)
+        if item is None:
+            # Missing collections are not cached, so collections created by
+            # other processes become visible immediately
+            item = self.db['collections'].find_one({'_id': name})
+            if item is None:
+                return None
+
+            self.collections[name] = item
+
+        return item
+
+    def _collection_changed(self, name):
+        self.collections.pop(name, None)
+        self.collection_bump_version(name)
+        item = self.db[GENERATION_COLLECTION].find_one_and_update(
+            {'_id': 'collections'},
+            {'$inc': {'generation': 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+
+        if self.generation is None or item['generation'] != self.generation + 1:
+            # Someone else changed metadata since our last check
+            self.collections.clear()
+            self.counters_seeded.clear()
+
+        self.generation = item['generation']
+
+    def _counter_key(self, name, prefix=None):
+        return name if prefix is None else '{0}:{1}'.format(name, prefix)
+
+    def _seed_counter(self, name, prefix=None):
+        # Counters never go backwards ($max), so seeding is safe to repeat and
+        # to race with other processes. It brings the counter up to date with
+        # keys that were inserted explicitly (restores, migrations).
+        key = self._counter_key(name, prefix)
+        db = self._get_db(name)
+        if prefix is None:
+            ret = db.find_one(
+                {
+                    '$or': [
+                        {'_id': {'$type': 16}},  # BSON int32
+                        {'_id': {'$type': 18}}   # BSON int64
+                    ]
+                },
+                sort=[('_id', pymongo.DESCENDING)]
+            )
+            value = ret['_id'] if ret else 0
+        else:
+            value = -1
+            for i in db.find({'_id': {'$regex': '^{0}[0-9]+$'.format(re.escape(prefix))}}, projection=['_id']):
+                value = max(value, int(i['_id'][len(prefix):]))
+
+        self.db[COUNTERS_COLLECTION].update_one({'_id': key}, {'$max': {'value': value}}, upsert=True)
+        self.counters_seeded.add(key)
+        self.serials.pop(key, None)
+
+    def _allocate_serial(self, name, count=1, prefix=None):
+        key = self._counter_key(name, prefix)
+        if key not in self.counters_seeded:
+            self._seed_counter(name, prefix)
+
+        result = []
+        block = self.serials.get(key)
+        while block and block[0] <= block[1] and len(result) < count:
+            result.append(block[0])
+            block[0] += 1
+
+        missing = count - len(result)
+        if missing:
+            # Collections may ask for keys to be handed out in blocks, trading
+            # strictly increasing keys across processes for fewer round trips
+            size = missing
+            if prefix is None:
+                size = max(missing, self._get_collection(name)['attributes'].get('serial_block', 1))
+
+            item = self.db[COUNTERS_COLLECTION].find_one_and_update(
+                {'_id': key},
+                {'$inc': {'value': size}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+
+            first = item['value'] - size + 1
+            result.extend(range(first, first + missing))
+            self.serials[key] = [first + missing, item['value']]
+
+        return result
+
+    def _projection(self, select=None, exclude=None, depends=None):
+        # Translates select/exclude into a native projection, so that only
+        # the fields needed are sent over the wire. `depends` names fields a
+        # callback reads, which have to be fetched too.
+        if select:
+            fields = [select] if isinstance(select, string_types) else list(select)
+            fields.extend(depends or [])
+            fields = ['_id' if f == 'id' else f for f in fields]
+            if any(p.isdigit() for f in fields for p in f.split('.')):
+                # Array indexes can't be expressed as a projection
+                return None
+
+            # Drop paths already covered by their parent, MongoDB rejects
+            # overlapping projections
+            return {f: True for f in fields if not any(f.startswith(g + '.') for g in fields)}
+
+        if exclude:
+            fields = [exclude] if isinstance(exclude, string_types) else list(exclude)
+            fields = [f for f in fields if f != 'id' and f not in (depends or [])]
+            if not fields or any(p.isdigit() for f in fields for p in f.split('.')):
+                return None
+
+            return {f: False for f in fields if not any(f.startswith(g + '.') for g in fields)}
+
     def _get_db(self, collection):
-        c = self.db['collections'].find_one({"_id": collection})
-        if not c:
+        if not self._get_collection(collection):
             raise DatastoreException('Collection {0} not found'.format(collection))
 
         return self.db[collection]
@@ -144,6 +327,7 @@ class MongodbDatastore(object):
     def connect(self, dsn, database='freenas'):
         self.conn_db = MongoClient(dsn)
         self.db = self.conn_db[database]
+        self.collection_invalidate()
         self.connected = True
 
     def close(self):
@@ -162,6 +346,7 @@ class MongodbDatastore(object):
                 'pkey-type': pkey_type,
                 'attributes': attributes
             })
+            self._collection_changed(name)
 
         db = self._get_db(name).database
 
@@ -180,35 +365,71 @@ class MongodbDatastore(object):
 
             self.db[name].create_index([(i, pymongo.ASCENDING) for i in idx], unique=True)
 
+        self.collection_ensure_indexes(name, attributes.get('indexes', []))
+
         self.db[name].create_index([('$**', pymongo.TEXT)])
 
+    def collection_ensure_indexes(self, name, indexes):
+        # Creating an index that already exists is a no-op
+        for idx in indexes:
+            if isinstance(idx, str):
+                idx = [idx]
+
+            self.db[name].create_index([(i, pymongo.ASCENDING) for i in idx])
+
+    def collection_invalidate(self, name=None):
+        if name:
+            self.collections.pop(name, None)
+            return
+
+        self.collections.clear()
+        self.generation = None
+        self.generation_checked = 0
+
+    @auto_retry
+    def collection_get_version(self, name):
+        item = self.db[GENERATION_COLLECTION].find_one({'_id': name})
+        return item['version'] if item else 0
+
+    @auto_retry
+    def collection_bump_version(self, name):
+        # Lets other processes caching collection contents know they changed
+        item = self.db[GENERATION_COLLECTION].find_one_and_update(
+            {'_id': name},
+            {'$inc': {'version': 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+
+        return item['version']
+
     @auto_retry
     def collection_exists(self, name):
-        return self.db['collections'].find_one({"_id": name}) is not None
+        return self._get_collection(name) is not None
 
     @auto_retry
     def collection_get_attrs(self, name):
-        item = self.db['collections'].find_one({"_id": name})
-        return item['attributes']
+        item = self._get_collection(name)
+        return copy.deepcopy(item['attributes'])
 
     @auto_retry
     def collection_set_attrs(self, name):
-        item = self.db['collections'].find_one({"_id": name})
-        return item['attributes']
+        item = self._get_collection(name)
+        return copy.deepcopy(item['attributes'])
 
     @auto_retry
     def collection_get_migration_policy(self, name):
-        item = self.db['collections'].find_one({"_id": name})
+        item = self._get_collection(name)
         return item.get('migration', 'keep')
 
     @auto_retry
     def collection_get_migrations(self, name):
-        item = self.db['collections'].find_one({"_id": name})
-        return item.get('migrations', [])
+        item = self._get_collection(name)
+        return list(item.get('migrations', []))
 
     @auto_retry
     def collection_has_migration(self, name, migration_name):
-        item = self.db['collections'].find_one({"_id": name})
+        item = self._get_collection(name)
         return migration_name in item.get('migrations', [])
 
     @auto_retry
@@ -217,6 +438,7 @@ class MongodbDatastore(object):
         migs = item.setdefault('migrations', [])
         migs.append(migration_name)
         self.db['collections'].update({'_id': name}, item)
+        self._collection_changed(name)
 
     @auto_retry
     def collection_list(self):
@@ -229,10 +451,21 @@ class MongodbDatastore(object):
 
         self._get_db(name).drop()
         self.db['collections'].remove({'_id': name})
+        self.db[COUNTERS_COLLECTION].delete_many({
+            '$or': [
+                {'_id': name},
+                {'_id': {'$regex': '^{0}:'.format(re.escape(name))}}
+            ]
+        })
+
+        for key in [k for k in self.serials if k == name or k.startswith(name + ':')]:
+            del self.serials[key]
+
+        self._collection_changed(name)
 
     @auto_retry
     def collection_get_pkey_type(self, name):
-        item = self.db['collections'].find_one({"_id": name})
+        item = self._get_collection(name)
         return item['pkey-type']
 
     @auto_retry
@@ -240,16 +473,16 @@ class MongodbDatastore(object):
         item = self.db['collections'].find_one({"_id": name})
         item['pkey-type'] = type
         self.db['collections'].replace_one({'_id': name}, item)
+        self._collection_changed(name)
 
     @auto_retry
-    def collection_get_next_pkey(self, name, prefix):
-        counter = 0
-        while True:
-            pkey = prefix + str(counter)
-            if not self.exists(name, ('id', '=', pkey)):
-                return pkey
+    def collection_reseed_keys(self, name):
+        for i in self.db[COUNTERS_COLLECTION].find({'_id': {'$regex': '^{0}(:|$)'.format(re.escape(name))}}):
+            self._seed_counter(name, None if i['_id'] == name else i['_id'][len(name) + 1:])
 
-            counter += 1
+    @auto_retry
+    def collection_get_next_pkey(self, name, prefix):
+        return prefix + str(self._allocate_serial(name, prefix=prefix)[0])
 
     @auto_retry
     def query(self, collection, *args, **kwargs):
@@ -272,9 +505,14 @@ class MongodbDatastore(object):
         postprocess = kwargs.pop('callback', None)
         select = kwargs.pop('select', None)
         exclude = kwargs.pop('exclude', None)
+        depends = kwargs.pop('depends', None)
+        projection = None
+
+        if not postprocess or depends is not None:
+            projection = self._projection(select, exclude, depends)
 
         db = self._get_db(collection)
-        cur = db.find(self._build_query(args))
+        cur = db.find(self._build_query(args), projection)
         if count:
             return cur.count()
 
@@ -413,16 +651,7 @@ class MongodbDatastore(object):
         while True:
             if autopkey:
                 if pkey_type in ('serial', 'integer'):
-                    ret = self._get_db(collection).find_one(
-                        {
-                            '$or': [
-                                {'_id': {'$type': 16}},  # BSON int32
-                                {'_id': {'$type': 18}}   # BSON int64
-                            ]
-                        },
-                        sort=[('_id', pymongo.DESCENDING)]
-                    )
-                    pkey = ret['_id'] + 1 if ret else 1
+                    pkey = self._allocate_serial(collection)[0]
                 elif pkey_type == 'uuid':
                     pkey = str(uuid.uuid4())
 
@@ -438,6 +667,9 @@ class MongodbDatastore(object):
             except pymongo.errors.DuplicateKeyError:
                 if autopkey and retries > 0:
                     retries -= 1
+                    if pkey_type in ('serial', 'integer'):
+                        self._seed_counter(collection)
+
                     continue
 
                 raise DuplicateKeyException('Document with given key already exists')
@@ -468,15 +700,15 @@ class MongodbDatastore(object):
             t = datetime.utcnow()
             obj['updated_at'] = t
 
-            if not self.get_by_id(collection, pkey):
-                obj['created_at'] = t
-
         try:
             db = self._get_db(collection)
-            db.replace_one({'_id': pkey}, obj, upsert=upsert)
+            result = db.replace_one({'_id': pkey}, obj, upsert=upsert)
         except pymongo.errors.DuplicateKeyError:
             raise DuplicateKeyException('Document with given key already exists')
 
+        if timestamp and result.upserted_id is not None:
+            db.update_one({'_id': pkey}, {'$set': {'created_at': t}})
+
     def upsert(self, collection, pkey, obj, config=False):
         return self.update(collection, pkey, obj, upsert=True, config=config)
 
@@ -485,6 +717,153 @@ class MongodbDatastore(object):
         db = self._get_db(collection)
         db.delete_one({'_id': pkey})
 
+    def _bulk_document(self, obj, config=False):
+        if hasattr(obj, '__getstate__'):
+            return obj.__getstate__()
+
+        if type(obj) is not dict or config:
+            return {'value': obj}
+
+        return copy.deepcopy(obj)
+
+    def _bulk_write(self, collection, requests, ordered):
+        # Returns indexes of requests that were applied, indexes of upserted
+        # documents and a list of (index, exception) pairs for failed ones.
+        # In ordered mode requests after the first failure are neither
+        # applied nor reported as failed.
+        if not requests:
+            return [], [], []
+
+        db = self._get_db(collection)
+        errors = []
+        try:
+            result = db.bulk_write(requests, ordered=ordered)
+            upserted = list(result.upserted_ids.keys())
+        except pymongo.errors.BulkWriteError as err:
+            upserted = [i['index'] for i in err.details.get('upserted', [])]
+            for i in err.details.get('writeErrors', []):
+                cls = DuplicateKeyException if i['code'] in DUPLICATE_KEY_ERRORS else DatastoreException
+                errors.append((i['index'], cls(i['errmsg'])))
+
+        failed = {i for i, _ in errors}
+        last = min(failed) if ordered and failed else len(requests)
+        applied = [i for i in range(0, last) if i not in failed]
+        return applied, upserted, errors
+
+    def _bulk_result(self, operation, pkeys, applied, errors):
+        ids = [pkeys[i] for i in sorted(applied)]
+        if errors:
+            raise BulkWriteException(
+                '{0} of {1} documents failed in {2}'.format(len(errors), len(pkeys), operation),
+                [{'index': i, 'id': pkeys[i], 'error': e} for i, e in sorted(errors, key=lambda e: e[0])],
+                ids
+            )
+
+        return ids
+
+    @single_attempt
+    def insert_many(self, collection, objs, pkeys=None, timestamp=True, config=False, ordered=True):
+        pkey_type = self.collection_get_pkey_type(collection)
+        docs = []
+        auto = []
+        t = datetime.utcnow()
+
+        for idx, obj in enumerate(objs):
+            obj = self._bulk_document(obj, config)
+            pkey = pkeys[idx] if pkeys else None
+            if 'id' in obj:
+                pkey = obj.pop('id')
+
+            if pkey_type == 'uuid' and pkey:
+                pkey = pkey.lower()
+
+            if timestamp:
+                obj['updated_at'] = t
+                obj['created_at'] = t
+
+            obj['_id'] = pkey
+            auto.append(pkey is None)
+            docs.append(obj)
+
+        pending = list(range(0, len(docs)))
+        applied = []
+        errors = []
+        retries = 100
+
+        while pending:
+            if any(auto[i] for i in pending):
+                if pkey_type in ('serial', 'integer'):
+                    serials = iter(self._allocate_serial(collection, len([i for i in pending if auto[i]])))
+                    for i in pending:
+                        if auto[i]:
+                            docs[i]['_id'] = next(serials)
+                elif pkey_type == 'uuid':
+                    for i in pending:
+                        if auto[i]:
+                            docs[i]['_id'] = str(uuid.uuid4())
+
+            done, _, failed = self._bulk_write(collection, [InsertOne(docs[i]) for i in pending], ordered)
+            applied.extend(pending[i] for i in done)
+
+            # Generated serial keys may collide with keys inserted explicitly,
+            # retry those with freshly generated keys
+            collisions = [
+                pending[i] for i, err in failed
+                if auto[pending[i]] and isinstance(err, DuplicateKeyException)
+            ]
+
+            errors.extend((pending[i], err) for i, err in failed if pending[i] not in collisions)
+            if not collisions or retries == 0:
+                errors.extend((i, DuplicateKeyException('Document with given key already exists')) for i in collisions)
+                break
+
+            retries -= 1
+            if pkey_type in ('serial', 'integer'):
+                self._seed_counter(collection)
+
+            if ordered:
+                pending = pending[pending.index(collisions[0]):]
+            else:
+                pending = collisions
+
+        return self._bulk_result('insert_many', [d['_id'] for d in docs], applied, errors)
+
+    @single_attempt
+    def update_many(self, collection, objs, upsert=False, timestamp=True, config=False, ordered=True):
+        pkeys = []
+        requests = []
+        t = datetime.utcnow()
+
+        for pkey, obj in objs:
+            obj = self._bulk_document(obj, config)
+            if 'id' in obj and pkey != obj['id']:
+                raise DatastoreException('Changing document id is not supported in bulk updates')
+
+            obj.pop('id', None)
+            if timestamp:
+                obj['updated_at'] = t
+
+            pkeys.append(pkey)
+            requests.append(ReplaceOne({'_id': pkey}, obj, upsert=upsert))
+
+        applied, upserted, errors = self._bulk_write(collection, requests, ordered)
+        if timestamp and upserted:
+            self._get_db(collection).update_many(
+                {'_id': {'$in': [pkeys[i] for i in upserted]}},
+                {'$set': {'created_at': t}}
+            )
+
+        return self._bulk_result('update_many', pkeys, applied, errors)
+
+    def upsert_many(self, collection, objs, config=False, ordered=True):
+        return self.update_many(collection, objs, upsert=True, config=config, ordered=ordered)
+
+    @single_attempt
+    def delete_many(self, collection, pkeys, ordered=True):
+        pkeys = list(pkeys)
+        applied, _, errors = self._bulk_write(collection, [DeleteOne({'_id': i}) for i in pkeys], ordered)
+        return self._bulk_result('delete_many', pkeys, applied, errors)
+
     def lock(self):
         self.conn_db.fsync(lock=True)
 
@@ -25,11 +25,12 @@
 #
 #####################################################################
 
+import re
 import logging
 import json
 import psycopg2
 import psycopg2.extras
-from datastore import DuplicateKeyException
+from datastore import DatastoreException, DuplicateKeyException, BulkWriteException
 
 class PostgresSelectQuery(object):
     ASC = 'ASC'
@@ -112,6 +113,21 @@ class PostgresDatastore(object):
             self.insert('__collections', attributes, pkey=collection)
 
         self.conn.commit()
+        self.collection_ensure_indexes(collection, attributes.get('indexes', []))
+
+    def collection_ensure_indexes(self, collection, indexes):
+        with self.conn.cursor() as cur:
+            for idx in indexes:
+                if isinstance(idx, str):
+                    idx = [idx]
+
+                cur.execute("CREATE INDEX IF NOT EXISTS {0} ON {1} ({2})".format(
+                    '{0}_{1}_idx'.format(collection, '_'.join(idx)).replace('.', '_'),
+                    collection,
+                    ', '.join("((data->'{0}')::text)".format(i) for i in idx)
+                ))
+
+        self.conn.commit()
 
     def collection_get_pkey_type(self, collection):
         with self.conn.cursor() as cur:
@@ -138,6 +154,82 @@ class PostgresDatastore(object):
 
         self.conn.commit()
 
+    def __seed_sequence(self, cur, sequence, value):
+        # Sequences never go backwards, so seeding is safe to repeat. It brings
+        # the sequence up to date with keys that were inserted explicitly
+        # (restores, migrations).
+        if value is None:
+            return
+
+        cur.execute("SELECT last_value FROM {0}".format(sequence))
+        cur.execute("SELECT setval(%s, %s)", (sequence, max(value, cur.fetchone()[0])))
+
+    def __max_prefixed_key(self, cur, collection, prefix):
+        pattern = '^{0}([0-9]+)$'.format(re.escape(prefix))
+        cur.execute("SELECT max(substring(id::text from %s)::bigint) FROM {0} WHERE id::text ~* %s".format(
+            collection
+        ), (pattern, pattern))
+        return cur.fetchone()[0]
+
+    def collection_reseed_keys(self, collection):
+        serial = '{0}_id_seq'.format(collection)
+        version = '{0}_version_seq'.format(collection)
+        with self.conn.cursor() as cur:
+            cur.execute("SELECT pg_get_serial_sequence(%s, 'id')", (collection,))
+            sequence = cur.fetchone()[0]
+            if sequence:
+                cur.execute("SELECT max(id) FROM {0}".format(collection))
+                self.__seed_sequence(cur, sequence, cur.fetchone()[0])
+
+            cur.execute("SELECT sequence_name FROM information_schema.sequences " +
+                        "WHERE sequence_schema = %s", ('public',))
+            for name, in cur.fetchall():
+                if name in (serial, version) or not name.startswith(collection + '_') or not name.endswith('_seq'):
+                    continue
+
+                # Sequences of another collection sharing the name prefix only
+                # ever get moved forward, which just skips some keys
+                prefix = name[len(collection) + 1:-len('_seq')]
+                self.__seed_sequence(cur, name, self.__max_prefixed_key(cur, collection, prefix))
+
+        self.conn.commit()
+
+    def collection_get_next_pkey(self, collection, prefix):
+        # One sequence per key prefix, next to the one backing serial ids
+        sequence = '{0}_{1}_seq'.format(collection, prefix)
+        with self.conn.cursor() as cur:
+            cur.execute("SELECT to_regclass(%s) IS NULL", (sequence,))
+            if cur.fetchone()[0]:
+                cur.execute("CREATE SEQUENCE IF NOT EXISTS {0} MINVALUE 0 START 0".format(sequence))
+                self.__seed_sequence(cur, sequence, self.__max_prefixed_key(cur, collection, prefix))
+
+            cur.execute("SELECT nextval(%s)", (sequence,))
+            value = cur.fetchone()[0]
+
+        self.conn.commit()
+        return prefix + str(value)
+
+    def collection_get_version(self, collection):
+        sequence = '{0}_version_seq'.format(collection)
+        with self.conn.cursor() as cur:
+            cur.execute("CREATE SEQUENCE IF NOT EXISTS {0} MINVALUE 0 START 1".format(sequence))
+            # Until the first nextval(), last_value holds the start value
+            cur.execute("SELECT CASE WHEN is_called THEN last_value ELSE last_value - 1 END FROM {0}".format(sequence))
+            value = cur.fetchone()[0]
+
+        self.conn.commit()
+        return value
+
+    def collection_bump_version(self, collection):
+        sequence = '{0}_version_seq'.format(collection)
+        with self.conn.cursor() as cur:
+            cur.execute("CREATE SEQUENCE IF NOT EXISTS {0} MINVALUE 0 START 1".format(sequence))
+            cur.execute("SELECT nextval(%s)", (sequence,))
+            value = cur.fetchone()[0]
+
+        self.conn.commit()
+        return value
+
     def collection_list(self):
         with self.conn.cursor() as cur:
             cur.execute("SELECT table_name FROM information_schema.tables " +
@@ -148,6 +240,11 @@ class PostgresDatastore(object):
 
                 yield i[0]
 
+    def supports_predicate(self, *args):
+        # Operators are put into the SQL as they are, so only those valid
+        # there can be pushed down
+        return len(args) == 3 and args[1] in ('=', '!=', '<', '>', '<=', '>=')
+
     def query(self, collection, *args, **kwargs):
         wrap = kwargs.pop('wrap', True)
         with self.conn.cursor() as cur:
@@ -260,3 +357,132 @@ class PostgresDatastore(object):
 
     def exists(self, collection, *args):
         return self.get_one(collection, *args) is not None
+
+    def __bulk(self, operation, pkeys, execute, statement, rows, ordered, template=None):
+        # Try the whole batch as a single statement first. If that fails,
+        # replay it row by row under a savepoint to find the offending rows.
+        with self.conn.cursor() as cur:
+            try:
+                result = execute(cur, statement, rows, template)
+            except psycopg2.Error:
+                self.conn.rollback()
+            else:
+                self.conn.commit()
+                return result, list(range(0, len(rows)))
+
+            result = []
+            applied = []
+            errors = []
+            for idx, row in enumerate(rows):
+                cur.execute('SAVEPOINT bulk_item')
+                try:
+                    result.extend(execute(cur, statement, [row], template))
+                except psycopg2.Error as err:
+                    cur.execute('ROLLBACK TO SAVEPOINT bulk_item')
+                    cls = DuplicateKeyException if isinstance(err, psycopg2.IntegrityError) else DatastoreException
+                    errors.append({'index': idx, 'id': pkeys[idx], 'error': cls(err)})
+                    if ordered:
+                        break
+
+                    continue
+
+                cur.execute('RELEASE SAVEPOINT bulk_item')
+                applied.append(idx)
+
+            self.conn.commit()
+
+        if errors:
+            raise BulkWriteException(
+                '{0} of {1} rows failed in {2}'.format(len(errors), len(rows), operation),
+                errors,
+                result or [pkeys[i] for i in applied]
+            )
+
+        return result, applied
+
+    @staticmethod
+    def __execute_values(cur, statement, rows, template):
+        return [i[0] for i in psycopg2.extras.execute_values(cur, statement, rows, template=template, fetch=True)]
+
+    @staticmethod
+    def __execute_batch(cur, statement, rows, template):
+        psycopg2.extras.execute_batch(cur, statement, rows)
+        return []
+
+    def __bulk_rows(self, objs, pkeys=None):
+        rows = []
+        for idx, obj in enumerate(objs):
+            if hasattr(obj, '__getstate__'):
+                obj = obj.__getstate__()
+
+            pkey = pkeys[idx] if pkeys else None
+            if type(obj) is dict and 'id' in obj:
+                obj = dict(obj)
+                pkey = obj.pop('id')
+
+            rows.append((pkey, psycopg2.extras.Json(obj)))
+
+        return rows
+
+    def insert_many(self, collection, objs, pkeys=None, ordered=True):
+        rows = self.__bulk_rows(objs, pkeys)
+        template = None
+        if any(pkey is None for pkey, _ in rows):
+            template = "(COALESCE(%s, nextval('{0}_id_seq')), %s)".format(collection)
+
+        result, _ = self.__bulk(
+            'insert_many',
+            [pkey for pkey, _ in rows],
+            self.__execute_values,
+            "INSERT INTO {0} (id, data) VALUES %s RETURNING id".format(collection),
+            rows,
+            ordered,
+            template
+        )
+
+        return result
+
+    def update_many(self, collection, objs, ordered=True):
+        objs = list(objs)
+        pkeys = [pkey for pkey, _ in objs]
+        rows = [(data, pkey) for (_, data), pkey in zip(self.__bulk_rows([obj for _, obj in objs]), pkeys)]
+        _, applied = self.__bulk(
+            'update_many',
+            pkeys,
+            self.__execute_batch,
+            "UPDATE {0} SET data = %s WHERE id = %s".format(collection),
+            rows,
+            ordered
+        )
+
+        return [pkeys[i] for i in applied]
+
+    def upsert_many(self, collection, objs, ordered=True):
+        objs = list(objs)
+        pkeys = [pkey for pkey, _ in objs]
+        rows = self.__bulk_rows([obj for _, obj in objs], pkeys)
+        result, _ = self.__bulk(
+            'upsert_many',
+            pkeys,
+            self.__execute_values,
+            "INSERT INTO {0} (id, data) VALUES %s ON CONFLICT (id) DO UPDATE SET data = EXCLUDED.data RETURNING id".format(
+                collection
+            ),
+            rows,
+            ordered
+        )
+
+        return result
+
+    def delete_many(self, collection, pkeys, ordered=True):
+        pkeys = list(pkeys)
+        _, applied = self.__bulk(
+            'delete_many',
+            pkeys,
+            self.__execute_batch,
+            "DELETE FROM {0} WHERE id = %s".format(collection),
+            [(i,) for i in pkeys],
+            ordered
+        )
+
+        return [pkeys[i] for i in applied]
@@ -0,0 +1,109 @@
+#+
+# Copyright 2017 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+"""
+Compares indexed and full-scan CacheStore query latency.
+
+Usage: python3 benchmarks/cache_query.py [--sizes 10000,100000,500000]
+"""
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from cache import CacheStore
+
+
+SNAPSHOTS_PER_DATASET = 50
+DATASETS_PER_POOL = 100
+
+
+def sort_func(d):
+    return os.path.dirname(d), os.path.basename(d)
+
+
+def snap_sort_func(d):
+    ds, snap = d.split('@', 1)
+    par, base = sort_func(ds)
+    return par, base, snap
+
+
+def populate(store, count):
+    for i in range(count):
+        pool = 'pool{0}'.format(i // (SNAPSHOTS_PER_DATASET * DATASETS_PER_POOL))
+        dataset = '{0}/ds{1}'.format(pool, (i // SNAPSHOTS_PER_DATASET) % DATASETS_PER_POOL)
+        name = '{0}@auto-{1}'.format(dataset, i % SNAPSHOTS_PER_DATASET)
+        store.put(name, {
+            'id': name,
+            'name': name,
+            'pool': pool,
+            'dataset': dataset,
+            'type': 'SNAPSHOT',
+            'properties': {'used': {'rawvalue': str(i)}}
+        })
+
+
+def measure(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='10000,100000,500000')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    filters = [
+        ('dataset =', [('dataset', '=', 'pool0/ds7')]),
+        ('pool in', [('pool', 'in', ['pool0'])]),
+        ('id prefix', [('id', '~', '^pool0/ds7@')]),
+        ('scan', [('properties.used.rawvalue', '=', '7')]),
+    ]
+
+    print('{0:>8} {1:>12} {2:>12} {3:>12} {4:>8}'.format('size', 'query', 'scan ms', 'indexed ms', 'results'))
+    for size in (int(i) for i in args.sizes.split(',')):
+        plain = CacheStore(snap_sort_func)
+        indexed = CacheStore(snap_sort_func, indexes=['pool', 'dataset'], key_field='id')
+        populate(plain, size)
+        populate(indexed, size)
+
+        for label, f in filters:
+            scan = measure(lambda: plain.query(*f), args.repeat)
+            idx = measure(lambda: indexed.query(*f), args.repeat)
+            count = len(indexed.query(*f))
+            print('{0:>8} {1:>12} {2:>12.2f} {3:>12.2f} {4:>8}'.format(size, label, scan, idx, count))
+
+
+if __name__ == '__main__':
+    main()
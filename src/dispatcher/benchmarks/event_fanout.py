@@ -0,0 +1,111 @@
+#+
+# Copyright 2017 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+"""
+Measures events/sec resolved to subscribed connections, matching every mask
+of every connection per event versus using the subscription index.
+
+Usage: python3 benchmarks/event_fanout.py [--connections 100] [--events 100000]
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from bsd import fnmatch as cfnmatch
+from event import EventRouter
+
+
+MASKS = [
+    ['*'],
+    ['task.*', 'entity-subscriber.*'],
+    ['statd.*.pulse'],
+    ['task.progress', 'server.*'],
+    ['zfs.*.changed', 'volume.changed', 'volume.snapshot.changed'],
+    ['entity-subscriber.volume.changed', 'entity-subscriber.task.changed'],
+]
+
+EVENTS = [
+    'statd.localhost.aggregation-cpu-sum.cpu-user.value.pulse',
+    'statd.localhost.interface-em0.if_octets.rx.pulse',
+    'task.progress',
+    'task.updated',
+    'zfs.dataset.changed',
+    'volume.snapshot.changed',
+    'entity-subscriber.volume.changed',
+    'server.client_connected',
+    'network.changed',
+]
+
+
+class FakeConnection(object):
+    def __init__(self, masks):
+        self.event_masks = set(masks)
+        self.delivered = 0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--connections', type=int, default=100)
+    parser.add_argument('--events', type=int, default=100000)
+    args = parser.parse_args()
+
+    random.seed(0)
+    conns = [FakeConnection(random.choice(MASKS)) for i in range(args.connections)]
+    router = EventRouter()
+    for c in conns:
+        router.subscribe(c, c.event_masks)
+
+    names = [random.choice(EVENTS) for i in range(args.events)]
+
+    start = time.perf_counter()
+    for name in names:
+        for c in conns:
+            for mask in c.event_masks:
+                if cfnmatch(name, mask):
+                    c.delivered += 1
+
+    linear = args.events / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for name in names:
+        for c in router.resolve(name):
+            c.delivered += 1
+
+    indexed = args.events / (time.perf_counter() - start)
+
+    print('{0} connections, {1} events'.format(args.connections, args.events))
+    print('{0:<32} {1:>12.0f}'.format('per-mask matching events/s', linear))
+    print('{0:<32} {1:>12.0f}'.format('event router events/s', indexed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+#+
+# Copyright 2017 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+"""
+Simulates a reconnect storm: every client unsubscribes all its masks and
+subscribes them again, with many registered event types. Compares matching
+every event type per mask against the mask cache.
+
+Usage: python3 benchmarks/event_subscriptions.py [--clients 500] [--types 5000]
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from event import MaskCache, match_event
+
+
+MASKS = [
+    ['*'],
+    ['entity-subscriber.*', 'task.*'],
+    ['statd.*.pulse'],
+    ['task.progress', 'server.*'],
+    ['entity-subscriber.volume.changed', 'entity-subscriber.task.changed'],
+]
+
+
+class FakeEventType(object):
+    def __init__(self):
+        self.refcount = 0
+
+    def incref(self):
+        self.refcount += 1
+
+    def decref(self):
+        self.refcount -= 1
+
+
+def make_types(count):
+    types = {}
+    for i in range(count):
+        types['statd.localhost.source{0}.value.pulse'.format(i)] = FakeEventType()
+
+    for name in ('task.progress', 'task.updated', 'server.client_connected', 'entity-subscriber.volume.changed'):
+        types[name] = FakeEventType()
+
+    return types
+
+
+def storm_linear(types, clients):
+    for masks in clients:
+        for mask in masks:
+            for name, ev in types.items():
+                if match_event(name, mask):
+                    ev.decref()
+
+        for mask in masks:
+            for name, ev in types.items():
+                if match_event(name, mask):
+                    ev.incref()
+
+
+def storm_cached(cache, clients):
+    for masks in clients:
+        cache.unsubscribe(masks)
+        cache.subscribe(masks)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=500)
+    parser.add_argument('--types', type=int, default=5000)
+    args = parser.parse_args()
+
+    random.seed(0)
+    clients = [random.choice(MASKS) for i in range(args.clients)]
+
+    types = make_types(args.types)
+    start = time.perf_counter()
+    storm_linear(types, clients)
+    linear = time.perf_counter() - start
+
+    types = make_types(args.types)
+    cache = MaskCache(types)
+    for masks in clients:
+        cache.subscribe(masks)
+
+    start = time.perf_counter()
+    storm_cached(cache, clients)
+    cached = time.perf_counter() - start
+
+    print('{0} clients, {1} event types'.format(args.clients, len(types)))
+    print('{0:<32} {1:>12.3f}'.format('per-type matching s', linear))
+    print('{0:<32} {1:>12.3f}'.format('mask cache s', cached))
+
+
+if __name__ == '__main__':
+    main()
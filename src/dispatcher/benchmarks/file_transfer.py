@@ -0,0 +1,128 @@
+#+
+# Copyright 2017 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+"""
+Downloads a large local file from a running dispatcher through the HTTP
+(/filedownload) and websocket (/file) endpoints and reports throughput.
+
+Usage: python3 benchmarks/file_transfer.py [--size 2048] [--port 5000] [--path /var/tmp/transfer.bin]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from freenas.dispatcher.client import Client
+from ws4py.client.threadedclient import WebSocketClient
+
+
+BUFSIZE = 1024 * 1024
+
+
+class DownloadClient(WebSocketClient):
+    def __init__(self, url, token):
+        super(DownloadClient, self).__init__(url)
+        self.token = token
+        self.received = 0
+        self.authenticated = False
+        self.finished = threading.Event()
+
+    def opened(self):
+        self.send(json.dumps({'token': self.token}))
+
+    def received_message(self, message):
+        if not self.authenticated:
+            self.authenticated = True
+            return
+
+        self.received += len(message.data)
+
+    def closed(self, code, reason=None):
+        self.finished.set()
+
+
+def make_file(path, size):
+    with open(path, 'wb') as f:
+        chunk = os.urandom(BUFSIZE)
+        for i in range(size):
+            f.write(chunk)
+
+
+def report(name, size, elapsed):
+    print('{0:<12} {1:>10} bytes {2:>10.1f} MB/s {3:>8.2f} s'.format(name, size, size / elapsed / 2**20, elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=2048, help='File size in MB')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--path', default='/var/tmp/transfer.bin')
+    args = parser.parse_args()
+
+    make_file(args.path, args.size)
+    client = Client()
+    client.connect('unix:')
+    client.login_service('benchmark')
+
+    try:
+        token = client.call_sync('filesystem.download', args.path)
+        start = time.perf_counter()
+        received = 0
+        url = 'http://127.0.0.1:{0}/filedownload?token={1}'.format(args.port, token)
+        with urllib.request.urlopen(url) as f:
+            while True:
+                data = f.read(BUFSIZE)
+                if not data:
+                    break
+
+                received += len(data)
+
+        report('http', received, time.perf_counter() - start)
+
+        token = client.call_sync('filesystem.download', args.path)
+        start = time.perf_counter()
+        ws = DownloadClient('ws://127.0.0.1:{0}/file'.format(args.port), token)
+        ws.connect()
+        ws.finished.wait()
+        report('websocket', ws.received, time.perf_counter() - start)
+
+        transfers = client.call_sync('management.get_file_transfers')
+        for i in transfers['finished'][-2:]:
+            print('server side: {0} {1} bytes at {2:.1f} MB/s'.format(i['direction'], i['done'], i['throughput'] / 2**20))
+    finally:
+        client.disconnect()
+        os.unlink(args.path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#+
+# Copyright 2017 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+"""
+Measures ResourceGraph.can_acquire() latency for different graph sizes.
+
+Usage: python3 benchmarks/resources_can_acquire.py [--sizes 1000,10000,100000]
+"""
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from resources import ResourceGraph, Resource
+
+
+DATASETS_PER_POOL = 1000
+
+
+def build(size):
+    graph = ResourceGraph()
+    pools = max(1, size // DATASETS_PER_POOL)
+    for p in range(pools):
+        graph.add_resource(Resource('zpool:pool{0}'.format(p)))
+        graph.add_resource(Resource('zfs:pool{0}'.format(p)), parents=['zpool:pool{0}'.format(p)])
+
+    for i in range(size - 2 * pools):
+        pool = 'pool{0}'.format(i % pools)
+        graph.add_resource(Resource('zfs:{0}/ds{1}'.format(pool, i)), parents=['zfs:{0}'.format(pool)])
+
+    return graph, pools
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='1000,10000,100000')
+    parser.add_argument('--repeat', type=int, default=10000)
+    args = parser.parse_args()
+
+    print('{0:>8} {1:>16} {2:>16}'.format('size', 'can_acquire us', 'acquire+rel us'))
+    for size in (int(i) for i in args.sizes.split(',')):
+        graph, pools = build(size)
+        names = ['zpool:pool{0}'.format(i % pools) for i in range(args.repeat)]
+
+        # Keep one dataset busy so pool level checks have something to find
+        graph.acquire('zfs:pool0/ds0')
+
+        start = time.perf_counter()
+        for name in names:
+            graph.can_acquire(name)
+
+        can_acquire = (time.perf_counter() - start) / args.repeat * 1000000
+
+        start = time.perf_counter()
+        for i in range(args.repeat):
+            ds = i % (size - 2 * pools)
+            name = 'zfs:pool{0}/ds{1}'.format(ds % pools, ds)
+            graph.acquire(name)
+            graph.release(name)
+
+        acquire = (time.perf_counter() - start) / args.repeat * 1000000
+        print('{0:>8} {1:>16.2f} {2:>16.2f}'.format(size, can_acquire, acquire))
+
+
+if __name__ == '__main__':
+    main()
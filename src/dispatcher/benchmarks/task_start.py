@@ -0,0 +1,136 @@
+#+
+# Copyright 2017 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+"""
+Measures task start overhead: plugin module lookup with and without the
+precomputed module map and, when --task is given, submit to EXECUTING
+latency against a running dispatcher.
+
+Usage: python3 benchmarks/task_start.py [--plugin-dir plugins] [--task NAME --args JSON --count 100]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from freenas.utils import first_or_default
+
+
+def walk_lookup(dirs, module_name):
+    def match_file(module, f):
+        name, ext = os.path.splitext(f)
+        return module == name and ext in ['.py', '.pyc', '.so']
+
+    for dir in dirs:
+        for root, _, files in os.walk(dir):
+            file = first_or_default(lambda f: match_file(module_name, f), files)
+            if file:
+                return os.path.join(root, file)
+
+
+def index_modules(dirs):
+    files = {}
+    for dir in dirs:
+        for root, _, filenames in os.walk(dir):
+            for f in filenames:
+                name, ext = os.path.splitext(f)
+                if ext in ('.py', '.pyc', '.so'):
+                    files.setdefault(name, os.path.join(root, f))
+
+    return files
+
+
+def bench_lookup(dirs):
+    names = list(index_modules(dirs).keys())
+    if not names:
+        print('No modules found in {0}'.format(', '.join(dirs)))
+        return
+
+    start = time.perf_counter()
+    for name in names:
+        walk_lookup(dirs, name)
+
+    walk = (time.perf_counter() - start) / len(names) * 1000000
+
+    start = time.perf_counter()
+    files = index_modules(dirs)
+    for name in names:
+        files.get(name)
+
+    indexed = (time.perf_counter() - start) / len(names) * 1000000
+
+    print('{0} modules'.format(len(names)))
+    print('{0:<32} {1:>12.2f}'.format('os.walk lookup us/task', walk))
+    print('{0:<32} {1:>12.2f}'.format('index + lookup us/task', indexed))
+
+
+def bench_live(task, args, count):
+    from freenas.dispatcher.client import Client
+
+    client = Client()
+    client.connect('unix:')
+    client.login_service('benchmark')
+
+    latencies = []
+    for i in range(count):
+        tid = client.call_sync('task.submit', task, args)
+        client.call_sync('task.wait', tid, timeout=None)
+        status = client.call_sync('task.status', tid)
+        if status.get('started_at') and status.get('created_at'):
+            latencies.append((status['started_at'] - status['created_at']).total_seconds())
+
+    client.disconnect()
+    if not latencies:
+        print('No task reached EXECUTING state')
+        return
+
+    latencies.sort()
+    print('{0:<32} {1:>12.2f}'.format('submit->EXECUTING avg ms', sum(latencies) / len(latencies) * 1000))
+    print('{0:<32} {1:>12.2f}'.format('submit->EXECUTING p95 ms', latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)] * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--plugin-dir', action='append')
+    parser.add_argument('--task')
+    parser.add_argument('--args', default='[]')
+    parser.add_argument('--count', type=int, default=100)
+    args = parser.parse_args()
+
+    dirs = args.plugin_dir or [os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'plugins')]
+    bench_lookup(dirs)
+
+    if args.task:
+        bench_live(args.task, json.loads(args.args), args.count)
+
+
+if __name__ == '__main__':
+    main()
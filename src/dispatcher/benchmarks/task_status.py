@@ -0,0 +1,157 @@
+#+
+# Copyright 2017 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+"""
+Measures task.status lookup latency with a given number of active, queued
+and recently finished tasks, comparing in-memory state against a
+datastore_log round trip.
+
+Usage: python3 benchmarks/task_status.py [--tasks 1000] [--config /usr/local/etc/middleware.conf]
+"""
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from datastore import get_datastore
+from freenas.utils import first_or_default
+from resources import ResourceGraph
+from balancer import Balancer, Task
+from task import TaskState
+
+
+COLLECTION = 'benchmark.tasks'
+
+
+class CollectionProxy(object):
+    """
+    Redirects the 'tasks' collection to a scratch one, so the benchmark
+    does not touch the real task log.
+    """
+    def __init__(self, ds):
+        self.ds = ds
+
+    def __getattr__(self, item):
+        fn = getattr(self.ds, item)
+
+        def wrapped(collection, *args, **kwargs):
+            return fn(COLLECTION if collection == 'tasks' else collection, *args, **kwargs)
+
+        return wrapped
+
+
+class FakeConfigStore(object):
+    def get(self, key):
+        return None
+
+
+class FakeDispatcher(object):
+    def __init__(self, ds):
+        self.datastore_log = CollectionProxy(ds)
+        self.configstore = FakeConfigStore()
+        self.resource_graph = ResourceGraph()
+        self.tasks = {}
+        self.balancer = Balancer(self)
+
+    def require_collection(self, collection, pkey_type='uuid', type='config'):
+        if not self.datastore_log.collection_exists(collection):
+            self.datastore_log.collection_create(collection, pkey_type)
+
+    def register_event_type(self, name):
+        pass
+
+    def dispatch_event(self, name, args):
+        pass
+
+
+def create_task(dispatcher, i):
+    task = Task(dispatcher, 'benchmark.task{0}'.format(i))
+    task.args = [i]
+    task.id = dispatcher.datastore_log.insert('tasks', task)
+    task.set_state(TaskState.CREATED)
+    return task
+
+
+def measure(fn, ids):
+    start = time.perf_counter()
+    for i in ids:
+        fn(i)
+
+    return (time.perf_counter() - start) / len(ids) * 1000000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tasks', type=int, default=1000)
+    parser.add_argument('--config', default=None)
+    args = parser.parse_args()
+
+    ds = get_datastore(args.config, log=True)
+    ds.collection_delete(COLLECTION)
+    dispatcher = FakeDispatcher(ds)
+    balancer = dispatcher.balancer
+
+    try:
+        finished = []
+        queued = []
+        for i in range(args.tasks):
+            task = create_task(dispatcher, i)
+            if i % 2:
+                balancer.task_list.add(task)
+                task.set_state(TaskState.FINISHED)
+                finished.append(task.id)
+            else:
+                balancer.queued_tasks[task.id] = task
+                balancer.task_queue.put(task)
+                queued.append(task.id)
+
+        print('{0:<32} {1:>12}'.format('lookup', 'us/call'))
+        print('{0:<32} {1:>12.2f}'.format(
+            'finished: datastore_log',
+            measure(lambda i: ds.get_by_id(COLLECTION, i), finished)
+        ))
+        print('{0:<32} {1:>12.2f}'.format(
+            'finished: task history',
+            measure(balancer.get_task_state, finished)
+        ))
+        print('{0:<32} {1:>12.2f}'.format(
+            'queued: task_queue scan',
+            measure(lambda i: first_or_default(lambda x: x.id == i, balancer.task_queue.queue), queued)
+        ))
+        print('{0:<32} {1:>12.2f}'.format(
+            'queued: get_task',
+            measure(balancer.get_task, queued)
+        ))
+    finally:
+        ds.collection_delete(COLLECTION)
+
+
+if __name__ == '__main__':
+    main()
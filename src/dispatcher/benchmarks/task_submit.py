@@ -0,0 +1,79 @@
+#+
+# Copyright 2017 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+"""
+Measures task submission throughput for a schema-heavy task against a
+running dispatcher. Arguments are rejected by schema validation by default,
+so the benchmark exercises verify_schema() without side effects.
+
+Usage: python3 benchmarks/task_submit.py [--task volume.create] [--args JSON] [--count 500]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from freenas.dispatcher.client import Client
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--task', default='volume.create')
+    parser.add_argument('--args', default='[null]')
+    parser.add_argument('--count', type=int, default=500)
+    args = parser.parse_args()
+
+    client = Client()
+    client.connect('unix:')
+    client.login_service('benchmark')
+    task_args = json.loads(args.args)
+
+    start = time.perf_counter()
+    ids = [client.call_sync('task.submit', args.task, task_args) for i in range(args.count)]
+    submitted = time.perf_counter() - start
+
+    for i in ids:
+        client.call_sync('task.wait', i, timeout=None)
+
+    total = time.perf_counter() - start
+    states = {}
+    for i in ids:
+        state = client.call_sync('task.status', i)['state']
+        states[state] = states.get(state, 0) + 1
+
+    client.disconnect()
+    print('{0:<32} {1:>12.1f}'.format('submitted tasks/s', args.count / submitted))
+    print('{0:<32} {1:>12.1f}'.format('verified tasks/s', args.count / total))
+    print('final states: {0}'.format(', '.join('{0}={1}'.format(k, v) for k, v in sorted(states.items()))))
+
+
+if __name__ == '__main__':
+    main()
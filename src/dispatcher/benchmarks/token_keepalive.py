@@ -0,0 +1,94 @@
+#+
+# Copyright 2017 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+"""
+Measures TokenStore.keepalive_token() throughput with a number of live
+tokens, by token id and by token object, compared with rescheduling a
+greenlet per keepalive.
+
+Usage: python3 benchmarks/token_keepalive.py [--tokens 10000] [--calls 100000]
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import gevent
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from auth import TokenStore, Token
+
+
+def legacy_keepalive(store, token, token_id):
+    gevent.kill(token.timer)
+    token.timer = gevent.spawn_later(token.lifetime, store.revoke_token, token_id)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tokens', type=int, default=10000)
+    parser.add_argument('--calls', type=int, default=100000)
+    args = parser.parse_args()
+
+    store = TokenStore(None)
+    ids = [store.issue_token(Token(user=None, lifetime=600)) for i in range(args.tokens)]
+    random.seed(0)
+    calls = [random.choice(ids) for i in range(args.calls)]
+
+    start = time.perf_counter()
+    for i in calls:
+        store.keepalive_token(i)
+
+    by_id = args.calls / (time.perf_counter() - start)
+
+    tokens = [store.lookup_token(i) for i in calls]
+    start = time.perf_counter()
+    for t in tokens:
+        store.keepalive_token(t)
+
+    by_token = args.calls / (time.perf_counter() - start)
+
+    for i in ids:
+        t = store.lookup_token(i)
+        t.timer = gevent.spawn_later(t.lifetime, store.revoke_token, i)
+
+    start = time.perf_counter()
+    for i, t in zip(calls, tokens):
+        legacy_keepalive(store, t, i)
+
+    legacy = args.calls / (time.perf_counter() - start)
+
+    print('{0} live tokens, {1} keepalives'.format(args.tokens, args.calls))
+    print('{0:<32} {1:>12.0f}'.format('keepalive by id/s', by_id))
+    print('{0:<32} {1:>12.0f}'.format('keepalive by token/s', by_token))
+    print('{0:<32} {1:>12.0f}'.format('greenlet respawn/s', legacy))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+#+
+# Copyright 2017 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+"""
+Measures ZFS snapshot cache startup time and resident memory in eager
+and lazy mode, using a fake libzfs provider.
+
+Usage: python3 benchmarks/zfs_snapshot_cache.py [--snapshots 200000]
+"""
+
+import os
+import sys
+import time
+import types
+import resource
+import argparse
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'plugins'))
+
+
+PROPERTY_COUNT = 60
+SNAPSHOTS_PER_DATASET = 100
+
+
+class FakeZFSException(Exception):
+    pass
+
+
+class FakeProperty(object):
+    def __init__(self, name, value):
+        self.name = name
+        self.value = value
+
+    def __getstate__(self):
+        return {
+            'source': 'DEFAULT',
+            'value': self.value,
+            'rawvalue': self.value,
+            'parsed': self.value
+        }
+
+
+class FakeSnapshot(object):
+    def __init__(self, name, txg):
+        self.name = name
+        self.txg = txg
+
+    @property
+    def properties(self):
+        props = {'prop{0}'.format(i): FakeProperty('prop{0}'.format(i), str(i)) for i in range(PROPERTY_COUNT)}
+        props['createtxg'] = FakeProperty('createtxg', str(self.txg))
+        props['creation'] = FakeProperty('creation', str(1500000000 + self.txg))
+        return props
+
+    def __getstate__(self):
+        dataset = self.name.split('@', 1)[0]
+        return {
+            'id': self.name,
+            'name': self.name,
+            'pool': dataset.split('/')[0],
+            'dataset': dataset,
+            'type': 'SNAPSHOT',
+            'holds': {},
+            'properties': {k: v.__getstate__() for k, v in self.properties.items()}
+        }
+
+
+class FakeZFS(object):
+    count = 0
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    @property
+    def snapshots(self):
+        for i in range(self.count):
+            yield self.get_snapshot('tank/ds{0}@auto-{1}'.format(i // SNAPSHOTS_PER_DATASET, i))
+
+    def get_snapshot(self, name):
+        return FakeSnapshot(name, int(name.rsplit('-', 1)[1]))
+
+
+class FakeDispatcher(object):
+    def threaded(self, fn, *args, **kwargs):
+        return fn(*args, **kwargs)
+
+    def emit_event(self, name, args):
+        pass
+
+
+def install_fakes():
+    libzfs = types.ModuleType('libzfs')
+    libzfs.ZFS = FakeZFS
+    libzfs.ZFSException = FakeZFSException
+    sys.modules['libzfs'] = libzfs
+    sys.modules.setdefault('bsd', types.ModuleType('bsd'))
+
+
+def run(mode, count, capacity):
+    install_fakes()
+    import ZfsPlugin
+    from cache import EventCacheStore
+
+    FakeZFS.count = count
+    dispatcher = FakeDispatcher()
+    zfs = ZfsPlugin.get_zfs()
+    loader = ZfsPlugin.SnapshotLoader(dispatcher, capacity) if mode == 'lazy' else None
+    store = EventCacheStore(dispatcher, 'zfs.snapshot', indexes=['pool', 'dataset'], key_field='id', loader=loader)
+
+    start = time.perf_counter()
+    if loader:
+        store.update_partial(**{i['id']: i for i in (ZfsPlugin.snapshot_stub(s) for s in zfs.snapshots)})
+    else:
+        store.update(**{i['id']: i for i in (s.__getstate__() for s in zfs.snapshots)})
+
+    startup = time.perf_counter() - start
+
+    start = time.perf_counter()
+    store.query(('dataset', '=', 'tank/ds1'))
+    first_query = time.perf_counter() - start
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print('{0:>6} {1:>10} {2:>12.2f} {3:>14.2f} {4:>12}'.format(mode, count, startup, first_query * 1000, rss))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--snapshots', type=int, default=200000)
+    parser.add_argument('--capacity', type=int, default=20000)
+    parser.add_argument('--mode', choices=['eager', 'lazy'])
+    args = parser.parse_args()
+
+    if args.mode:
+        run(args.mode, args.snapshots, args.capacity)
+        return
+
+    # Run each mode in a separate process so peak RSS is not shared
+    print('{0:>6} {1:>10} {2:>12} {3:>14} {4:>12}'.format('mode', 'snapshots', 'startup s', 'first query ms', 'max RSS kB'))
+    sys.stdout.flush()
+    for mode in ('eager', 'lazy'):
+        subprocess.check_call([
+            sys.executable, __file__,
+            '--mode', mode,
+            '--snapshots', str(args.snapshots),
+            '--capacity', str(args.capacity)
+        ])
+
+
+if __name__ == '__main__':
+    main()
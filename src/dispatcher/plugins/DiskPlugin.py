@@ -112,11 +112,11 @@ class DiskProvider(Provider):
             disk['rname'] = 'disk:{0}'.format(disk['path'])
             return disk
 
-        return q.query(
-            self.datastore.query_stream('disks', callback=extend),
-            *(filter or []),
-            stream=True,
-            **(params or {})
+        return self.datastore_query(
+            'disks', filter, params,
+            callback=extend,
+            computed=('online', 'status', 'rname'),
+            depends=('id', 'path', 'delete_at')
         )
 
     @accepts(str)
@@ -35,6 +35,9 @@ from freenas.dispatcher.rpc import generator, description, accepts, private
 from freenas.utils.permissions import get_type, get_unix_permissions
 
 
+INDEX_BATCH_SIZE = 1000
+
+
 @description("Provides access to the filesystem index")
 class IndexProvider(Provider):
     @generator
@@ -119,8 +122,11 @@ class IndexDatasetIncrementalTask(ProgressTask):
         if not ds:
             raise TaskException(errno.ENOENT, 'Dataset {0} not found'.format(dataset))
 
+        batch = IndexBatch(self.datastore)
         for rec in ds.diff('{0}@org.freenas.indexer:ref'.format(dataset), '{0}@org.freenas.indexer:now'.format(dataset)):
-            collect(self.datastore, rec.path)
+            batch.collect(rec.path)
+
+        batch.flush()
 
         self.run_subtask_sync('volume.snapshot.delete', '{0}@org.freenas.indexer:ref'.format(dataset))
         self.run_subtask_sync('volume.snapshot.update', '{0}@org.freenas.indexer:now'.format(dataset), {
@@ -148,21 +154,24 @@ class IndexDatasetFullTask(ProgressTask):
         statfs = bsd.statfs(mountpoint)
         total_files = statfs.files - statfs.free_files
         done_files = 0
+        batch = IndexBatch(self.datastore)
 
         for root, dirs, files in os.walk(mountpoint, topdown=True):
             dirs[:] = [dir for dir in dirs if not os.path.ismount(os.path.join(root, dir))]
 
             for d in dirs:
                 path = os.path.join(root, d)
-                collect(self.datastore, path)
+                batch.collect(path)
                 done_files += 1
                 self.set_progress(done_files / total_files * 100, 'Processing directory {0}'.format(path))
 
             for f in files:
                 path = os.path.join(root, f)
-                collect(self.datastore, path)
+                batch.collect(path)
                 done_files += 1
 
+        batch.flush()
+
         self.run_subtask_sync('volume.snapshot.create', {
             'dataset': dataset,
             'name': 'org.freenas.indexer:ref',
@@ -170,26 +179,44 @@ class IndexDatasetFullTask(ProgressTask):
         })
 
 
-def collect(datastore, path):
-    try:
-        st = os.stat(path, follow_symlinks=False)
-    except OSError as err:
-        # Can't access the file - delete index entry
-        datastore.delete('fileindex', path)
-        return
-
-    volume = path.split('/')[2]
-    datastore.upsert('fileindex', path, {
-        'id': path,
-        'volume': volume,
-        'type': get_type(st),
-        'atime': datetime.utcfromtimestamp(st.st_atime),
-        'mtime': datetime.utcfromtimestamp(st.st_mtime),
-        'ctime': datetime.utcfromtimestamp(st.st_ctime),
-        'uid': st.st_uid,
-        'gid': st.st_gid,
-        'permissions': get_unix_permissions(st.st_mode)
-    })
+class IndexBatch(object):
+    def __init__(self, datastore):
+        self.datastore = datastore
+        self.pending = {}
+
+    def collect(self, path):
+        try:
+            st = os.stat(path, follow_symlinks=False)
+        except OSError as err:
+            # Can't access the file - delete index entry
+            self.pending[path] = None
+        else:
+            volume = path.split('/')[2]
+            self.pending[path] = {
+                'id': path,
+                'volume': volume,
+                'type': get_type(st),
+                'atime': datetime.utcfromtimestamp(st.st_atime),
+                'mtime': datetime.utcfromtimestamp(st.st_mtime),
+                'ctime': datetime.utcfromtimestamp(st.st_ctime),
+                'uid': st.st_uid,
+                'gid': st.st_gid,
+                'permissions': get_unix_permissions(st.st_mode)
+            }
+
+        if len(self.pending) >= INDEX_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        pending, self.pending = self.pending, {}
+        upserts = [(k, v) for k, v in pending.items() if v is not None]
+        deletes = [k for k, v in pending.items() if v is None]
+
+        if upserts:
+            self.datastore.upsert_many('fileindex', upserts, ordered=False)
+
+        if deletes:
+            self.datastore.delete_many('fileindex', deletes, ordered=False)
 
 
 def _init(dispatcher, plugin):
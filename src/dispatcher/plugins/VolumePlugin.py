@@ -41,7 +41,7 @@ import uuid
 import itertools
 from datetime import datetime
 from event import sync
-from cache import EventCacheStore
+from cache import EventCacheStore, CacheLoader
 from lib.system import SubprocessException
 from lib.freebsd import fstyp
 from lib.zfs import compare_vdevs, iterate_vdevs, vdev_by_guid, split_snapshot_name, get_disks, get_disk_ids
@@ -534,6 +534,27 @@ class SnapshotProvider(Provider):
         return snapname
 
 
+class SnapshotLoader(CacheLoader):
+    fields = ['id', 'volume', 'dataset', 'name', 'lifetime', 'expires_at', 'replicable', 'hidden']
+
+    def __init__(self, dispatcher, convert, capacity=None):
+        super(SnapshotLoader, self).__init__(capacity)
+        self.dispatcher = dispatcher
+        self.convert = convert
+
+    def load(self, keys):
+        result = {}
+        for i in self.dispatcher.call_sync('zfs.snapshot.query', [('id', 'in', keys)], no_copy=True):
+            snap = self.convert(i)
+            if snap:
+                result[snap['id']] = snap
+
+        return result
+
+    def strip(self, data):
+        return {k: data[k] for k in self.fields}
+
+
 @description("Creating a volume")
 @accepts(
     h.all_of(
@@ -3194,7 +3215,7 @@ def _init(dispatcher, plugin):
                 snapshot['properties'],
                 'used', 'referenced', 'compressratio', 'clones', 'creation'
             ),
-            'holds': snapshot['holds'],
+            'holds': snapshot.get('holds'),
             'metadata': convert_properties(snapshot['properties'])
         }
 
@@ -3767,8 +3788,20 @@ def _init(dispatcher, plugin):
     plugin.push_status('Populating volume cache...')
 
     global snapshots
-    snapshots = EventCacheStore(dispatcher, 'volume.snapshot')
-    snapshots.populate(dispatcher.call_sync('zfs.snapshot.query', no_copy=True), callback=convert_snapshot)
+    if dispatcher.configstore.get('middleware.zfs_lazy_snapshots'):
+        loader = SnapshotLoader(
+            dispatcher,
+            convert_snapshot,
+            dispatcher.configstore.get('middleware.zfs_snapshot_cache_size')
+        )
+        snapshots = EventCacheStore(dispatcher, 'volume.snapshot', key_field='id', loader=loader)
+        partial = (convert_snapshot(s) for s in dispatcher.call_sync(
+            'zfs.snapshot.query', [], {'partial': True}, no_copy=True
+        ))
+        snapshots.update_partial(**{s['id']: loader.strip(s) for s in partial if s})
+    else:
+        snapshots = EventCacheStore(dispatcher, 'volume.snapshot')
+        snapshots.populate(dispatcher.call_sync('zfs.snapshot.query', no_copy=True), callback=convert_snapshot)
     snapshots.ready = True
     plugin.register_event_handler(
         'entity-subscriber.zfs.snapshot.changed',
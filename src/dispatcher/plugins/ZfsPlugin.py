@@ -33,7 +33,7 @@ import time
 import gevent
 import libzfs
 from threading import Thread, Event
-from cache import EventCacheStore
+from cache import EventCacheStore, CacheLoader
 from event import sync
 from task import (
     Provider, Task, ProgressTask, TaskWarning, TaskException,
@@ -46,7 +46,7 @@ from debug import AttachData, AttachCommandOutput
 from lib.zfs import iterate_vdevs, vdev_by_guid, vdev_by_path, get_disks
 from freenas.utils.trace_logger import TRACE
 from freenas.utils import first_or_default, query as q
-from utils import is_child, split_dataset
+from utils import split_dataset
 
 
 USER_CACHE_FILE = '/data/zfs/volume.cache'
@@ -55,6 +55,12 @@ VOLATILE_ZFS_PROPERTIES = [
     'usedbydataset', 'usedbychildren', 'usedbyrefreservation', 'refcompressratio',
     'written', 'logicalused', 'logicalreferenced'
 ]
+LAZY_SNAPSHOT_PROPERTIES = [
+    'createtxg', 'creation', 'org.freenas:lifetime', 'org.freenas:replicable', 'org.freenas:hidden'
+]
+SNAPSHOT_FILL_BATCH = 500
+ZFS_REFRESH_MAX_BACKOFF = 8
+DATASET_PATH_FIELDS = ('id', 'name', 'dataset')
 
 logger = logging.getLogger('ZfsPlugin')
 pools = None
@@ -309,6 +315,49 @@ class ZfsSnapshotProvider(Provider):
         return snapshots.query(*(filter or []), stream=True, **(params or {}))
 
 
+class SnapshotLoader(CacheLoader):
+    fields = ['id', 'name', 'pool', 'dataset', 'type'] + [
+        'properties.{0}'.format(p.replace('.', '\\.')) for p in LAZY_SNAPSHOT_PROPERTIES
+    ]
+
+    def __init__(self, dispatcher, capacity=None):
+        super(SnapshotLoader, self).__init__(capacity)
+        self.dispatcher = dispatcher
+
+    def load(self, keys):
+        def doit():
+            zfs = get_zfs()
+            result = {}
+            for i in keys:
+                try:
+                    result[i] = zfs.get_snapshot(i).__getstate__()
+                except libzfs.ZFSException:
+                    pass
+
+            return result
+
+        return self.dispatcher.threaded(doit)
+
+    def strip(self, data):
+        ret = {k: data[k] for k in ('id', 'name', 'pool', 'dataset', 'type') if k in data}
+        ret['properties'] = {p: data['properties'][p] for p in LAZY_SNAPSHOT_PROPERTIES if p in data['properties']}
+        return ret
+
+
+def snapshot_stub(snapshot):
+    name = snapshot.name
+    dataset = name.split('@', 1)[0]
+    props = snapshot.properties
+    return {
+        'id': name,
+        'name': name,
+        'pool': dataset.split('/')[0],
+        'dataset': dataset,
+        'type': 'SNAPSHOT',
+        'properties': {p: props[p].__getstate__() for p in LAZY_SNAPSHOT_PROPERTIES if p in props}
+    }
+
+
 class ScanStatusTaskMixin(object):
     def start_watch(self, pool_name, scan_function):
         self.watch_event = Event()
@@ -1393,8 +1442,8 @@ def sync_zpool_cache(dispatcher, pool, guid=None):
     except libzfs.ZFSException as e:
         if e.code == libzfs.Error.NOENT:
             pools.remove(pool)
-            snapshots.remove_predicate(lambda i: i['pool'] == pool)
-            datasets.remove_predicate(lambda i: i['pool'] == pool)
+            snapshots.remove_subtree(pool)
+            datasets.remove_subtree(pool)
             return
 
         logger.warning("Cannot read pool status from pool {0}".format(pool))
@@ -1404,28 +1453,43 @@ def sync_dataset_cache(dispatcher, dataset, old_dataset=None, recursive=False, s
     zfs = get_zfs()
     pool = dataset.split('/')[0]
     sync_zpool_cache(dispatcher, pool)
-    try:
-        ds = dispatcher.threaded(lambda: zfs.get_dataset(dataset))
-        if old_dataset:
-            datasets.rename(old_dataset, dataset)
-
-        datasets.put(dataset, dispatcher.threaded(lambda: ds.__getstate__(False)))
 
+    def collect(ds, dataset_states, snapshot_states):
+        dataset_states[ds.name] = ds.__getstate__(False)
         if snaps:
-            for i in dispatcher.threaded(lambda: list(ds.snapshots)):
-                oldpath = f'{old_dataset}@{i.snapshot_name}' if old_dataset else None
-                sync_snapshot_cache(dispatcher, i.name, old_snapshot=oldpath)
+            for i in ds.snapshots:
+                try:
+                    snapshot_states[i.name] = snapshot_stub(i) if snapshots.loader else i.__getstate__()
+                except libzfs.ZFSException:
+                    pass
 
         if recursive:
-            for i in dispatcher.threaded(lambda: list(ds.children)):
-                oldpath = os.path.join(old_dataset, os.path.relpath(i.name, dataset)) if old_dataset else None
-                sync_dataset_cache(dispatcher, i.name, old_dataset=oldpath, recursive=True, snaps=snaps)
+            for i in ds.children:
+                try:
+                    collect(i, dataset_states, snapshot_states)
+                except libzfs.ZFSException:
+                    pass
+
+    try:
+        ds = dispatcher.threaded(lambda: zfs.get_dataset(dataset))
+        if old_dataset:
+            # ZFS renames the whole subtree at once, so do the cache
+            datasets.rename_subtree(old_dataset, dataset, fields=DATASET_PATH_FIELDS)
+            snapshots.rename_subtree(old_dataset, dataset, fields=DATASET_PATH_FIELDS)
+
+        dataset_states = {}
+        snapshot_states = {}
+        dispatcher.threaded(collect, ds, dataset_states, snapshot_states)
+        datasets.update(**dataset_states)
+        if snapshots.loader:
+            snapshots.update_partial(**snapshot_states)
+        else:
+            snapshots.update(**snapshot_states)
 
     except libzfs.ZFSException as e:
         if e.code == libzfs.Error.NOENT:
-            if datasets.remove(dataset):
-                snapshots.remove_predicate(lambda i: i['dataset'] == dataset)
-                datasets.remove_predicate(lambda i: is_child(i['name'], dataset))
+            if datasets.remove_subtree(dataset):
+                snapshots.remove_subtree(dataset)
 
             return
 
@@ -1634,41 +1698,88 @@ def _init(dispatcher, plugin):
                     # Try to clear errors
                     zpool_try_clear(dispatcher, volume['id'], vd)
 
-    def sync_sizes():
+    def fill_snapshots():
+        keys = snapshots.partial_keys()
+        total = len(keys)
+        if snapshots.loader.capacity is not None:
+            keys = keys[:snapshots.loader.capacity]
+
+        for i in range(0, len(keys), SNAPSHOT_FILL_BATCH):
+            snapshots.load(keys[i:i + SNAPSHOT_FILL_BATCH])
+            plugin.push_status('Loaded {0} of {1} ZFS snapshots'.format(min(i + SNAPSHOT_FILL_BATCH, len(keys)), total))
+
+        logger.info('Loaded {0} of {1} ZFS snapshots into cache'.format(len(keys), total))
+
+    def refresh_pool(pool):
         zfs = get_zfs()
-        interval = dispatcher.configstore.get('middleware.zfs_refresh_interval')
+        cached = {
+            i['id']: {p: q.get(i, f'properties.{p}.rawvalue') for p in VOLATILE_ZFS_PROPERTIES}
+            for i in datasets.query(('pool', '=', pool))
+        }
+
+        def doit():
+            diff = {}
+
+            def collect(ds):
+                # Datasets may go away while the pool is being walked, which
+                # must not cost the rest of the pool its refresh
+                old = cached.get(ds.name)
+                if old is not None:
+                    try:
+                        props = ds.properties
+                        changed = {p: props[p].__getstate__() for p in VOLATILE_ZFS_PROPERTIES if old[p] != props[p].rawvalue}
+                    except libzfs.ZFSException as err:
+                        logger.debug('Cannot refresh dataset {0}: {1}'.format(ds.name, str(err)))
+                        changed = None
+
+                    if changed:
+                        diff[ds.name] = changed
+
+                try:
+                    children = list(ds.children)
+                except libzfs.ZFSException as err:
+                    logger.debug('Cannot list children of dataset {0}: {1}'.format(ds.name, str(err)))
+                    return
+
+                for i in children:
+                    collect(i)
+
+            zfspool = zfs.get(pool)
+            collect(zfs.get_dataset(pool))
+            return zfspool.__getstate__(False), diff
+
+        zfspool, diff = dispatcher.threaded(doit)
+        if zfspool != pools.get(pool):
+            pools.put(pool, zfspool)
+
+        changed = {}
+        for name, props in diff.items():
+            ds = datasets.get(name)
+            if ds:
+                ds['properties'].update(props)
+                changed[name] = ds
+
+        datasets.update(**changed)
+        return bool(changed)
+
+    def sync_sizes():
+        base_interval = dispatcher.configstore.get('middleware.zfs_refresh_interval')
+        interval = base_interval
         while True:
             gevent.sleep(interval)
+            changed = False
             with dispatcher.get_lock('zfs-cache'):
-                for key, i in pools.itervalid():
+                for pool, _ in pools.itervalid():
                     try:
-                        zfspool = dispatcher.threaded(lambda: zfs.get(key).__getstate__(False))
-                        if zfspool != i:
-                            pools.put(key, zfspool)
-                    except libzfs.ZFSException:
-                        pass
-
-                changed = {}
-                for key, i in datasets.itervalid():
-                    def doit():
-                        props = i['properties']
-                        ds = zfs.get_dataset(i['id'])
-                        changed = False
-
-                        for prop in VOLATILE_ZFS_PROPERTIES:
-                            if props[prop]['rawvalue'] != ds.properties[prop].rawvalue:
-                                props[prop] = ds.properties[prop].__getstate__()
-                                changed = True
-
-                        return changed
-
-                    try:
-                        if dispatcher.threaded(doit):
-                            changed[key] = i
-                    except libzfs.ZFSException:
-                        pass
+                        changed = refresh_pool(pool) or changed
+                    except libzfs.ZFSException as err:
+                        logger.warning('Cannot refresh pool {0}: {1}'.format(pool, str(err)))
 
-                datasets.update(**changed)
+            # Back off while the pools are idle, go back to the base interval on first change
+            if changed:
+                interval = base_interval
+            else:
+                interval = min(interval * 2, base_interval * ZFS_REFRESH_MAX_BACKOFF)
 
     plugin.register_schema_definition('ZfsVdev', {
         'type': 'object',
@@ -2035,8 +2146,21 @@ def _init(dispatcher, plugin):
             return par, base, snap
 
         pools = EventCacheStore(dispatcher, 'zfs.pool', sort_func)
-        datasets = EventCacheStore(dispatcher, 'zfs.dataset', sort_func)
-        snapshots = EventCacheStore(dispatcher, 'zfs.snapshot', snap_sort_func)
+        datasets = EventCacheStore(
+            dispatcher, 'zfs.dataset', sort_func,
+            indexes=['pool', 'type'],
+            key_field='id'
+        )
+        lazy_snapshots = dispatcher.configstore.get('middleware.zfs_lazy_snapshots')
+        snapshots = EventCacheStore(
+            dispatcher, 'zfs.snapshot', snap_sort_func,
+            indexes=['pool', 'dataset'],
+            key_field='id',
+            loader=SnapshotLoader(
+                dispatcher,
+                dispatcher.configstore.get('middleware.zfs_snapshot_cache_size')
+            ) if lazy_snapshots else None
+        )
 
         pools_dict = {}
         for i in dispatcher.threaded(lambda: [p.__getstate__(False) for p in zfs.pools]):
@@ -2059,9 +2183,14 @@ def _init(dispatcher, plugin):
         plugin.push_status(msg)
 
         snapshots_dict = {}
-        for i in dispatcher.threaded(lambda: [s.__getstate__() for s in zfs.snapshots]):
-            snapshots_dict[i['id']] = i
-        snapshots.update(**snapshots_dict)
+        if lazy_snapshots:
+            for i in dispatcher.threaded(lambda: [snapshot_stub(s) for s in zfs.snapshots]):
+                snapshots_dict[i['id']] = i
+            snapshots.update_partial(**snapshots_dict)
+        else:
+            for i in dispatcher.threaded(lambda: [s.__getstate__() for s in zfs.snapshots]):
+                snapshots_dict[i['id']] = i
+            snapshots.update(**snapshots_dict)
 
         pools.ready = True
         datasets.ready = True
@@ -2072,6 +2201,8 @@ def _init(dispatcher, plugin):
         logger.info("Syncing ZFS cache took {0:.0f} ms".format((time.time() - zfs_cache_start) * 1000))
 
     gevent.spawn(sync_sizes)
+    if snapshots and snapshots.loader:
+        gevent.spawn(fill_snapshots)
 
     dispatcher.track_resources(
         'zfs.pool.query',
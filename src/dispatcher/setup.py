@@ -44,6 +44,7 @@ files = [
     "src/schemas.py",
     "src/services.py",
     "src/task.py",
+    "src/transfer.py",
     "src/websocket.py",
     "src/utils.py",
     "src/lib/freebsd.py",
@@ -25,10 +25,13 @@
 #
 #####################################################################
 
+import time
+import heapq
 import string
 import random
 import gevent
 import logging
+from gevent.event import Event
 from freenas.dispatcher.rpc import RpcException
 from lib.freebsd import sockstat
 
@@ -155,6 +158,8 @@ class FileToken(Token):
         self.file = kwargs.pop('file')
         self.name = kwargs.pop('name')
         self.size = kwargs.pop('size', None)
+        self.streams = 0
+        self.completed = False
         self.revocation_reason = '{0} of file: {1} timed out'.format(
             self.direction or 'Transfer',
             self.name or 'Unknown'
@@ -169,9 +174,20 @@ class FileToken(Token):
 
 
 class TokenStore(object):
+    """
+    Keeps issued tokens and expires them once they outlive their lifetime.
+    Expiration deadlines are kept in a heap with lazy deletion: keepalive
+    only moves the deadline of a token, and the single reaper greenlet
+    re-queues entries whose deadline moved since they were pushed.
+    """
     def __init__(self, dispatcher):
         self.dispatcher = dispatcher
         self.tokens = {}
+        self.token_ids = {}
+        self.deadlines = {}
+        self.heap = []
+        self.wakeup = Event()
+        self.reaper = None
 
     def generate_id(self):
         return ''.join([random.choice(string.ascii_letters + string.digits) for n in range(32)])
@@ -179,22 +195,17 @@ class TokenStore(object):
     def issue_token(self, token):
         token_id = self.generate_id()
         self.tokens[token_id] = token
+        self.token_ids[token] = token_id
 
         if token.lifetime:
-            if token.revocation_function is not None:
-                token.timer = gevent.spawn_later(
-                    token.lifetime,
-                    token.revocation_function,
-                    self,
-                    token,
-                    token_id
-                )
-            else:
-                token.timer = gevent.spawn_later(
-                    token.lifetime,
-                    self.revoke_token,
-                    token_id
-                )
+            deadline = time.monotonic() + token.lifetime
+            self.deadlines[token_id] = deadline
+            heapq.heappush(self.heap, (deadline, token_id))
+            if self.heap[0][1] == token_id:
+                self.wakeup.set()
+
+            if not self.reaper:
+                self.reaper = gevent.spawn(self.reap_tokens)
 
         return token_id
 
@@ -207,30 +218,14 @@ class TokenStore(object):
             if not token:
                 raise TokenException('Token not found or expired')
 
-        if token.lifetime:
-            gevent.kill(token.timer)
-            if token.revocation_function is not None:
-                token.timer = gevent.spawn_later(
-                    token.lifetime,
-                    token.revocation_function,
-                    self,
-                    token,
-                    token_id
-                )
-            else:
-                token.timer = gevent.spawn_later(
-                    token.lifetime,
-                    self.revoke_token,
-                    token_id
-                )
+        if token.lifetime and token_id in self.deadlines:
+            self.deadlines[token_id] = time.monotonic() + token.lifetime
 
     def lookup_token(self, token_id):
         return self.tokens.get(token_id)
 
     def lookup_token_id(self, token):
-        for key, value in self.tokens.items():
-            if value == token:
-                return key
+        return self.token_ids.get(token)
 
     def delete_token(self, token_id):
         if isinstance(token_id, Token):
@@ -242,11 +237,43 @@ class TokenStore(object):
                 logger.trace('Tried to delete token but it was not found or expired')
                 return
         if token.lifetime:
-            gevent.kill(token.timer)
+            self.deadlines.pop(token_id, None)
             token.revocation_reason = 'Token explicitly deleted'
-            token.revocation_function(self, token, token_id)
+            self.expire_token(token, token_id)
         else:
-            self.tokens.pop(token)
+            self.revoke_token(token_id)
 
     def revoke_token(self, token_id):
-        self.tokens.pop(token_id, None)
+        token = self.tokens.pop(token_id, None)
+        self.token_ids.pop(token, None)
+        self.deadlines.pop(token_id, None)
+
+    def expire_token(self, token, token_id):
+        if token.revocation_function is not None:
+            token.revocation_function(self, token, token_id)
+        else:
+            self.revoke_token(token_id)
+
+    def reap_tokens(self):
+        while True:
+            timeout = max(self.heap[0][0] - time.monotonic(), 0) if self.heap else None
+            self.wakeup.wait(timeout)
+            self.wakeup.clear()
+
+            now = time.monotonic()
+            while self.heap and self.heap[0][0] <= now:
+                deadline, token_id = heapq.heappop(self.heap)
+                current = self.deadlines.get(token_id)
+                if current is None:
+                    # Token is gone already
+                    continue
+
+                if current > now:
+                    # Token was kept alive in the meantime
+                    heapq.heappush(self.heap, (current, token_id))
+                    continue
+
+                del self.deadlines[token_id]
+                token = self.tokens.get(token_id)
+                if token:
+                    gevent.spawn(self.expire_token, token, token_id)
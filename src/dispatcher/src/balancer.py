@@ -26,6 +26,7 @@
 #####################################################################
 
 import os
+import time
 import gevent
 import logging
 import traceback
@@ -49,6 +50,7 @@ from gevent.event import Event, AsyncResult
 from gevent.subprocess import Popen
 from gevent.fileobject import FileObjectPosix
 from freenas.utils import first_or_default
+from datastore import BulkWriteException
 from resources import Resource
 from auth import FileToken
 from task import (
@@ -59,6 +61,13 @@ import collections
 
 
 TASKWORKER_PATH = '/usr/local/libexec/taskworker'
+TASK_HISTORY_SIZE = 1000
+EXECUTOR_IDLE_TIMEOUT = 300
+EXECUTOR_MAX_TASKS = 1000
+EXECUTOR_MAX_RSS = 512 * 1024
+PRELOAD_MODULES = 16
+START_LATENCY_SAMPLES = 1000
+JOURNAL_FLUSH_INTERVAL = 0.5
 ERROR_TYPES = {
     'RpcException': RpcException,
     'TaskException': TaskException,
@@ -87,6 +96,149 @@ class WorkerState(object):
     STARTING = 'STARTING'
 
 
+class TaskList(object):
+    """
+    Tasks known to the balancer, indexed by id, by state and by parent task.
+    """
+    def __init__(self):
+        self.tasks = collections.OrderedDict()
+        self.states = collections.defaultdict(collections.OrderedDict)
+        self.children = collections.defaultdict(collections.OrderedDict)
+
+    def __iter__(self):
+        return iter(list(self.tasks.values()))
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def __contains__(self, task):
+        return self.tasks.get(task.id) is task
+
+    def add(self, task):
+        self.tasks[task.id] = task
+        self.states[task.state][task.id] = task
+        if task.parent:
+            self.children[task.parent.id][task.id] = task
+
+    def remove(self, task):
+        if task not in self:
+            return False
+
+        del self.tasks[task.id]
+        self.states[task.state].pop(task.id, None)
+        if task.parent:
+            siblings = self.children.get(task.parent.id)
+            if siblings is not None:
+                siblings.pop(task.id, None)
+                if not siblings:
+                    del self.children[task.parent.id]
+
+        return True
+
+    def get(self, id):
+        return self.tasks.get(id)
+
+    def update_state(self, task, old_state):
+        if task not in self:
+            return
+
+        self.states[old_state].pop(task.id, None)
+        self.states[task.state][task.id] = task
+
+    def with_state(self, *states):
+        return [t for s in states for t in self.states[s].values()]
+
+    def count(self, state):
+        return len(self.states[state])
+
+    def subtasks(self, task):
+        return list(self.children.get(task.id, {}).values())
+
+
+class TaskJournal(object):
+    """
+    Write-behind journal of task documents in datastore_log. Updates of the
+    same task within a flush window are coalesced into a single write and
+    task.changed events are emitted once the documents are stored. Task ids
+    are pre-allocated, so submitting a task does not wait for an insert.
+    """
+    def __init__(self, dispatcher, interval=JOURNAL_FLUSH_INTERVAL):
+        self.dispatcher = dispatcher
+        self.interval = interval
+        self.logger = logging.getLogger('TaskJournal')
+        self.pending = collections.OrderedDict()
+        self.created = set()
+        self.next_id = None
+        self.lock = RLock()
+        self.ready = Event()
+
+    def allocate_id(self):
+        with self.lock:
+            if self.next_id is None:
+                last = self.dispatcher.datastore_log.query('tasks', sort='-id', limit=1, single=True)
+                self.next_id = last['id'] + 1 if last else 1
+
+            id = self.next_id
+            self.next_id += 1
+            return id
+
+    def update(self, task, create=False, flush=False):
+        with self.lock:
+            self.pending[task.id] = task
+            if create:
+                self.created.add(task.id)
+
+            self.ready.set()
+
+        if flush:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, collections.OrderedDict()
+            created, self.created = self.created, set()
+            self.ready.clear()
+            failed = []
+
+            try:
+                saved = self.dispatcher.datastore_log.upsert_many(
+                    'tasks',
+                    [(task.id, task) for task in pending.values()],
+                    ordered=False
+                )
+            except BulkWriteException as err:
+                saved = err.ids
+                failed = [(i['id'], i['error']) for i in err.errors]
+            except BaseException as err:
+                saved = []
+                failed = [(i, err) for i in pending]
+
+            for task_id, err in failed:
+                # Keep it around and retry with the next flush
+                self.logger.warning('Cannot save task {0}: {1}'.format(task_id, str(err)))
+                self.pending.setdefault(task_id, pending[task_id])
+                if task_id in created:
+                    self.created.add(task_id)
+
+                self.ready.set()
+
+        for operation, ids in (
+            ('create', [i for i in saved if i in created]),
+            ('update', [i for i in saved if i not in created])
+        ):
+            if ids:
+                self.dispatcher.dispatch_event('task.changed', {
+                    'operation': operation,
+                    'ids': ids
+                })
+
+    def flush_thread(self):
+        while True:
+            self.ready.wait()
+            gevent.sleep(self.interval)
+            self.flush()
+
+
 class TaskExecutor(object):
     def __init__(self, balancer, index):
         self.balancer = balancer
@@ -97,6 +249,9 @@ class TaskExecutor(object):
         self.conn = None
         self.state = WorkerState.STARTING
         self.key = str(uuid.uuid4())
+        self.tasks_run = 0
+        self.maxrss = 0
+        self.idle_since = time.monotonic()
         self.result = AsyncResult()
         self.exiting = False
         self.killed = False
@@ -109,8 +264,14 @@ class TaskExecutor(object):
             self.balancer.logger.debug('Check-in of worker #{0} (key {1})'.format(self.index, self.key))
             self.conn = conn
             self.state = WorkerState.IDLE
+            self.idle_since = time.monotonic()
+            self.tasks_run = 0
+            self.maxrss = 0
             self.cv.notify_all()
 
+        # Let the worker import modules of frequently run tasks before it gets any
+        return self.balancer.get_preload_modules()
+
     def put_progress(self, progress):
         st = TaskStatus(None)
         st.__setstate__(progress)
@@ -122,6 +283,7 @@ class TaskExecutor(object):
             try:
                 kinfo = self.balancer.dispatcher.threaded(bsd.kinfo_getproc, self.pid)
                 self.task.rusage = kinfo.rusage
+                self.maxrss = kinfo.rusage.get('ru_maxrss', 0)
             except LookupError:
                 pass
 
@@ -159,37 +321,42 @@ class TaskExecutor(object):
     def update_env(self, env):
         self.conn.call_sync('taskproxy.update_env', env)
 
-    def run(self, task):
-        def match_file(module, f):
-            name, ext = os.path.splitext(f)
-            return module == name and ext in ['.py', '.pyc', '.so']
+    def release(self):
+        # Must be called with self.cv held
+        if self.state != WorkerState.EXECUTING:
+            return
+
+        if self.tasks_run >= self.balancer.executor_max_tasks or self.maxrss >= self.balancer.executor_max_rss:
+            self.balancer.logger.info('Recycling executor #{0} after {1} tasks (maxrss {2} kB)'.format(
+                self.index,
+                self.tasks_run,
+                self.maxrss
+            ))
 
+            # Executor thread will respawn the worker and check it in again
+            self.state = WorkerState.STARTING
+            self.terminate()
+        else:
+            self.state = WorkerState.IDLE
+            self.idle_since = time.monotonic()
+
+        self.cv.notify_all()
+
+    def run(self, task):
         with self.cv:
             self.cv.wait_for(lambda: self.state == WorkerState.ASSIGNED)
             self.result = AsyncResult()
             self.task = task
             self.task.set_state(TaskState.EXECUTING)
             self.state = WorkerState.EXECUTING
+            self.tasks_run += 1
             self.cv.notify_all()
 
         self.balancer.logger.debug('Actually starting task {0}'.format(task.id))
 
-        filename = None
-        module_name = inspect.getmodule(task.clazz).__name__
-        for dir in self.balancer.dispatcher.plugin_dirs:
-            found = False
-            try:
-                for root, _, files in os.walk(dir):
-                    file = first_or_default(lambda f: match_file(module_name, f), files)
-                    if file:
-                        filename = os.path.join(root, file)
-                        found = True
-                        break
-
-                if found:
-                    break
-            except OSError:
-                continue
+        filename = self.balancer.get_module_file(inspect.getmodule(task.clazz).__name__)
+        if filename:
+            self.balancer.module_usage[filename] += 1
 
         try:
             self.conn.call_sync('taskproxy.run', {
@@ -235,10 +402,7 @@ class TaskExecutor(object):
 
             with self.cv:
                 self.task.ended.set()
-
-                if self.state == WorkerState.EXECUTING:
-                    self.state = WorkerState.IDLE
-                    self.cv.notify_all()
+                self.release()
 
             self.balancer.task_exited(self.task)
             return
@@ -247,9 +411,7 @@ class TaskExecutor(object):
             self.task.result = self.result.value
             self.task.set_state(TaskState.FINISHED, TaskStatus(100, ''))
             self.task.ended.set()
-            if self.state == WorkerState.EXECUTING:
-                self.state = WorkerState.IDLE
-                self.cv.notify_all()
+            self.release()
 
         self.balancer.task_exited(self.task)
 
@@ -267,7 +429,7 @@ class TaskExecutor(object):
             self.terminate()
 
             # Now kill all the subtasks
-            for subtask in filter(lambda t: t.parent is self.task, self.balancer.task_list):
+            for subtask in self.balancer.task_list.subtasks(self.task):
                 self.balancer.logger.warning("Aborting subtask {0} because parent task {1} died".format(
                     subtask.id,
                     self.task.id
@@ -417,7 +579,9 @@ class Task(object):
     def set_state(self, state=None, progress=None, error=None):
         with self.slock:
             if state:
+                old_state = self.state
                 self.state = state
+                self.balancer.task_list.update_state(self, old_state)
 
             event = {'id': self.id, 'name': self.name, 'state': self.state}
 
@@ -427,6 +591,7 @@ class Task(object):
             if self.state == TaskState.EXECUTING:
                 if not self.started_at:
                     self.started_at = datetime.utcnow()
+                    self.balancer.record_start_latency(self)
                 event['started_at'] = self.started_at
 
             if self.state == TaskState.FINISHED:
@@ -439,44 +604,41 @@ class Task(object):
                 self.progress = TaskStatus(0)
 
             self.dispatcher.dispatch_event('task.created' if self.state == TaskState.CREATED else 'task.updated', event)
-            self.dispatcher.datastore_log.update('tasks', self.id, self)
-            self.dispatcher.dispatch_event('task.changed', {
-                'operation': 'create' if state == TaskState.CREATED else 'update',
-                'ids': [self.id]
-            })
+
+            # Terminal states are written out immediately, everything else gets coalesced
+            self.balancer.journal.update(
+                self,
+                create=state == TaskState.CREATED,
+                flush=self.state in (TaskState.FINISHED, TaskState.FAILED, TaskState.ABORTED)
+            )
 
             if progress and self.state not in (TaskState.FINISHED, TaskState.FAILED, TaskState.ABORTED):
                 self.progress = progress
                 self.__emit_progress()
 
             if self.state in (TaskState.FINISHED, TaskState.FAILED, TaskState.ABORTED):
-                try:
-                    # Remove all subtasks
-                    for i in filter(lambda t: t.parent is self, self.balancer.task_list):
-                        self.balancer.task_list.remove(i)
-
-                    # If top-level task, also remove self
-                    if self.parent is None:
-                        self.balancer.task_list.remove(self)
-                except ValueError:
-                    # failed in verify stage
-                    pass
+                self.balancer.unblock(self)
+                self.balancer.archive_task(self)
+
+                # Remove all subtasks
+                for i in self.balancer.task_list.subtasks(self):
+                    self.balancer.task_list.remove(i)
+
+                # If top-level task, also remove self
+                if self.parent is None:
+                    self.balancer.task_list.remove(self)
 
     def set_env(self, key, value):
         self.environment[key] = value
-        self.dispatcher.datastore_log.update('tasks', self.id, self)
+        self.balancer.journal.update(self)
 
     def set_output(self, output):
         self.output = output
-        self.dispatcher.datastore_log.update('tasks', self.id, self)
+        self.balancer.journal.update(self)
 
     def add_warning(self, warning):
         self.warnings.append(warning)
-        self.dispatcher.datastore_log.update('tasks', self.id, self)
-        self.dispatcher.dispatch_event('task.changed', {
-            'operation': 'update',
-            'ids': [self.id]
-        })
+        self.balancer.journal.update(self)
 
     def get_description(self):
         if not self.description:
@@ -494,13 +656,28 @@ class Task(object):
 class Balancer(object):
     def __init__(self, dispatcher):
         self.dispatcher = dispatcher
-        self.task_list = []
+        self.task_list = TaskList()
         self.task_queue = Queue()
+        self.queued_tasks = {}
+        self.task_history = collections.OrderedDict()
+        self.task_history_size = self.get_config('middleware.task_history_size', TASK_HISTORY_SIZE)
+        self.wait_queues = collections.defaultdict(collections.OrderedDict)
+        self.blocked_on = {}
         self.resource_graph = dispatcher.resource_graph
         self.threads = []
         self.executors = []
+        self.executor_index = 0
+        self.executor_idle_timeout = self.get_config('middleware.executor_idle_timeout', EXECUTOR_IDLE_TIMEOUT)
+        self.executor_max_tasks = self.get_config('middleware.executor_max_tasks', EXECUTOR_MAX_TASKS)
+        self.executor_max_rss = self.get_config('middleware.executor_max_rss', EXECUTOR_MAX_RSS)
+        self.min_executors = 0
+        self.module_files = {}
+        self.module_dirs = None
+        self.module_usage = collections.Counter()
+        self.start_latency = collections.deque(maxlen=START_LATENCY_SAMPLES)
         self.logger = logging.getLogger('Balancer')
         self.dispatcher.require_collection('tasks', 'serial', type='log')
+        self.journal = TaskJournal(dispatcher)
         self.create_initial_queues()
         self.schedule_lock = RLock()
         self.distribution_lock = RLock()
@@ -508,15 +685,21 @@ class Balancer(object):
         self.debugged_tasks = None
         self.dispatcher.register_event_type('task.changed')
 
+    def get_config(self, key, default):
+        value = self.dispatcher.configstore.get(key)
+        return default if value is None else value
+
     def clean_stale_tasks(self):
         # Lets try to get `EXECUTING|WAITING|CREATED` state tasks
         # from the previous dispatcher instance and set their
         # states to 'FAILED' since they are no longer running
         # in this instance of the dispatcher
-        for stale_task in self.dispatcher.datastore_log.query(
+        stale_tasks = self.dispatcher.datastore_log.query(
             'tasks',
             ('state', 'in', ['EXECUTING', 'WAITING', 'CREATED'])
-        ):
+        )
+
+        for stale_task in stale_tasks:
             self.logger.info('Stale task ID: {0}, name: {1} being set to FAILED'.format(
                 stale_task['id'],
                 stale_task['name']
@@ -533,20 +716,37 @@ class Balancer(object):
                 }
             })
 
-            self.dispatcher.datastore_log.update('tasks', stale_task['id'], stale_task)
+        try:
+            self.dispatcher.datastore_log.update_many(
+                'tasks',
+                [(t['id'], t) for t in stale_tasks],
+                ordered=False
+            )
+        except BulkWriteException as err:
+            for i in err.errors:
+                self.logger.warning('Cannot update stale task {0}: {1}'.format(i['id'], str(i['error'])))
 
     def create_initial_queues(self):
         self.resource_graph.add_resource(Resource('system'))
 
     def start_executors(self):
-        for i in range(0, max(get_sysctl("hw.ncpu"), 2)):
-            self.logger.info('Starting task executor #{0}...'.format(i))
-            self.executors.append(TaskExecutor(self, i))
+        self.min_executors = max(get_sysctl("hw.ncpu"), 2)
+        for i in range(0, self.min_executors):
+            self.spawn_executor()
+
+    def spawn_executor(self):
+        executor = TaskExecutor(self, self.executor_index)
+        self.logger.info('Starting task executor #{0}...'.format(executor.index))
+        self.executor_index += 1
+        self.executors.append(executor)
+        return executor
 
     def start(self):
         self.clean_stale_tasks()
         self.start_executors()
         self.threads.append(gevent.spawn(self.distribution_thread))
+        self.threads.append(gevent.spawn(self.journal.flush_thread))
+        self.threads.append(gevent.spawn(self.reap_executors))
         self.logger.info("Started")
 
     def schema_to_list(self, schema):
@@ -562,13 +762,7 @@ class Balancer(object):
         if not params_schema:
             return []
 
-        schema = self.schema_to_list(params_schema)
-        val = validator.create_validator(schema, resolver=self.dispatcher.rpc.get_schema_resolver(schema))
-        if strict:
-            val.fail_read_only = True
-        else:
-            val.remove_read_only = True
-
+        val = self.dispatcher.rpc.get_validator(clazz, self.schema_to_list(params_schema), strict)
         return list(val.iter_errors(args))
 
     def submit(self, name, args, sender, env=None):
@@ -599,10 +793,11 @@ class Balancer(object):
         if 'RUN_AS_USER' in task.environment:
             task.user = task.environment['RUN_AS_USER']
 
-        task.id = self.dispatcher.datastore_log.insert("tasks", task)
+        task.id = self.journal.allocate_id()
         task.environment['SENDER_ADDRESS'] = sender.client_address
         task.environment['ID'] = task.id
         task.set_state(TaskState.CREATED)
+        self.queued_tasks[task.id] = task
         self.task_queue.put(task)
         self.logger.info("Task %d submitted (type: %s, class: %s)", task.id, name, task.clazz)
         return task.id
@@ -673,7 +868,7 @@ class Balancer(object):
         task.instance = task.clazz(self.dispatcher)
         task.instance.verify(*task.args)
         task.description = task.instance.describe(*task.args)
-        task.id = self.dispatcher.datastore_log.insert("tasks", task)
+        task.id = self.journal.allocate_id()
         task.parent = parent
         task.environment = {'ID': task.id}
 
@@ -694,7 +889,7 @@ class Balancer(object):
                     task.debugger = self.debugger
 
         task.set_state(TaskState.CREATED)
-        self.task_list.append(task)
+        self.task_list.add(task)
 
         task.start()
         return task
@@ -728,29 +923,81 @@ class Balancer(object):
 
     def task_exited(self, task):
         self.resource_graph.release(*task.resources)
-        self.schedule_tasks(True)
+        self.schedule_tasks(True, self.woken_tasks(task.resources))
+
+    def block(self, task, resource):
+        self.wait_queues[resource][task.id] = task
+        self.blocked_on[task.id] = resource
+
+    def unblock(self, task):
+        resource = self.blocked_on.pop(task.id, None)
+        if resource is None:
+            return
+
+        queue = self.wait_queues.get(resource)
+        if queue is not None:
+            queue.pop(task.id, None)
+            if not queue:
+                del self.wait_queues[resource]
 
-    def schedule_tasks(self, exit=False):
+    def woken_tasks(self, released):
+        """
+        Returns waiting tasks which might be able to run after given resources
+        were released: ones blocked on those resources or their ancestors, plus
+        ones blocked on resources that did not exist at the time.
+        """
+        names = set(released)
+        for name in released:
+            names.update(self.resource_graph.get_resource_ancestors(name))
+
+        for name in self.wait_queues:
+            if self.resource_graph.get_resource(name) is None:
+                names.add(name)
+
+        tasks = [t for n in names for t in self.wait_queues.get(n, {}).values()]
+        return sorted(tasks, key=lambda t: t.id)
+
+    def reschedule_waiting(self):
+        """
+        Retries all waiting tasks. Used when the resource graph changed in a way
+        that could unblock tasks not related to any released resource.
+        """
+        self.schedule_tasks(False, self.task_list.with_state(TaskState.WAITING))
+
+    def try_start(self, task):
+        for name in task.resources:
+            if not self.resource_graph.can_acquire(name):
+                self.block(task, name)
+                return False
+
+        self.resource_graph.acquire(*task.resources)
+        self.threads.append(task.start())
+        return True
+
+    def schedule_tasks(self, exit=False, tasks=None):
         """
         This function is called when:
         1) any new task is submitted to any of the queues
         2) any task exists
+
+        Only the given tasks are considered for starting; the others stay
+        parked on wait queues of resources they are blocked on.
         """
         with self.schedule_lock:
             started = 0
-            executing_tasks = [t for t in self.task_list if t.state == TaskState.EXECUTING]
-            waiting_tasks = [t for t in self.task_list if t.state == TaskState.WAITING]
+            executing = self.task_list.count(TaskState.EXECUTING)
 
-            for task in waiting_tasks:
-                if not self.resource_graph.can_acquire(*task.resources):
+            for task in tasks or []:
+                self.unblock(task)
+                if task.state != TaskState.WAITING:
                     continue
 
-                self.resource_graph.acquire(*task.resources)
-                self.threads.append(task.start())
-                started += 1
+                if self.try_start(task):
+                    started += 1
 
-            if not started and not executing_tasks and (exit or len(waiting_tasks) == 1):
-                for task in waiting_tasks:
+            waiting = self.task_list.count(TaskState.WAITING)
+            if not started and not executing and (exit or waiting == 1):
+                for task in self.task_list.with_state(TaskState.WAITING):
                     # Check whether or not task waits on nonexistent resources. If it does,
                     # abort it 'cause there's no chance anymore that missing resources will appear.
                     missing_resources = [r for r in task.resources if self.resource_graph.get_resource(r) is None]
@@ -766,6 +1013,7 @@ class Balancer(object):
             self.task_queue.peek()
             self.distribution_lock.acquire()
             task = self.task_queue.get()
+            self.queued_tasks.pop(task.id, None)
 
             try:
                 self.logger.debug("Picked up task %d: %s with args %s", task.id, task.name, task.args)
@@ -797,10 +1045,10 @@ class Balancer(object):
 
                 continue
 
+            self.task_list.add(task)
             task.set_state(TaskState.WAITING)
-            self.task_list.append(task)
             self.distribution_lock.release()
-            self.schedule_tasks()
+            self.schedule_tasks(False, [task] + self.woken_tasks([]))
             if task.resources:
                 self.logger.debug("Task %d assigned to resources %s", task.id, ','.join(task.resources))
 
@@ -811,43 +1059,163 @@ class Balancer(object):
                     self.logger.info("Task %d assigned to executor #%d", task.id, i.index)
                     task.executor = i
                     i.state = WorkerState.ASSIGNED
-                    return
-
-        # Out of executors! Need to spawn new one
-        executor = TaskExecutor(self, len(self.executors))
-        self.executors.append(executor)
-        with executor.cv:
-            executor.cv.wait_for(lambda: executor.state == WorkerState.IDLE)
-            executor.state = WorkerState.ASSIGNED
-            task.executor = executor
-            self.logger.info("Task %d assigned to executor #%d", task.id, executor.index)
+                    break
+        else:
+            # Out of executors! Need to spawn new one
+            executor = self.spawn_executor()
+            with executor.cv:
+                executor.cv.wait_for(lambda: executor.state == WorkerState.IDLE)
+                executor.state = WorkerState.ASSIGNED
+                task.executor = executor
+                self.logger.info("Task %d assigned to executor #%d", task.id, executor.index)
+
+        # Keep one warm executor around if the pool has just run dry, so that
+        # next task does not have to wait for a worker process to start up
+        if not any(e.state in (WorkerState.IDLE, WorkerState.STARTING) for e in self.executors):
+            self.spawn_executor()
+
+    def reap_executors(self):
+        """
+        Shrinks the executor pool back towards its initial size by disposing
+        executors which were idle for longer than executor_idle_timeout.
+        """
+        while True:
+            gevent.sleep(max(self.executor_idle_timeout // 4, 1))
+            now = time.monotonic()
+            excess = len(self.executors) - self.min_executors
+            idle = [
+                e for e in reversed(self.executors)
+                if e.state == WorkerState.IDLE and now - e.idle_since > self.executor_idle_timeout
+            ]
+
+            for e in idle[:max(excess, 0)]:
+                with e.cv:
+                    if e.state != WorkerState.IDLE:
+                        continue
+
+                    # Make sure nobody assigns a task to it in the meantime
+                    e.state = WorkerState.STARTING
+
+                self.logger.info('Disposing idle task executor #{0}'.format(e.index))
+                self.executors.remove(e)
+                e.die()
 
     def dispose_executors(self):
         for i in self.executors:
             i.die()
 
+        self.journal.flush()
+
+    def index_module_files(self):
+        """
+        Builds a map of module names to files found in plugin directories,
+        so that task start does not need to walk them every time.
+        """
+        files = {}
+        dirs = {}
+        for dir in self.dispatcher.plugin_dirs:
+            dirs[dir] = get_mtime(dir)
+            for root, subdirs, filenames in os.walk(dir):
+                for d in subdirs:
+                    path = os.path.join(root, d)
+                    dirs[path] = get_mtime(path)
+
+                for f in filenames:
+                    name, ext = os.path.splitext(f)
+                    if ext in ('.py', '.pyc', '.so'):
+                        files.setdefault(name, os.path.join(root, f))
+
+        self.module_files = files
+        self.module_dirs = dirs
+
+    def module_dirs_changed(self):
+        if self.module_dirs is None or set(self.dispatcher.plugin_dirs) - set(self.module_dirs):
+            return True
+
+        return any(get_mtime(d) != mtime for d, mtime in self.module_dirs.items())
+
+    def get_module_file(self, module_name):
+        filename = self.module_files.get(module_name)
+        if not filename and self.module_dirs_changed():
+            # Module might have appeared after last scan. Files are only ever
+            # added by changing a plugin directory, so unknown modules do not
+            # cost a rescan each time.
+            self.index_module_files()
+            filename = self.module_files.get(module_name)
+
+        return filename
+
+    def get_preload_modules(self):
+        return [f for f, _ in self.module_usage.most_common(PRELOAD_MODULES)]
+
+    def record_start_latency(self, task):
+        if task.created_at:
+            self.start_latency.append((task.started_at - task.created_at).total_seconds())
+
+    def get_start_latency(self):
+        samples = sorted(self.start_latency)
+        if not samples:
+            return None
+
+        return {
+            'samples': len(samples),
+            'average': sum(samples) / len(samples),
+            'median': samples[len(samples) // 2],
+            'p95': samples[min(int(len(samples) * 0.95), len(samples) - 1)],
+            'max': samples[-1]
+        }
+
     def get_active_tasks(self):
-        return [x for x in self.task_list if x.state in (
+        return self.task_list.with_state(
             TaskState.CREATED,
             TaskState.WAITING,
             TaskState.EXECUTING
-        )]
+        )
 
     def get_tasks(self, type=None):
         if type is None:
-            return self.task_list
+            return list(self.task_list)
 
-        return [x for x in self.task_list if x.state == type]
+        return self.task_list.with_state(type)
 
     def get_task(self, id):
         self.distribution_lock.acquire()
-        t = first_or_default(lambda x: x.id == id, self.task_list)
+        t = self.task_list.get(id)
         if not t:
-            t = first_or_default(lambda x: x.id == id, self.task_queue.queue)
+            t = self.queued_tasks.get(id)
 
         self.distribution_lock.release()
         return t
 
+    def archive_task(self, task):
+        """
+        Keeps the final state of a task in a bounded history, so that status
+        requests for recently finished tasks do not need to hit datastore_log.
+        """
+        state = task.__getstate__()
+        state['id'] = task.id
+        self.task_history.pop(task.id, None)
+        self.task_history[task.id] = state
+        while len(self.task_history) > self.task_history_size:
+            self.task_history.popitem(last=False)
+
+    def get_task_state(self, id):
+        """
+        Returns state of an active or recently finished task, None if the task
+        is not known in memory anymore.
+        """
+        task = self.get_task(id)
+        if task:
+            state = task.__getstate__()
+            state['id'] = task.id
+            return state
+
+        state = self.task_history.pop(id, None)
+        if state is not None:
+            self.task_history[id] = state
+
+        return state
+
     def get_executor_by_key(self, key):
         return first_or_default(lambda t: t.key == key, self.executors)
 
@@ -859,6 +1227,13 @@ class Balancer(object):
             e.update_env(env)
 
 
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
 def serialize_error(err):
     ret = {
         'type': type(err).__name__,
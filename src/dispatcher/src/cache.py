@@ -25,32 +25,295 @@
 #
 #####################################################################
 
+from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
 from gevent.event import Event
 from gevent.lock import RLock
-from freenas.utils.query import query, set
-from sortedcontainers import SortedDict
+from freenas.utils import query as q
+from sortedcontainers import SortedDict, SortedSet
+
+
+REGEX_SPECIAL = frozenset('.^$*+?{}[]|()')
+
+
+def regex_prefix(pattern):
+    """
+    Returns the literal string every match of an anchored regular expression
+    has to start with, or None if the pattern cannot be narrowed down that way.
+    """
+    if not isinstance(pattern, str) or not pattern.startswith('^'):
+        return None
+
+    # Top-level alternation makes the anchor apply to the first branch only
+    depth = 0
+    escaped = False
+    in_class = False
+    for ch in pattern:
+        if escaped:
+            escaped = False
+        elif ch == '\\':
+            escaped = True
+        elif in_class:
+            in_class = ch != ']'
+        elif ch == '[':
+            in_class = True
+        elif ch == '(':
+            depth += 1
+        elif ch == ')':
+            depth -= 1
+        elif ch == '|' and depth == 0:
+            return None
+
+    prefix = []
+    idx = 1
+    while idx < len(pattern):
+        ch = pattern[idx]
+        if ch == '\\':
+            if idx + 1 >= len(pattern) or pattern[idx + 1].isalnum():
+                break
+
+            ch = pattern[idx + 1]
+            idx += 2
+        elif ch in REGEX_SPECIAL:
+            break
+        else:
+            idx += 1
+
+        if idx < len(pattern) and pattern[idx] in '*?{':
+            # Last literal character is optional or repeated
+            break
+
+        prefix.append(ch)
+
+    return ''.join(prefix)
+
+
+class CacheIndex(object):
+    """
+    Hash index over a single (possibly nested) field of cached objects.
+    """
+    def __init__(self, field):
+        self.field = field
+        self.postings = {}
+        self.values = {}
+        self.unhashable = set()
+
+    def add(self, key, data):
+        self.remove(key)
+        value = q.get(data, self.field)
+        try:
+            self.postings.setdefault(value, set()).add(key)
+            self.values[key] = value
+        except TypeError:
+            self.unhashable.add(key)
+
+    def remove(self, key):
+        self.unhashable.discard(key)
+        try:
+            value = self.values.pop(key)
+        except KeyError:
+            return
+
+        keys = self.postings[value]
+        keys.discard(key)
+        if not keys:
+            del self.postings[value]
+
+    def clear(self):
+        self.postings.clear()
+        self.values.clear()
+        self.unhashable.clear()
+
+    def lookup(self, values):
+        result = set(self.unhashable)
+        for v in values:
+            result.update(self.postings.get(v, ()))
+
+        return result
+
+
+def filter_fields(rules):
+    """
+    Returns set of field paths referenced by a query filter, or None
+    if the filter contains rules that cannot be analyzed.
+    """
+    result = set()
+    for rule in rules:
+        if not isinstance(rule, (list, tuple)):
+            return None
+
+        if len(rule) == 3 and isinstance(rule[0], str):
+            result.add(rule[0])
+            continue
+
+        if len(rule) == 2 and isinstance(rule[1], (list, tuple)):
+            nested = filter_fields(rule[1])
+            if nested is None:
+                return None
+
+            result |= nested
+            continue
+
+        return None
+
+    return result
+
+
+class CacheLoader(object, metaclass=ABCMeta):
+    """
+    Provides full state of cache entries which were populated only partially.
+
+    Partial entries carry just the fields listed in ``fields`` (which have to
+    include the key field and all indexed fields). Up to ``capacity`` fully
+    loaded entries are kept resident; least recently used ones are stripped
+    back to their partial form once that limit is exceeded.
+    """
+    fields = ()
+
+    def __init__(self, capacity=None):
+        self.capacity = capacity
+
+    @abstractmethod
+    def load(self, keys):
+        """
+        Returns a dict of full entries for those of ``keys`` that still exist.
+        """
+
+    def strip(self, data):
+        return {k: data[k] for k in self.fields if k in data}
+
+    def covers(self, paths):
+        for path in paths:
+            if not any(path == f or path.startswith(f + '.') for f in self.fields):
+                return False
+
+        return True
 
 
 class CacheStore(object):
     class CacheItem(object):
-        __slots__ = ('valid', 'data')
+        __slots__ = ('valid', 'data', 'partial')
 
         def __init__(self):
             self.valid = Event()
             self.data = None
+            self.partial = False
 
-    def __init__(self, key=None):
+    def __init__(self, key=None, indexes=None, key_field=None, loader=None):
         self.lock = RLock()
         self.store = SortedDict(key)
+        self.key_field = key_field
+        self.indexes = {f: CacheIndex(f) for f in indexes or []}
+        self.ordered_keys = SortedSet() if key_field and key else None
+        self.loader = loader
+        self.resident = OrderedDict()
 
     def __getitem__(self, item):
         return self.get(item)
 
+    def _index_add(self, key, data):
+        for index in self.indexes.values():
+            index.add(key, data)
+
+        if self.ordered_keys is not None:
+            self.ordered_keys.add(key)
+
+    def _index_remove(self, key):
+        for index in self.indexes.values():
+            index.remove(key)
+
+        if self.ordered_keys is not None:
+            self.ordered_keys.discard(key)
+
+        self.resident.pop(key, None)
+
+    def _touch(self, key):
+        if not self.loader or self.loader.capacity is None:
+            return
+
+        if key in self.resident:
+            self.resident.move_to_end(key)
+            return
+
+        self.resident[key] = None
+        while len(self.resident) > self.loader.capacity:
+            evicted, _ = self.resident.popitem(last=False)
+            item = self.store.get(evicted)
+            if item and not item.partial:
+                item.data = self.loader.strip(item.data)
+                item.partial = True
+
+    def _iter_prefix(self, prefix):
+        if self.ordered_keys is None and self.store.key:
+            # Store is not ordered lexicographically, nothing to bisect on
+            for key in list(self.store.keys()):
+                if key.startswith(prefix):
+                    yield key
+
+            return
+
+        keys = self.ordered_keys if self.ordered_keys is not None else self.store
+        for key in keys.irange(minimum=prefix):
+            if not key.startswith(prefix):
+                break
+
+            yield key
+
+    def _plan_rule(self, rule):
+        if not isinstance(rule, (list, tuple)) or len(rule) != 3:
+            return None
+
+        field, op, value = rule
+        if op == '=':
+            values = [value]
+        elif op == 'in' and isinstance(value, (list, tuple, set, frozenset)):
+            values = value
+        elif op == '~' and field == self.key_field:
+            prefix = regex_prefix(value)
+            if not prefix:
+                return None
+
+            return set(self._iter_prefix(prefix))
+        else:
+            return None
+
+        try:
+            if field == self.key_field:
+                return {v for v in values if v in self.store}
+
+            index = self.indexes.get(field)
+            if index:
+                return index.lookup(values)
+        except TypeError:
+            pass
+
+        return None
+
+    def plan(self, *filter):
+        """
+        Returns set of keys that can possibly match given filter, or None
+        if the filter cannot be resolved using indexes and a full scan is needed.
+        """
+        candidates = None
+        for rule in filter:
+            keys = self._plan_rule(rule)
+            if keys is None:
+                continue
+
+            candidates = keys if candidates is None else candidates & keys
+            if not candidates:
+                break
+
+        return candidates
+
     def put(self, key, data):
         with self.lock:
+            self._index_add(key, data)
+            self._touch(key)
             try:
                 item = self.store[key]
                 item.data = data
+                item.partial = False
                 item.valid.set()
                 return False
             except KeyError:
@@ -60,26 +323,94 @@ class CacheStore(object):
                 self.store[key] = item
                 return True
 
-    def update(self, **kwargs):
+    def _update(self, items, partial):
         with self.lock:
             created = []
             updated = []
-            for k, v in kwargs.items():
+            for k, v in items.items():
                 if not v:
                     continue
 
-                try:
-                    item = self.store[k]
-                    updated.append(k)
-                except KeyError:
+                item = self.store.get(k)
+                if item is None:
                     self.store[k] = item = self.CacheItem()
                     created.append(k)
+                elif partial:
+                    # A stub only replaces an entry whose partial fields have
+                    # changed, fully loaded entries stay loaded otherwise
+                    current = item.data if item.partial else self.loader.strip(item.data)
+                    if current == v:
+                        continue
+
+                    updated.append(k)
+                else:
+                    updated.append(k)
 
                 item.data = v
+                item.partial = partial
                 item.valid.set()
+                self._index_add(k, v)
+                if partial:
+                    self.resident.pop(k, None)
+                else:
+                    self._touch(k)
 
             return created, updated
 
+    def update(self, **kwargs):
+        return self._update(kwargs, False)
+
+    def update_partial(self, **kwargs):
+        """
+        Same as update(), but stores given values as partial entries
+        to be completed by the cache loader on first access. Entries whose
+        partial fields did not change are left alone and not reported.
+        """
+        return self._update(kwargs, True)
+
+    def load(self, keys):
+        """
+        Returns full state of given entries, loading the partial ones.
+        """
+        result = {}
+        missing = []
+        with self.lock:
+            for key in keys:
+                item = self.store.get(key)
+                if not item:
+                    continue
+
+                if item.partial:
+                    missing.append(key)
+                    continue
+
+                result[key] = item.data
+                self._touch(key)
+
+        if not missing:
+            return result
+
+        loaded = self.loader.load(missing)
+        with self.lock:
+            for key, data in loaded.items():
+                item = self.store.get(key)
+                if not item:
+                    continue
+
+                if item.partial:
+                    item.data = data
+                    item.partial = False
+                    self._index_add(key, data)
+                    self._touch(key)
+
+                result[key] = data if item.partial else item.data
+
+        return result
+
+    def partial_keys(self):
+        with self.lock:
+            return [k for k, v in self.store.items() if v.partial]
+
     def update_one(self, key, **kwargs):
         with self.lock:
             item = self.get(key)
@@ -87,7 +418,7 @@ class CacheStore(object):
                 return False
 
             for k, v in kwargs.items():
-                set(item, k, v)
+                q.set(item, k, v)
 
             self.put(key, item)
             return True
@@ -106,6 +437,9 @@ class CacheStore(object):
         item = self.store.get(key)
         if item:
             item.valid.wait(timeout)
+            if item.partial:
+                return self.load([key]).get(key, default)
+
             return item.data
 
         return default
@@ -114,6 +448,7 @@ class CacheStore(object):
         with self.lock:
             try:
                 del self.store[key]
+                self._index_remove(key)
                 return True
             except KeyError:
                 return False
@@ -124,6 +459,7 @@ class CacheStore(object):
             for key in keys:
                 try:
                     del self.store[key]
+                    self._index_remove(key)
                     removed.append(key)
                 except KeyError:
                     pass
@@ -134,6 +470,13 @@ class CacheStore(object):
         with self.lock:
             items = list(self.store.keys())
             self.store.clear()
+            for index in self.indexes.values():
+                index.clear()
+
+            if self.ordered_keys is not None:
+                self.ordered_keys.clear()
+
+            self.resident.clear()
             return items
 
     def exists(self, key):
@@ -152,6 +495,57 @@ class CacheStore(object):
         for o, n in pairs:
             self.rename(o, n)
 
+    def subtree(self, key, separators='/@'):
+        """
+        Returns given key and all keys nested below it, that is keys starting
+        with the given key followed by one of the separators.
+        """
+        with self.lock:
+            keys = [key] if key in self.store else []
+            for sep in separators:
+                keys.extend(self._iter_prefix(key + sep))
+
+            return keys
+
+    def remove_subtree(self, key, separators='/@'):
+        with self.lock:
+            return self.remove_many(self.subtree(key, separators))
+
+    def rename_subtree(self, oldkey, newkey, separators='/@', fields=('id',)):
+        """
+        Moves `oldkey` and every key under it to `newkey`. Fields listed in
+        `fields` holding a path within the subtree get rewritten as well, so
+        that entries and indexes are consistent right away.
+        """
+        def rename(value):
+            if isinstance(value, str) and value.startswith(oldkey):
+                rest = value[len(oldkey):]
+                if not rest or rest[0] in separators:
+                    return newkey + rest
+
+            return value
+
+        with self.lock:
+            pairs = []
+            for key in self.subtree(oldkey, separators):
+                renamed = newkey + key[len(oldkey):]
+                item = self.store.pop(key)
+                self._index_remove(key)
+                if item.data is not None:
+                    for field in fields:
+                        if field in item.data:
+                            item.data[field] = rename(item.data[field])
+
+                    item.data['id'] = renamed
+
+                self.store[renamed] = item
+                self._index_add(renamed, item.data)
+                if not item.partial:
+                    self._touch(renamed)
+                pairs.append([key, renamed])
+
+            return pairs
+
     def is_valid(self, key):
         item = self.store.get(key)
         if item:
@@ -175,6 +569,27 @@ class CacheStore(object):
             if value.valid.is_set():
                 yield value.data
 
+    def validitems(self, keys=None):
+        if keys is None:
+            return [(k, v) for k, v in self.store.items() if v.valid.is_set()]
+
+        if len(keys) * 4 > len(self.store):
+            # Walking the store in order is cheaper than sorting a large key set
+            return [(k, v) for k, v in self.store.items() if k in keys and v.valid.is_set()]
+
+        if self.store.key:
+            keys = sorted(keys, key=self.store.key)
+        else:
+            keys = sorted(keys)
+
+        result = []
+        for key in keys:
+            item = self.store.get(key)
+            if item and item.valid.is_set():
+                result.append((key, item))
+
+        return result
+
     def remove_predicate(self, predicate):
         result = []
         for k, v in self.itervalid():
@@ -185,12 +600,51 @@ class CacheStore(object):
         return result
 
     def query(self, *filter, **params):
-        return query(list(self.validvalues()), *filter, **params)
+        partial = params.pop('partial', False)
+        with self.lock:
+            items = self.validitems(self.plan(*filter))
+
+        if self.loader:
+            if partial:
+                values = [i.data if i.partial else self.loader.strip(i.data) for _, i in items]
+                return q.query(values, *filter, **params)
+
+            if any(i.partial for _, i in items):
+                return self._query_partial(items, filter, params)
+
+        return q.query([i.data for _, i in items], *filter, **params)
+
+    def _query_partial(self, items, filter, params):
+        values = [i.data for _, i in items]
+        fields = filter_fields(filter)
+        if fields is None or not self.loader.covers(fields):
+            loaded = self.load([k for k, _ in items])
+            return q.query([loaded[k] for k, _ in items if k in loaded], *filter, **params)
+
+        sort = params.get('sort') or []
+        sort = [s.lstrip('-') for s in ([sort] if isinstance(sort, str) else sort)]
+        select = params.get('select')
+        if select and not params.get('exclude'):
+            select = [select] if isinstance(select, str) else select
+            if self.loader.covers(sort) and self.loader.covers(select):
+                # Everything can be answered from partial entries
+                return q.query(values, *filter, **params)
+
+        # Filter partial entries first and load only the matching ones
+        keys = [v[self.key_field] for v in q.query(values, *filter)]
+        if not sort and not params.get('offset'):
+            if params.get('single'):
+                keys = keys[:1]
+            elif params.get('limit'):
+                keys = keys[:params['limit']]
+
+        loaded = self.load(keys)
+        return q.query([loaded[k] for k in keys if k in loaded], **params)
 
 
 class EventCacheStore(CacheStore):
-    def __init__(self, dispatcher, name, key=None):
-        super(EventCacheStore, self).__init__(key=key)
+    def __init__(self, dispatcher, name, key=None, indexes=None, key_field=None, loader=None):
+        super(EventCacheStore, self).__init__(key=key, indexes=indexes, key_field=key_field, loader=loader)
         self.dispatcher = dispatcher
         self.ready = False
         self.name = name
@@ -205,8 +659,8 @@ class EventCacheStore(CacheStore):
 
         return ret
 
-    def update(self, **kwargs):
-        created, updated = super(EventCacheStore, self).update(**kwargs)
+    def _update(self, items, partial):
+        created, updated = super(EventCacheStore, self)._update(items, partial)
         if self.ready:
             if created:
                 self.dispatcher.emit_event(f'{self.name}.changed', {
@@ -283,6 +737,16 @@ class EventCacheStore(CacheStore):
 
         return True
 
+    def rename_subtree(self, oldkey, newkey, separators='/@', fields=('id',)):
+        pairs = super(EventCacheStore, self).rename_subtree(oldkey, newkey, separators, fields)
+        if pairs and self.ready:
+            self.dispatcher.emit_event(f'{self.name}.changed', {
+                'operation': 'rename',
+                'ids': pairs
+            })
+
+        return pairs
+
     def rename_many(self, pairs):
         # XXX: not sending bulk rename event because GUI doesn't support them yet
         with self.lock:
@@ -26,7 +26,20 @@
 #####################################################################
 
 
+import re
 import logging
+import datetime
+import collections
+from bsd import fnmatch as cfnmatch
+from gevent.event import Event
+
+
+WILDCARD_CHARS = '*?['
+ROUTER_CACHE_SIZE = 10000
+EVENT_QUEUE_SIZE = 10000
+EVENT_BURST_SIZE = 64
+COALESCED_OPERATIONS = ('create', 'update', 'delete')
+COALESCED_KEYS = {'operation', 'ids', 'timestamp', 'nolog'}
 
 
 class EventSource(object):
@@ -51,3 +64,269 @@ class EventSource(object):
 def sync(fn):
     fn.sync = True
     return fn
+
+
+def match_event(name, pat):
+    if isinstance(pat, str):
+        return cfnmatch(name, pat)
+
+    if isinstance(pat, re._pattern_type):
+        return pat.match(name) is not None
+
+
+def is_pattern(mask):
+    return not isinstance(mask, str) or any(c in mask for c in WILDCARD_CHARS)
+
+
+def mask_prefix(mask):
+    """
+    Returns first dot-separated component of a wildcard mask if it's literal,
+    so that the mask only needs to be tried against events sharing it.
+    """
+    if not isinstance(mask, str):
+        return None
+
+    head = mask.split('.', 1)[0]
+    if '.' not in mask or any(c in head for c in WILDCARD_CHARS):
+        return None
+
+    return head
+
+
+class EventRouter(object):
+    """
+    Index of event subscriptions of connections. Exact masks are kept in
+    a plain map, wildcard masks are bucketed by their literal first name
+    component. Set of connections interested in an event name is resolved
+    once and cached until subscriptions change.
+    """
+    def __init__(self):
+        self.exact = {}
+        self.patterns = {}
+        self.cache = {}
+
+    def subscribe(self, conn, masks):
+        for mask in masks:
+            if is_pattern(mask):
+                self.patterns.setdefault(mask_prefix(mask), {}).setdefault(mask, set()).add(conn)
+            else:
+                self.exact.setdefault(mask, set()).add(conn)
+
+        self.cache.clear()
+
+    def unsubscribe(self, conn, masks):
+        for mask in masks:
+            if is_pattern(mask):
+                prefix = mask_prefix(mask)
+                bucket = self.patterns.get(prefix, {})
+                subscribers = bucket.get(mask)
+                if subscribers is None:
+                    continue
+
+                subscribers.discard(conn)
+                if not subscribers:
+                    del bucket[mask]
+                    if not bucket:
+                        del self.patterns[prefix]
+            else:
+                subscribers = self.exact.get(mask)
+                if subscribers is None:
+                    continue
+
+                subscribers.discard(conn)
+                if not subscribers:
+                    del self.exact[mask]
+
+        self.cache.clear()
+
+    def resolve(self, name):
+        conns = self.cache.get(name)
+        if conns is not None:
+            return conns
+
+        result = set(self.exact.get(name, ()))
+        for prefix in (name.split('.', 1)[0], None):
+            for mask, subscribers in self.patterns.get(prefix, {}).items():
+                if subscribers <= result:
+                    continue
+
+                if match_event(name, mask):
+                    result |= subscribers
+
+        if len(self.cache) >= ROUTER_CACHE_SIZE:
+            self.cache.clear()
+
+        conns = self.cache[name] = tuple(result)
+        return conns
+
+
+class EventQueue(object):
+    """
+    Outbound event queue of a single connection. Consecutive *.changed events
+    of the same name and operation are merged into a single one, events are
+    handed out in batches and the queue is kept under maxsize according to
+    given policy:
+
+    - drop_oldest: oldest events are discarded
+    - resync: whole queue is discarded and replaced by server.events_dropped
+      event, telling the client to refetch whatever it's interested in
+    - disconnect: on_overflow callback is called and the queue is closed
+    """
+    def __init__(self, maxsize=EVENT_QUEUE_SIZE, policy='drop_oldest', burst=EVENT_BURST_SIZE, on_overflow=None):
+        self.maxsize = maxsize
+        self.policy = policy
+        self.burst = burst
+        self.on_overflow = on_overflow
+        self.items = collections.deque()
+        self.ready = Event()
+        self.closed = False
+        self.dropped = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        while True:
+            self.ready.wait()
+            if self.closed:
+                return
+
+            batch = [self.pop() for i in range(min(self.burst, len(self.items)))]
+            if not self.items:
+                self.ready.clear()
+
+            if batch:
+                yield batch
+
+    def put(self, item):
+        if item is StopIteration:
+            self.close()
+            return
+
+        if self.closed:
+            return
+
+        name, args = item
+        if name.endswith('.changed') and self.coalesce(name, args):
+            return
+
+        self.items.append([name, args])
+        if self.maxsize and len(self.items) > self.maxsize:
+            self.overflow()
+
+        self.ready.set()
+
+    def pop(self):
+        return tuple(self.items.popleft())
+
+    def coalesce(self, name, args):
+        # Only the newest queued event can take more ids, merging into an
+        # earlier one would deliver these ahead of events queued after it
+        last = self.items[-1] if self.items else None
+        if not last or last[0] != name or not mergeable(last[1], args) or last[1]['operation'] != args['operation']:
+            return False
+
+        # Args dicts are shared between connections, so never modify them in place
+        ids = last[1]['ids'] + args['ids']
+        try:
+            ids = list(collections.OrderedDict.fromkeys(ids))
+        except TypeError:
+            pass
+
+        merged = dict(last[1], ids=ids)
+        if 'timestamp' in args:
+            merged['timestamp'] = args['timestamp']
+
+        last[1] = merged
+        self.coalesced += 1
+        return True
+
+    def overflow(self):
+        if self.policy == 'disconnect':
+            self.dropped += len(self.items)
+            self.close()
+            if self.on_overflow:
+                self.on_overflow()
+
+            return
+
+        if self.policy == 'resync':
+            self.dropped += len(self.items)
+            self.items.clear()
+            self.items.append(['server.events_dropped', {
+                'dropped': self.dropped,
+                'timestamp': datetime.datetime.utcnow()
+            }])
+            return
+
+        while len(self.items) > self.maxsize:
+            self.pop()
+            self.dropped += 1
+
+    def close(self):
+        self.closed = True
+        self.items.clear()
+        self.ready.set()
+
+
+def mergeable(a, b):
+    for args in (a, b):
+        if args.get('operation') not in COALESCED_OPERATIONS:
+            return False
+
+        if not isinstance(args.get('ids'), list) or not set(args) <= COALESCED_KEYS:
+            return False
+
+    return True
+
+
+class MaskCache(object):
+    """
+    Keeps event types matched by every subscribed event mask together with
+    number of subscriptions of the mask, so that subscribing and
+    unsubscribing only touches the matched event types. The cache is kept
+    up to date as event types come and go.
+    """
+    def __init__(self, event_types):
+        self.event_types = event_types
+        self.refs = {}
+        self.matched = {}
+
+    def subscribe(self, masks):
+        for mask in masks:
+            matched = self.matched.get(mask)
+            if matched is None:
+                matched = {name for name in self.event_types if match_event(name, mask)}
+                self.matched[mask] = matched
+                self.refs[mask] = 0
+
+            self.refs[mask] += 1
+            for name in matched:
+                self.event_types[name].incref()
+
+    def unsubscribe(self, masks):
+        for mask in masks:
+            matched = self.matched.get(mask)
+            if matched is None:
+                continue
+
+            for name in matched:
+                self.event_types[name].decref()
+
+            self.refs[mask] -= 1
+            if self.refs[mask] == 0:
+                del self.refs[mask]
+                del self.matched[mask]
+
+    def type_added(self, name):
+        ev = self.event_types[name]
+        for mask, matched in self.matched.items():
+            if match_event(name, mask):
+                matched.add(name)
+                for i in range(self.refs[mask]):
+                    ev.incref()
+
+    def type_removed(self, name):
+        for matched in self.matched.values():
+            matched.discard(name)
@@ -31,7 +31,6 @@ gevent.monkey.patch_all()
 import copy
 import os
 import sys
-import re
 import fnmatch
 import json
 import datetime
@@ -50,10 +49,11 @@ import struct
 import termios
 import fcntl
 import traceback
+import weakref
 import websocket  # do not remove - we import it only for side effects
 
 import gevent
-from bsd import setproctitle, fnmatch as cfnmatch
+from bsd import setproctitle
 from io import UnsupportedOperation
 from pyee import EventEmitter
 from gevent.threadpool import ThreadPool
@@ -68,6 +68,7 @@ from datastore import get_datastore
 from datastore.migrate import migrate_db, MigrationException
 from datastore.config import ConfigStore
 from freenas.dispatcher.jsonenc import loads, dumps
+from freenas.dispatcher import validator
 from freenas.dispatcher.rpc import RpcContext, RpcException, ServerLockProxy
 from freenas.dispatcher.server import Server, ServerConnection
 from resources import ResourceGraph, ResourceTracker
@@ -75,6 +76,10 @@ from services import ManagementService, DebugService, EventService, TaskService
 from services import LockService, PluginService, ShellService
 from schemas import register_general_purpose_schemas
 from balancer import Balancer
+from transfer import (
+    TransferRegistry, BufferPool, RangeNotSatisfiable, read_chunks, parse_range, file_size, TRANSFER_BUFSIZE
+)
+from event import EventRouter, EventQueue, MaskCache, match_event, EVENT_QUEUE_SIZE
 from auth import PasswordAuthenticator, TokenStore, Token, User, Service
 from freenas.utils import FaultTolerantLogHandler, load_module_from_file, serialize_exception
 from freenas.utils.trace_logger import TraceLogger, TRACE
@@ -83,7 +88,7 @@ from freenas.logd import LogdLogHandler
 
 DEFAULT_CONFIGFILE = '/usr/local/etc/middleware.conf'
 LOGGING_FORMAT = '%(asctime)s %(levelname)s %(filename)s:%(lineno)d %(message)s'
-FEATURES = ['streaming_responses', 'strict_validation']
+FEATURES = ['streaming_responses', 'strict_validation', 'event_burst']
 trace_log_file = None
 
 
@@ -101,14 +106,6 @@ def trace_log(message, *args):
         trace_log_file.flush()
 
 
-def match_event(name, pat):
-    if isinstance(pat, str):
-        return cfnmatch(name, pat)
-
-    if isinstance(pat, re._pattern_type):
-        return pat.match(name) is not None
-
-
 class Plugin(object):
     UNLOADED = 1
     LOADED = 2
@@ -328,6 +325,7 @@ class Dispatcher(object):
         self.started_at = None
         self.plugin_dirs = []
         self.event_types = {}
+        self.event_masks = MaskCache(self.event_types)
         self.event_sources = {}
         self.event_handlers = {}
         self.hooks = {}
@@ -342,6 +340,9 @@ class Dispatcher(object):
         self.logger = logging.getLogger('Main')
         self.token_store = TokenStore(self)
         self.event_delivery_lock = RLock()
+        self.event_router = EventRouter()
+        self.file_transfers = TransferRegistry()
+        self.transfer_buffers = None
         self.rpc = None
         self.balancer = None
         self.datastore = None
@@ -369,7 +370,7 @@ class Dispatcher(object):
         self.logger.info('Initializing')
 
         self.datastore = get_datastore(self.configfile)
-        self.configstore = ConfigStore(self.datastore)
+        self.configstore = ConfigStore(self.datastore, cache=True)
 
         self.logger.info('Connected to datastore')
 
@@ -378,6 +379,7 @@ class Dispatcher(object):
         self.rpc = DispatcherRpcContext(self)
         self.rpc.streaming_enabled = True
         self.rpc.streaming_burst = self.configstore.get('middleware.streaming_burst_size') or 1
+        self.transfer_buffers = BufferPool(self.configstore.get('middleware.file_transfer_bufsize') or TRANSFER_BUFSIZE)
         register_general_purpose_schemas(self)
 
         self.rpc.register_service('management', ManagementService)
@@ -436,6 +438,8 @@ class Dispatcher(object):
             self.logger.debug("Searching for plugins in %s", dir)
             self.__discover_plugin_dir(dir)
 
+        self.balancer.index_module_files()
+
     def load_plugins(self):
         loaded = set()
         toload = self.plugins.copy()
@@ -559,9 +563,8 @@ class Dispatcher(object):
             # If there's no timestamp, assume event fired right now
             args.setdefault('timestamp', datetime.datetime.utcnow())
 
-            for srv in self.ws_servers:
-                for conn in srv.connections:
-                    conn.outgoing_events.put((name, args))
+            for conn in self.event_router.resolve(name):
+                conn.outgoing_events.put((name, args))
 
         for h in self.event_handlers.get(name, []):
             def wrapper(handler, name):
@@ -638,10 +641,12 @@ class Dispatcher(object):
 
     def register_event_type(self, name, source=None, schema=None):
         self.event_types[name] = EventType(name, source, schema)
+        self.event_masks.type_added(name)
         self.dispatch_event('server.event.added', {'name': name})
 
     def unregister_event_type(self, name):
         del self.event_types[name]
+        self.event_masks.type_removed(name)
         self.dispatch_event('server.event.removed', {'name': name})
 
     def register_task_handler(self, name, clazz):
@@ -703,7 +708,11 @@ class Dispatcher(object):
 
     def update_resource(self, name, new_parents, new_children=None):
         self.logger.log(TRACE, 'Resource updated: {0}, new parents: {1}'.format(name, ', '.join(new_parents)))
+        busy = self.resource_graph.is_busy(name)
         self.resource_graph.update_resource(name, new_parents, new_children)
+        if busy:
+            # Moving a busy subtree may unblock tasks waiting on its former ancestors
+            self.balancer.reschedule_waiting()
 
     def rename_resource(self, oldname, newname):
         self.logger.log(TRACE, 'Resource renamed: {0} ->{1}'.format(oldname, newname))
@@ -711,12 +720,18 @@ class Dispatcher(object):
 
     def unregister_resource(self, name):
         self.logger.debug('Resource removed: {0}'.format(name))
+        busy = self.resource_graph.is_busy(name)
         self.resource_graph.remove_resource(name)
+        if busy:
+            self.balancer.reschedule_waiting()
 
     def unregister_resources(self, names):
         if names:
             self.logger.debug('Resources removed: {0}'.format(', '.join(names)))
+            busy = any(self.resource_graph.is_busy(n) for n in names)
             self.resource_graph.remove_resources(names)
+            if busy:
+                self.balancer.reschedule_waiting()
 
     def resource_exists(self, name):
         return self.resource_graph.get_resource(name) is not None
@@ -869,9 +884,70 @@ class Dispatcher(object):
 
 class DispatcherRpcContext(RpcContext):
     def __init__(self, dispatcher):
+        self.definitions = {}
+        self.validators = weakref.WeakKeyDictionary()
         super(DispatcherRpcContext, self).__init__()
         self.dispatcher = dispatcher
 
+    def register_schema_definition(self, name, definition):
+        super(DispatcherRpcContext, self).register_schema_definition(name, definition)
+        self.definitions[name] = definition
+        self.invalidate_validators(name)
+
+    def unregister_schema_definition(self, name):
+        super(DispatcherRpcContext, self).unregister_schema_definition(name)
+        self.definitions.pop(name, None)
+        self.invalidate_validators(name)
+
+    def collect_refs(self, schema):
+        """
+        Returns names of all schema definitions the schema refers to, directly
+        or through other definitions.
+        """
+        refs = set()
+        stack = [schema]
+        while stack:
+            obj = stack.pop()
+            if isinstance(obj, dict):
+                ref = obj.get('$ref')
+                if isinstance(ref, str) and ref not in refs:
+                    refs.add(ref)
+                    if ref in self.definitions:
+                        stack.append(self.definitions[ref])
+
+                stack.extend(obj.values())
+
+            elif isinstance(obj, (list, tuple)):
+                stack.extend(obj)
+
+        return refs
+
+    def get_validator(self, owner, schema, strict=False):
+        """
+        Returns a compiled validator for a schema owned by given task class or
+        RPC method. Validators are cached until any definition they refer to
+        gets registered or unregistered.
+        """
+        cached = self.validators.setdefault(owner, {})
+        entry = cached.get(strict)
+        if entry is None:
+            val = validator.create_validator(schema, resolver=self.get_schema_resolver(schema))
+            if strict:
+                val.fail_read_only = True
+            else:
+                val.remove_read_only = True
+
+            entry = (val, self.collect_refs(schema))
+            cached[strict] = entry
+
+        return entry[0]
+
+    def invalidate_validators(self, name):
+        for owner, cached in list(self.validators.items()):
+            for strict, (val, refs) in list(cached.items()):
+                if name in refs:
+                    del cached[strict]
+
     def call_sync(self, name, *args, **kwargs):
         no_copy = kwargs.pop('no_copy', False)
 
@@ -896,7 +972,11 @@ class DispatcherConnection(ServerConnection):
         self.proxy_address = None
         self.server_pending_calls = {}
         self.client_pending_calls = {}
-        self.outgoing_events = Queue()
+        self.outgoing_events = EventQueue(
+            maxsize=self.dispatcher.configstore.get('middleware.event_queue_size') or EVENT_QUEUE_SIZE,
+            policy=self.dispatcher.configstore.get('middleware.event_queue_policy') or 'drop_oldest',
+            on_overflow=self.__event_overflow
+        )
         self.enabled_features = set()
         self.resource = None
         self.user = None
@@ -918,12 +998,27 @@ class DispatcherConnection(ServerConnection):
         return {
             'resource': self.resource,
             'user': self.user.name if self.user else None,
-            'address': self.client_address
+            'address': self.client_address,
+            'event_queue_depth': len(self.outgoing_events),
+            'events_dropped': self.outgoing_events.dropped,
+            'events_coalesced': self.outgoing_events.coalesced
         }
 
     def __event_worker(self):
-        for name, args in self.outgoing_events:
-            self.emit_event(name, args)
+        # Events are already matched against our masks by the event router
+        for batch in self.outgoing_events:
+            if len(batch) > 1 and 'event_burst' in self.enabled_features:
+                self.send('events', 'event_burst', {
+                    'events': [{'name': name, 'args': args} for name, args in batch]
+                })
+                continue
+
+            for name, args in batch:
+                self.send_event(name, args)
+
+    def __event_overflow(self):
+        self.log(logging.WARNING, 'Client is too slow to receive events, disconnecting')
+        gevent.spawn(self.transport.close)
 
     def log(self, level, msg):
         self.logger.log(level, '[{0}] {1}'.format(self.client_address, msg))
@@ -948,13 +1043,11 @@ class DispatcherConnection(ServerConnection):
             self.close_session()
             self.user = None
 
-        for mask in set(self.event_masks):
-            for name, ev in list(self.dispatcher.event_types.items()):
-                if match_event(name, mask):
-                    ev.decref()
-
-            self.event_masks.remove(mask)
-
+        with self.event_subscription_lock:
+            masks = self.event_masks
+            self.event_masks = set()
+            self.dispatcher.event_masks.unsubscribe(masks)
+            self.dispatcher.event_router.unsubscribe(self, masks)
         self.outgoing_events.put(StopIteration)
         self.dispatcher.dispatch_event('server.client_disconnected', {
             'address': self.client_address,
@@ -994,12 +1087,10 @@ class DispatcherConnection(ServerConnection):
 
         with self.event_subscription_lock:
             # Increment reference count for any newly subscribed event
-            for mask in set.difference(set(event_masks), self.event_masks):
-                for name, ev in list(self.dispatcher.event_types.items()):
-                    if match_event(name, mask):
-                        ev.incref()
-
+            new_masks = set.difference(set(event_masks), self.event_masks)
+            self.dispatcher.event_masks.subscribe(new_masks)
             self.event_masks = set.union(self.event_masks, set(event_masks))
+            self.dispatcher.event_router.subscribe(self, new_masks)
 
     def on_events_unsubscribe(self, id, event_masks):
         if not isinstance(event_masks, list):
@@ -1017,12 +1108,9 @@ class DispatcherConnection(ServerConnection):
         with self.event_subscription_lock:
             # Decrement reference count for any newly unsubscribed event
             intersecting_unsubscribe_events = set.intersection(set(event_masks), self.event_masks)
-            for mask in intersecting_unsubscribe_events:
-                for name, ev in list(self.dispatcher.event_types.items()):
-                    if match_event(name, mask):
-                        ev.decref()
-
+            self.dispatcher.event_masks.unsubscribe(intersecting_unsubscribe_events)
             self.event_masks = set.difference(self.event_masks, intersecting_unsubscribe_events)
+            self.dispatcher.event_router.unsubscribe(self, intersecting_unsubscribe_events)
 
     def on_events_event(self, id, data):
         if self.user is None:
@@ -1377,8 +1465,6 @@ class ShellConnection(WebSocketApplication, EventEmitter):
 
 
 class FileConnection(WebSocketApplication, EventEmitter):
-    BUFSIZE = 1024
-
     def __init__(self, ws, parent):
         super(FileConnection, self).__init__(ws)
         self.dispatcher = parent.context
@@ -1391,15 +1477,14 @@ class FileConnection(WebSocketApplication, EventEmitter):
         self.logger = logging.getLogger('FileConnection')
 
     def worker(self, file, direction, size=None):
+        stats = self.dispatcher.file_transfers.start(self.token.name, direction, size)
         try:
             self.bytes_done = 0
             if self.token.direction == "download":
-                while True:
-                    data = file.read(self.BUFSIZE)
-                    if data == b'':
-                        break
-                    self.bytes_done += len(data)
-                    self.ws.send(data)
+                for chunk in read_chunks(file, self.dispatcher.transfer_buffers):
+                    self.bytes_done += len(chunk)
+                    stats.add(len(chunk))
+                    self.ws.send(chunk, binary=True)
                     # issue keepalive
                     self.dispatcher.token_store.keepalive_token(self.token)
             else:
@@ -1415,10 +1500,12 @@ class FileConnection(WebSocketApplication, EventEmitter):
                             # close everything
                             return
                         self.bytes_done += done
+                        stats.add(done)
                         num_written += done
                     # issue keepalive
                     self.dispatcher.token_store.keepalive_token(self.token)
         finally:
+            self.dispatcher.file_transfers.finish(stats)
             file.close()
             self.done.set()
             self.ws.close()
@@ -1472,7 +1559,6 @@ class DownloadRequestHandler(object):
 
     def __init__(self, dispatcher):
         self.dispatcher = dispatcher
-        self.token = None
 
     def __call__(self, environ, start_response):
         path = environ['PATH_INFO'][1:].split('/')
@@ -1484,38 +1570,90 @@ class DownloadRequestHandler(object):
         if token_str is None:
             start_response('401 Unauthorized', [('Content-Type', 'text/html')])
             return [b"No Token provided so no cookie for you!"]
-        self.token = self.dispatcher.token_store.lookup_token(token_str[0])
-        if self.token is None or self.token.direction != "download":
+        token = self.dispatcher.token_store.lookup_token(token_str[0])
+        if token is None or token.direction != "download":
             start_response('400 Bad Request', [('Content-Type', 'text/html')])
             return [b"You provided an invalid/timedout token!"]
-        return self.start_file_transfer(environ, start_response)
+        return self.start_file_transfer(token, environ, start_response)
 
-    def start_file_transfer(self, environ, start_response):
-        start_response('200 OK', [
+    def start_file_transfer(self, token, environ, start_response):
+        headers = [
             ('Access-Control-Allow-Origin', '*'),
             ('Access-Control-Allow-Credentials', 'true'),
             ('Content-Type', 'application/octet-stream'),
-            ('Content-Disposition', 'attachment; filename="{}"'.format(self.token.name)),
-            ('Transfer-Encoding', 'chunked')
-        ])
+            ('Content-Disposition', 'attachment; filename="{}"'.format(token.name)),
+        ]
+
+        # Regular files can be resumed using Range requests, pipes are streamed as they come
+        size = file_size(token.file)
+        last = True
         try:
+            byterange = parse_range(environ.get('HTTP_RANGE'), size)
+        except RangeNotSatisfiable:
+            start_response('416 Range Not Satisfiable', headers[:2] + [
+                ('Content-Range', 'bytes */{0}'.format(size))
+            ])
+            return [b'']
+
+        if byterange:
+            start, end = byterange
+            length = end - start + 1
+            last = end == size - 1
+            start_response('206 Partial Content', headers + [
+                ('Content-Range', 'bytes {0}-{1}/{2}'.format(start, end, size)),
+                ('Content-Length', str(length))
+            ])
+        elif size is not None:
+            start, length = 0, size
+            start_response('200 OK', headers + [
+                ('Accept-Ranges', 'bytes'),
+                ('Content-Length', str(size))
+            ])
+        else:
+            start, length = None, None
             try:
-                self.token.file.seek(0)
+                token.file.seek(0)
             except UnsupportedOperation:
                 # if file object's underlying stream is a pipe
                 # then seek is illegal
                 pass
 
-            while True:
-                chunk = self.token.file.read(1024)
-                if chunk == b'':
-                    break
+            start_response('200 OK', headers + [('Transfer-Encoding', 'chunked')])
+
+        return self.stream_file(token, start, length, size is not None, last)
+
+    def stream_file(self, token, start, length, resumable, last):
+        # A resumable download keeps its token (and open file) until a
+        # response reaching the end of the file completes, so that an
+        # interrupted transfer can be continued with a Range request.
+        # Otherwise the token goes away once it expires. Regular files are
+        # read at explicit offsets, so concurrent Range requests on the same
+        # token do not move each other's position, and the file is closed
+        # only once the last of them is done.
+        stats = self.dispatcher.file_transfers.start(token.name, 'download', length)
+        completed = False
+        token.streams += 1
+        try:
+            for chunk in read_chunks(token.file, self.dispatcher.transfer_buffers, length, start):
+                stats.add(len(chunk))
                 # issue keepalive
-                self.dispatcher.token_store.keepalive_token(self.token)
-                yield chunk
+                self.dispatcher.token_store.keepalive_token(token)
+                # The pooled buffer is refilled by the next read, while the
+                # server may still hold on to the chunk (gevent's pywsgi joins
+                # small writes after asking for the next one), so hand over
+                # a copy. The pool still saves an allocation per read.
+                yield bytes(chunk)
+
+            completed = True
         finally:
-            self.dispatcher.token_store.delete_token(self.token)
-            self.token.file.close()
+            self.dispatcher.file_transfers.finish(stats)
+            token.streams -= 1
+            if not resumable or (completed and last):
+                token.completed = True
+
+            if token.completed and token.streams == 0:
+                self.dispatcher.token_store.delete_token(token)
+                token.file.close()
 
 
 def run(d, args):
@@ -36,6 +36,7 @@ class Resource(object):
     def __init__(self, name):
         self.name = name
         self.busy = False
+        self.busy_descendants = 0
 
     def __str__(self):
         return "<Resource '{0}'>".format(self.name)
@@ -55,6 +56,7 @@ class ResourceGraph(object):
         self.root = Resource('root')
         self.resources = nx.DiGraph()
         self.resources.add_node(self.root)
+        self.index = {self.root.name: self.root}
 
     def lock(self):
         self.mutex.acquire()
@@ -66,6 +68,18 @@ class ResourceGraph(object):
     def nodes(self):
         return self.resources.nodes()
 
+    def busy_subtree(self, resource):
+        if not resource.busy and not resource.busy_descendants:
+            return []
+
+        return [i for i in [resource] + list(nx.descendants(self.resources, resource)) if i.busy]
+
+    def account_busy(self, resources, delta):
+        # Propagates busy state of given resources to busy_descendants counters of their ancestors
+        for res in resources:
+            for i in nx.ancestors(self.resources, res):
+                i.busy_descendants += delta
+
     def add_resource(self, resource, parents=None, children=None):
         with self.mutex:
             if not resource:
@@ -75,6 +89,7 @@ class ResourceGraph(object):
                 raise ResourceError('Resource {0} already exists'.format(resource.name))
     
             self.resources.add_node(resource)
+            self.index[resource.name] = resource
             if not parents:
                 parents = ['root']
     
@@ -90,6 +105,15 @@ class ResourceGraph(object):
                 if not node:
                     raise ResourceError('Invalid child resource {0}'.format(p))
 
+    def remove_node(self, resource):
+        self.account_busy(self.busy_subtree(resource), -1)
+        for i in nx.descendants(self.resources, resource):
+            self.resources.remove_node(i)
+            self.index.pop(i.name, None)
+
+        self.resources.remove_node(resource)
+        self.index.pop(resource.name, None)
+
     def remove_resource(self, name):
         with self.mutex:
             resource = self.get_resource(name)
@@ -97,10 +121,7 @@ class ResourceGraph(object):
             if not resource:
                 return
     
-            for i in nx.descendants(self.resources, resource):
-                self.resources.remove_node(i)
-    
-            self.resources.remove_node(resource)
+            self.remove_node(resource)
 
     def remove_resources(self, names):
         with self.mutex:
@@ -110,10 +131,7 @@ class ResourceGraph(object):
                 if not resource:
                     return
     
-                for i in nx.descendants(self.resources, resource):
-                    self.resources.remove_node(i)
-    
-                self.resources.remove_node(resource)
+                self.remove_node(resource)
 
     def rename_resource(self, oldname, newname):
         with self.mutex:
@@ -122,7 +140,9 @@ class ResourceGraph(object):
             if not resource:
                 return
 
+            del self.index[oldname]
             resource.name = newname
+            self.index[newname] = resource
 
     def update_resource(self, name, new_parents, new_children=None):
         with self.mutex:
@@ -130,8 +150,21 @@ class ResourceGraph(object):
     
             if not resource:
                 return
-    
-            for i in self.resources.predecessors(resource):
+
+            # Only the resource itself and subtrees hanging off it can get new ancestors
+            busy = set(self.busy_subtree(resource))
+            children = []
+            for p in new_children or []:
+                node = self.get_resource(p)
+                if not node:
+                    raise ResourceError('Invalid child resource {0}'.format(p))
+
+                children.append(node)
+                busy.update(self.busy_subtree(node))
+
+            self.account_busy(busy, -1)
+
+            for i in list(self.resources.predecessors(resource)):
                 self.resources.remove_edge(i, resource)
     
             for p in new_parents:
@@ -141,22 +174,31 @@ class ResourceGraph(object):
     
                 self.resources.add_edge(node, resource)
 
-            for p in new_children or []:
-                node = self.get_resource(p)
-                if not node:
-                    raise ResourceError('Invalid child resource {0}'.format(p))
-
+            for node in children:
                 self.resources.add_edge(resource, node)
 
+            self.account_busy(busy, 1)
+
     def get_resource(self, name):
-        f = [i for i in self.resources.nodes() if i.name == name]
-        return f[0] if len(f) > 0 else None
+        return self.index.get(name)
 
     def get_resource_dependencies(self, name):
         res = self.get_resource(name)
         for i, _ in self.resources.in_edges([res]):
             yield i.name
 
+    def get_resource_ancestors(self, name):
+        res = self.get_resource(name)
+        if not res:
+            return
+
+        for i in nx.ancestors(self.resources, res):
+            yield i.name
+
+    def is_busy(self, name):
+        res = self.get_resource(name)
+        return res is not None and bool(res.busy or res.busy_descendants)
+
     def acquire(self, *names):
         if not names:
             return
@@ -168,12 +210,15 @@ class ResourceGraph(object):
                 res = self.get_resource(name)
                 if not res:
                     raise ResourceError('Resource {0} not found'.format(name))
-    
-                for i in nx.descendants(self.resources, res):
-                    if i.name not in names and i.busy:
-                        raise ResourceError('Cannot acquire, some of dependent resources are busy')
-    
-                res.busy = True
+
+                if res.busy_descendants:
+                    for i in nx.descendants(self.resources, res):
+                        if i.name not in names and i.busy:
+                            raise ResourceError('Cannot acquire, some of dependent resources are busy')
+
+                if not res.busy:
+                    res.busy = True
+                    self.account_busy([res], 1)
 
     def can_acquire(self, *names):
         if not names:
@@ -187,13 +232,9 @@ class ResourceGraph(object):
                 if not res:
                     return False
     
-                if res.busy:
+                if res.busy or res.busy_descendants:
                     return False
     
-                for i in nx.descendants(self.resources, res):
-                    if i.busy:
-                        return False
-    
             return True
 
     def release(self, *names):
@@ -205,8 +246,9 @@ class ResourceGraph(object):
     
             for name in names:
                 res = self.get_resource(name)
-                if res:
+                if res and res.busy:
                     res.busy = False
+                    self.account_busy([res], -1)
 
     def draw(self, path):
         return nx.write_dot(nx.relabel_nodes(self.resources, lambda n: f'"{n.name}"'), path)
@@ -70,6 +70,9 @@ class ManagementService(RpcService):
     def get_plugin_names(self):
         return list(self.dispatcher.plugins.keys())
 
+    def get_file_transfers(self):
+        return self.dispatcher.file_transfers.__getstate__()
+
     def get_connected_clients(self):
         return [
             inner
@@ -399,9 +402,11 @@ class TaskService(RpcService):
         return tid, url_list
 
     def status(self, id):
-        t = self.__dispatcher.datastore_log.get_by_id('tasks', id)
-        task = self.__balancer.get_task(id)
+        t = self.__balancer.get_task_state(id)
+        if not t:
+            return self.__dispatcher.datastore_log.get_by_id('tasks', id)
 
+        task = self.__balancer.get_task(id)
         if task and task.progress:
             t['progress'] = task.progress.__getstate__()
 
@@ -413,6 +418,9 @@ class TaskService(RpcService):
             task.ended.wait()
             return
 
+        if id in self.__balancer.task_history:
+            return
+
         raise RpcException(errno.ENOENT, 'No such task')
 
     def abort(self, id):
@@ -437,11 +445,15 @@ class TaskService(RpcService):
             result.append({
                 'index': exe.index,
                 'state': exe.state,
-                'pid': exe.pid
+                'pid': exe.pid,
+                'tasks_run': exe.tasks_run
             })
 
         return result
 
+    def get_start_latency(self):
+        return self.__balancer.get_start_latency()
+
     @private
     def register_task_hook(self, hook, task, condition=None):
         self.__dispatcher.register_task_hook(hook, task, condition)
@@ -516,6 +528,17 @@ class TaskService(RpcService):
 
         executor.put_warning(warning)
 
+    @private
+    @pass_sender
+    def config_changed(self, key, sender):
+        executor = self.__balancer.get_executor_by_sender(sender)
+        if not executor:
+            raise RpcException(errno.EPERM, 'Not authorized')
+
+        # Config keys set by a task have to be visible to the dispatcher
+        # right away, not only after the next cache version check
+        self.__dispatcher.configstore.invalidate(key)
+
     @private
     @pass_sender
     def register_resource(self, resource, parents, sender):
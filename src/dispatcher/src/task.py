@@ -30,10 +30,14 @@ import errno
 import logging
 from freenas.dispatcher.rpc import RpcService, RpcException, RpcWarning, convert_schema
 from freenas.utils import exclude
+from freenas.utils import query as q
 from threading import RLock
 import collections
 
 
+PUSHDOWN_PARAMS = ('offset', 'limit', 'single', 'count', 'reverse', 'select', 'exclude')
+
+
 class TaskState(object):
     CREATED = 'CREATED'
     WAITING = 'WAITING'
@@ -299,6 +303,84 @@ class Provider(RpcService):
     def configstore(self):
         return self.dispatcher.configstore
 
+    def datastore_query(self, collection, filter=None, params=None, callback=None, computed=None, depends=None,
+                        datastore=None):
+        """
+        Queries a datastore collection, pushing down to the database whatever
+        does not depend on `computed` fields (the ones `callback` adds) and
+        evaluating the rest in Python. `depends` lists stored fields
+        `callback` reads, so that select/exclude can be turned into a native
+        projection.
+        """
+        datastore = datastore or self.datastore
+        pushed_filter, pushed_params, filter, params = split_query(
+            filter, params, computed,
+            getattr(datastore, 'supports_predicate', None)
+        )
+        logging.getLogger('Query').debug('Query on {0}: pushed down {1}, evaluated in Python {2}'.format(
+            collection,
+            (['filter'] if pushed_filter else []) + list(pushed_params),
+            (['filter'] if filter else []) + list(params)
+        ))
+
+        if callback:
+            pushed_params['callback'] = callback
+            if depends is not None:
+                pushed_params['depends'] = depends
+
+        result = datastore.query_stream(collection, *pushed_filter, **pushed_params)
+        if not filter and not params:
+            return result
+
+        return q.query(result, *filter, stream=True, **params)
+
+
+def split_query(filter=None, params=None, computed=None, supported=None):
+    """
+    Splits query filter and options into the part a datastore driver can
+    evaluate and the part referring to `computed` fields, which has to be
+    evaluated after the driver callback ran. Only rules `supported` accepts
+    (called with the rule items) are pushed down; without it the whole
+    filter stays in Python. Returns a tuple of (pushed filter, pushed
+    options, remaining filter, remaining options).
+    """
+    computed = set(computed or [])
+    params = dict(params or {})
+    pushed_params = {}
+
+    def is_computed(field):
+        return field.lstrip('-').split('.')[0] in computed
+
+    def pushable(rule):
+        if not supported or not supported(*rule):
+            return False
+
+        if len(rule) == 2:
+            op, value = rule
+            return op in ('or', 'and', 'nor') and all(pushable(i) for i in value)
+
+        return not is_computed(rule[0])
+
+    pushed_filter = [i for i in (filter or []) if pushable(i)]
+    filter = [i for i in (filter or []) if not pushable(i)]
+
+    sort = params.get('sort')
+    sort = [sort] if isinstance(sort, str) else sort or []
+    if any(is_computed(i) for i in sort):
+        return pushed_filter, pushed_params, filter, params
+
+    if sort:
+        pushed_params['sort'] = params.pop('sort')
+
+    # Paging, counting and shaping results only make sense once every
+    # filter rule has been applied
+    if not filter:
+        for i in PUSHDOWN_PARAMS:
+            if i in params:
+                pushed_params[i] = params.pop(i)
+
+    return pushed_filter, pushed_params, filter, params
+
 
 def metadata(**d):
     def wrapped(fn):
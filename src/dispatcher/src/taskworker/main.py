@@ -165,6 +165,22 @@ class Context(object):
 
         self.conn.call_sync('task.put_status', obj)
 
+    def load_module(self, filename):
+        module = self.module_cache.get(filename)
+        if not module:
+            name, _ = os.path.splitext(os.path.basename(filename))
+            module = load_module_from_file(name, filename)
+            self.module_cache[filename] = module
+
+        return module
+
+    def preload_modules(self, filenames):
+        for i in filenames:
+            try:
+                self.load_module(i)
+            except BaseException as err:
+                print("Cannot preload module {0}: {1}".format(i, str(err)), file=sys.stderr)
+
     def task_progress_handler(self, args):
         if self.instance:
             self.instance.task_progress_handler(args)
@@ -213,7 +229,10 @@ class Context(object):
 
         self.datastore = get_datastore()
         self.datastore_log = get_datastore(log=True)
-        self.configstore = ConfigStore(self.datastore)
+        self.configstore = ConfigStore(
+            self.datastore,
+            on_change=lambda key: self.conn.call_sync('task.config_changed', key)
+        )
         self.conn = Client()
         self.conn.connect('unix:')
         self.conn.login_service('task.{0}'.format(os.getpid()))
@@ -221,7 +240,7 @@ class Context(object):
         self.conn.call_sync('management.enable_features', ['streaming_responses'])
         self.conn.rpc.register_service_instance('taskproxy', self.service)
         self.conn.register_event_handler('task.progress', self.task_progress_handler)
-        self.conn.call_sync('task.checkin', key)
+        self.preload_modules(self.conn.call_sync('task.checkin', key) or [])
         setproctitle('task executor (idle)')
 
         while True:
@@ -237,12 +256,7 @@ class Context(object):
                     host, port = task['debugger']
                     pydevd.settrace(host, port=port, stdoutToServer=True, stderrToServer=True)
 
-                name, _ = os.path.splitext(os.path.basename(task['filename']))
-                module = self.module_cache.get(task['filename'])
-                if not module:
-                    module = load_module_from_file(name, task['filename'])
-                    self.module_cache[task['filename']] = module
-
+                module = self.load_module(task['filename'])
                 setproctitle('task executor (tid {0})'.format(task['id']))
                 fds = list(self.collect_fds(task['args']))
 
@@ -0,0 +1,209 @@
+#+
+# Copyright 2017 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+import os
+import re
+import stat
+import time
+import collections
+
+
+TRANSFER_BUFSIZE = 1024 * 1024
+TRANSFER_HISTORY_SIZE = 64
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class RangeNotSatisfiable(ValueError):
+    pass
+
+
+class BufferPool(object):
+    """
+    Pool of reusable transfer buffers, so that every chunk of a transfer does
+    not allocate a new one.
+    """
+    def __init__(self, bufsize=TRANSFER_BUFSIZE, maxbuffers=16):
+        self.bufsize = bufsize
+        self.maxbuffers = maxbuffers
+        self.buffers = []
+
+    def acquire(self):
+        if self.buffers:
+            return self.buffers.pop()
+
+        return bytearray(self.bufsize)
+
+    def release(self, buf):
+        if len(buf) == self.bufsize and len(self.buffers) < self.maxbuffers:
+            self.buffers.append(buf)
+
+
+class TransferStats(object):
+    def __init__(self, name, direction, total=None):
+        self.name = name
+        self.direction = direction
+        self.total = total
+        self.done = 0
+        self.started_at = time.time()
+        self.finished_at = None
+
+    def add(self, count):
+        self.done += count
+
+    @property
+    def throughput(self):
+        elapsed = (self.finished_at or time.time()) - self.started_at
+        return self.done / elapsed if elapsed > 0 else 0
+
+    def __getstate__(self):
+        return {
+            'name': self.name,
+            'direction': self.direction,
+            'total': self.total,
+            'done': self.done,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'throughput': self.throughput
+        }
+
+
+class TransferRegistry(object):
+    def __init__(self, history=TRANSFER_HISTORY_SIZE):
+        self.active = set()
+        self.finished = collections.deque(maxlen=history)
+
+    def start(self, name, direction, total=None):
+        stats = TransferStats(name, direction, total)
+        self.active.add(stats)
+        return stats
+
+    def finish(self, stats):
+        stats.finished_at = time.time()
+        self.active.discard(stats)
+        self.finished.append(stats)
+
+    def __getstate__(self):
+        return {
+            'active': [s.__getstate__() for s in self.active],
+            'finished': [s.__getstate__() for s in self.finished]
+        }
+
+
+def file_size(file):
+    """
+    Returns size of a regular file behind given file object, None if it's a
+    pipe, socket or the size can't be determined.
+    """
+    try:
+        st = os.fstat(file.fileno())
+    except (AttributeError, OSError, ValueError):
+        return None
+
+    return st.st_size if stat.S_ISREG(st.st_mode) else None
+
+
+def parse_range(header, size):
+    """
+    Parses single-range HTTP Range header. Returns (start, end) with end
+    inclusive, or None if the header is missing or malformed. Raises
+    RangeNotSatisfiable if the range lies past the end of the file.
+    """
+    match = RANGE_RE.match(header or '')
+    if not match or size is None:
+        return None
+
+    start, end = match.groups()
+    if not start:
+        if not end:
+            return None
+
+        # Suffix range - last N bytes
+        if int(end) == 0 or size == 0:
+            raise RangeNotSatisfiable()
+
+        start = max(size - int(end), 0)
+        end = size - 1
+    else:
+        start = int(start)
+        if end and int(end) < start:
+            return None
+
+        if start >= size:
+            raise RangeNotSatisfiable()
+
+        end = min(int(end), size - 1) if end else size - 1
+
+    return start, end
+
+
+def read_chunks(file, pool, length=None, offset=None):
+    """
+    Reads given file in chunks of the pool buffer size, reading into reused
+    buffers where the file object supports it. Yields memoryviews which are
+    only valid until the next chunk is requested.
+
+    With `offset` given, reads at explicit offsets instead of from the file
+    position, so that several transfers can share one open file.
+    """
+    buf = pool.acquire()
+    view = memoryview(buf)
+    readinto = getattr(file, 'readinto', None)
+    preadv = getattr(os, 'preadv', None)
+
+    try:
+        while length is None or length > 0:
+            want = len(buf) if length is None else min(len(buf), length)
+            if offset is not None:
+                # fileno() is looked up for every chunk, so that a file closed
+                # in the meantime fails instead of reading a reused descriptor
+                if preadv:
+                    count = preadv(file.fileno(), [view[:want]], offset)
+                    chunk = view[:count] if count else None
+                else:
+                    data = os.pread(file.fileno(), want, offset)
+                    count = len(data)
+                    chunk = memoryview(data) if data else None
+
+                offset += count
+            elif readinto:
+                count = readinto(view[:want])
+                chunk = view[:count] if count else None
+            else:
+                data = file.read(want)
+                count = len(data)
+                chunk = memoryview(data) if data else None
+
+            if not chunk:
+                break
+
+            if length is not None:
+                length -= count
+
+            yield chunk
+    finally:
+        view.release()
+        pool.release(buf)
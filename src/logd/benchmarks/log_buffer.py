@@ -0,0 +1,133 @@
+#
+# Copyright 2017 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+"""
+Measures ingest rate and memory use of logd's LogBuffer against the plain
+deque it replaced, feeding messages at a fixed rate (50k/s by default) as
+if the log datastore were unavailable for the whole run.
+
+Usage: python3 benchmarks/log_buffer.py [--rate 50000] [--seconds 20] [--buffer-size 33554432]
+"""
+
+import os
+import sys
+import time
+import uuid
+import shutil
+import tempfile
+import argparse
+import tracemalloc
+import collections
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from buffer import LogBuffer
+
+
+def entry(seqno):
+    return {
+        'id': str(uuid.uuid4()),
+        'seqno': seqno,
+        'boot_id': 'benchmark',
+        'priority': 'INFO',
+        'facility': 'DAEMON',
+        'identifier': 'smbd',
+        'pid': 1234,
+        'source': 'syslog',
+        'timestamp': datetime.now(),
+        'message': 'connect to service share{0} initially as user nobody (uid=65534, gid=65534)'.format(seqno % 100)
+    }
+
+
+def feed(store, rate, seconds):
+    # Paces appends in 10ms ticks, reporting the rate actually reached and
+    # the worst time spent in a single tick
+    total = rate * seconds
+    tick = rate // 100
+    seqno = 0
+    worst = 0
+    start = time.perf_counter()
+
+    while seqno < total:
+        tick_start = time.perf_counter()
+        for i in range(tick):
+            store.append(entry(seqno))
+            seqno += 1
+
+        elapsed = time.perf_counter() - tick_start
+        worst = max(worst, elapsed)
+        deadline = start + seqno / rate
+        delay = deadline - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+    return total / (time.perf_counter() - start), worst * 1000
+
+
+def run(name, factory, args):
+    # Rate is measured untraced, tracemalloc slows allocations down a lot
+    rate, worst = feed(factory(), args.rate, args.seconds)
+
+    tracemalloc.start()
+    store = factory()
+    for i in range(args.rate * args.seconds):
+        store.append(entry(i))
+
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('{0:<12} {1:>12.0f} {2:>14.2f} {3:>12.1f} {4:>12.1f}'.format(
+        name, rate, worst, current / 1024 / 1024, peak / 1024 / 1024
+    ))
+    return store
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rate', type=int, default=50000)
+    parser.add_argument('--seconds', type=int, default=20)
+    parser.add_argument('--buffer-size', type=int, default=32 * 1024 * 1024)
+    args = parser.parse_args()
+
+    spooldir = tempfile.mkdtemp()
+    print('{0} messages at {1}/s'.format(args.rate * args.seconds, args.rate))
+    print('{0:<12} {1:>12} {2:>14} {3:>12} {4:>12}'.format('buffer', 'msgs/s', 'worst tick ms', 'MiB held', 'MiB peak'))
+
+    try:
+        run('deque', collections.deque, args)
+        store = run('LogBuffer', lambda: LogBuffer(
+            max_size=args.buffer_size,
+            max_spill_size=1 << 40,
+            spill_prefix=os.path.join(spooldir, 'logd.spill.{0}'.format(uuid.uuid4()))
+        ), args)
+        print('{0} entries spilled to disk, {1:.1f} MiB'.format(store.spilled, store.spill_size / 1024 / 1024))
+    finally:
+        shutil.rmtree(spooldir)
+
+
+if __name__ == '__main__':
+    main()
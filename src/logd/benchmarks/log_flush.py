@@ -0,0 +1,150 @@
+#
+# Copyright 2017 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+"""
+Measures ingestion latency of logd while a large backlog (1M entries by
+default) is being flushed to a simulated log datastore, comparing a flush
+done under the buffer lock with the LogFlusher pipeline.
+
+Usage: python3 benchmarks/log_flush.py [--entries 1000000] [--rate 20000] [--batch-latency 5]
+"""
+
+import os
+import sys
+import time
+import uuid
+import shutil
+import tempfile
+import argparse
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'datastore'))
+
+from buffer import LogBuffer
+from flush import LogFlusher
+from log_buffer import entry
+
+
+class SimulatedDatastore(object):
+    # Stands in for the log datastore, every insert_many() costs a fixed
+    # round trip without holding the GIL
+    def __init__(self, latency):
+        self.latency = latency
+        self.stored = 0
+
+    def insert_many(self, collection, objs, ordered=True):
+        time.sleep(self.latency)
+        self.stored += len(objs)
+        return [i['id'] for i in objs]
+
+
+def locked_flush(store, lock, ds):
+    # Everything is written while ingestion is locked out
+    with lock:
+        segments = store.take()
+        for segment in segments:
+            ds.insert_many('syslog', segment.load())
+
+        store.release(list(segments))
+
+
+def pipelined_flush(store, lock, ds):
+    LogFlusher(store, lock).flush(ds)
+
+
+def ingest(store, lock, rate, stop, latencies, seqno):
+    while not stop.is_set():
+        item = entry(seqno)
+        start = time.perf_counter()
+        with lock:
+            store.append(item)
+
+        latencies.append(time.perf_counter() - start)
+        seqno += 1
+        delay = 1 / rate - (time.perf_counter() - start)
+        if delay > 0:
+            time.sleep(delay)
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100))] * 1000
+
+
+def run(name, flush, args, spooldir):
+    store = LogBuffer(
+        max_size=args.buffer_size,
+        max_spill_size=1 << 40,
+        spill_prefix=os.path.join(spooldir, 'logd.spill.{0}'.format(uuid.uuid4()))
+    )
+    lock = threading.Lock()
+    ds = SimulatedDatastore(args.batch_latency / 1000)
+
+    for i in range(args.entries):
+        store.append(entry(i))
+
+    stop = threading.Event()
+    latencies = []
+    thread = threading.Thread(target=ingest, args=(store, lock, args.rate, stop, latencies, args.entries))
+    thread.start()
+
+    start = time.perf_counter()
+    flush(store, lock, ds)
+    elapsed = time.perf_counter() - start
+    stop.set()
+    thread.join()
+
+    latencies.sort()
+    print('{0:<10} {1:>10.1f} {2:>12.0f} {3:>10} {4:>10.3f} {5:>10.3f} {6:>10.1f}'.format(
+        name, elapsed, ds.stored / elapsed, len(latencies),
+        percentile(latencies, 50), percentile(latencies, 99), latencies[-1] * 1000
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--entries', type=int, default=1000000)
+    parser.add_argument('--rate', type=int, default=20000)
+    parser.add_argument('--batch-latency', type=float, default=5, help='milliseconds per insert_many()')
+    parser.add_argument('--buffer-size', type=int, default=32 * 1024 * 1024)
+    args = parser.parse_args()
+
+    spooldir = tempfile.mkdtemp()
+    print('Flushing {0} entries while ingesting {1} msgs/s'.format(args.entries, args.rate))
+    print('{0:<10} {1:>10} {2:>12} {3:>10} {4:>10} {5:>10} {6:>10}'.format(
+        'flush', 'seconds', 'stored/s', 'ingested', 'p50 ms', 'p99 ms', 'max ms'
+    ))
+
+    try:
+        run('locked', locked_flush, args, spooldir)
+        run('pipelined', pipelined_flush, args, spooldir)
+    finally:
+        shutil.rmtree(spooldir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+#
+# Copyright 2017 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+"""
+Measures latency of typical logd.logging.query requests answered from
+logd's live buffer holding 5M lines (most of them spilled to disk), using
+the segment indexes and with a full scan of the buffer.
+
+Usage: python3 benchmarks/log_query.py [--lines 5000000] [--repeat 5] [--no-scan]
+"""
+
+import os
+import sys
+import time
+import uuid
+import shutil
+import random
+import tempfile
+import argparse
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from freenas.utils import query as q
+from buffer import LogBuffer
+from index import BufferQuery
+
+
+SERVICES = ['org.freenas.smbd'] * 12 + ['org.freenas.nginx'] * 6 + ['org.freenas.dispatcher', None]
+PRIORITIES = ['INFO'] * 16 + ['DEBUG'] * 3 + ['ERR']
+
+
+def fill(store, lines, start):
+    random.seed(0)
+    for seqno in range(0, lines):
+        store.append({
+            'id': str(uuid.uuid4()),
+            'seqno': seqno,
+            'boot_id': 'benchmark',
+            'priority': random.choice(PRIORITIES),
+            'facility': 'DAEMON',
+            'identifier': 'smbd',
+            'service': random.choice(SERVICES),
+            'pid': 1234,
+            'source': 'syslog',
+            'timestamp': start + timedelta(milliseconds=seqno),
+            'message': 'connect to service share{0} initially as user nobody'.format(seqno % 100)
+        })
+
+
+def queries(lines, start):
+    middle = start + timedelta(milliseconds=lines // 2)
+    return [
+        ('last 100 lines', [], {'sort': '-timestamp', 'reverse': True, 'limit': 100}),
+        ('last 100 of a service', [('service', '=', 'org.freenas.dispatcher')], {'sort': '-timestamp', 'reverse': True, 'limit': 100}),
+        ('last 50 errors', [('priority', '=', 'ERR')], {'sort': '-timestamp', 'reverse': True, 'limit': 50}),
+        ('1 second range', [('timestamp', '>=', middle), ('timestamp', '<', middle + timedelta(seconds=1))], {}),
+        ('1000 seqnos', [('seqno', '>=', lines // 3), ('seqno', '<', lines // 3 + 1000)], {'sort': 'seqno'}),
+    ]
+
+
+def measure(fn, repeat):
+    result = None
+    best = None
+    for i in range(0, repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, default=5000000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--buffer-size', type=int, default=32 * 1024 * 1024)
+    parser.add_argument('--no-scan', action='store_true', help='skip the full scan, it takes minutes at 5M lines')
+    args = parser.parse_args()
+
+    spooldir = tempfile.mkdtemp()
+    start = datetime(2017, 1, 1)
+    store = LogBuffer(
+        max_size=args.buffer_size,
+        max_spill_size=1 << 40,
+        spill_prefix=os.path.join(spooldir, 'logd.spill')
+    )
+
+    try:
+        started_at = time.perf_counter()
+        fill(store, args.lines, start)
+        print('{0} lines buffered in {1:.0f}s, {2} spilled to disk'.format(
+            args.lines, time.perf_counter() - started_at, store.spilled
+        ))
+
+        segments = store.snapshot()
+        print('{0:<24} {1:>10} {2:>12} {3:>12}'.format('query', 'results', 'indexed ms', 'scan ms'))
+        for name, filter, params in queries(args.lines, start):
+            indexed, result = measure(
+                lambda: list(q.query(BufferQuery(filter, params).run(segments), *filter, stream=True, **params)),
+                args.repeat
+            )
+
+            scan = '-'
+            if not args.no_scan:
+                elapsed, expected = measure(
+                    lambda: list(q.query(store.entries(segments), *filter, stream=True, **params)),
+                    1
+                )
+                assert expected == result
+                scan = '{0:.1f}'.format(elapsed)
+
+            print('{0:<24} {1:>10} {2:>12.2f} {3:>12}'.format(name, len(result), indexed, scan))
+    finally:
+        shutil.rmtree(spooldir)
+
+
+if __name__ == '__main__':
+    main()
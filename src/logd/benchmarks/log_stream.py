@@ -0,0 +1,147 @@
+#
+# Copyright 2017 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+"""
+Measures CPU time logd spends delivering log lines to followers, with
+every line broadcast to every follower and with subscription-filtered
+bursts. Followers each watch one service while smbd floods the log.
+
+Usage: python3 benchmarks/log_stream.py [--lines 200000] [--followers 5] [--interval 0.5]
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from stream import LogStreamer
+
+
+SERVICES = ['org.freenas.smbd'] * 18 + ['org.freenas.nginx', 'org.freenas.dispatcher']
+
+
+class Server(object):
+    def __init__(self):
+        self.connections = []
+
+
+class Connection(object):
+    # Serializes events the way an RPC connection would
+    def __init__(self, parent):
+        self.parent = parent
+        self.parent.connections.append(self)
+        self.events = 0
+        self.lines = 0
+        self.bytes = 0
+        self.dropped = 0
+
+    def emit_event(self, name, args):
+        data = json.dumps({'name': name, 'args': args}, default=str)
+        self.events += 1
+        self.lines += len(args['messages']) if 'messages' in args else 1
+        self.bytes += len(data)
+        self.dropped = args.get('dropped', 0) if isinstance(args, dict) else 0
+
+
+def lines(count):
+    random.seed(0)
+    for seqno in range(0, count):
+        yield {
+            'seqno': seqno,
+            'priority': 'INFO',
+            'identifier': 'smbd',
+            'service': random.choice(SERVICES),
+            'timestamp': datetime.now(),
+            'message': 'connect to service share{0} initially as user nobody'.format(seqno % 100)
+        }
+
+
+def broadcast(items, connections, args):
+    start = time.process_time()
+    for item in items:
+        for conn in connections:
+            conn.emit_event('logd.logging.message', item)
+
+    return time.process_time() - start
+
+
+def subscribed(items, connections, args):
+    streamer = LogStreamer()
+    streamer.start()
+    for i, conn in enumerate(connections):
+        service = SERVICES[-1 - i % 2]
+        streamer.subscribe(conn, {'service': service}, {'interval': args.interval})
+
+    start = time.process_time()
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == 64:
+            streamer.publish(batch)
+            batch = []
+
+    streamer.publish(batch)
+    time.sleep(args.interval * 2)
+    return time.process_time() - start
+
+
+def run(name, fn, args):
+    server = Server()
+    connections = [Connection(server) for i in range(0, args.followers)]
+    items = list(lines(args.lines))
+    cpu = fn(items, connections, args)
+    print('{0:<12} {1:>10.2f} {2:>10} {3:>12} {4:>12.1f} {5:>10}'.format(
+        name, cpu,
+        sum(c.events for c in connections),
+        sum(c.lines for c in connections),
+        sum(c.bytes for c in connections) / 1024 / 1024,
+        sum(c.dropped for c in connections)
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, default=200000)
+    parser.add_argument('--followers', type=int, default=5)
+    parser.add_argument('--interval', type=float, default=0.5)
+    args = parser.parse_args()
+
+    print('{0} lines, 90% from smbd, {1} followers of other services'.format(args.lines, args.followers))
+    print('{0:<12} {1:>10} {2:>10} {3:>12} {4:>12} {5:>10}'.format(
+        'delivery', 'cpu s', 'events', 'lines sent', 'MiB sent', 'dropped'
+    ))
+    run('broadcast', broadcast, args)
+    run('subscribed', subscribed, args)
+
+
+if __name__ == '__main__':
+    main()
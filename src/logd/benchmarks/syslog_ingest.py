@@ -0,0 +1,163 @@
+#
+# Copyright 2017 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+"""
+Measures how fast logd's SyslogServer takes messages off a local unix
+datagram socket and parses them, against the previous single recvmsg(1024)
+and strptime() based reader. A separate process sends the messages, one in
+every 20 of them longer than 1024 bytes.
+
+Usage: python3 benchmarks/syslog_ingest.py [--messages 200000] [--senders 2]
+"""
+
+import os
+import sys
+import time
+import socket
+import shutil
+import tempfile
+import argparse
+import threading
+import multiprocessing
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from ingest import SyslogServer, SYSLOG_PATTERN, PROC_PATTERN
+
+
+class LegacySyslogServer(SyslogServer):
+    def parse_message(self, msg):
+        now = datetime.now()
+        m = SYSLOG_PATTERN.match(msg.decode('utf-8', 'replace'))
+        if not m:
+            return
+
+        m = m.groupdict()
+        m.update({
+            'priority': int(m['priority']),
+            'syslog_timestamp': datetime.strptime(m['syslog_timestamp'], '%b %d %H:%M:%S').replace(year=now.year),
+            'source': 'syslog'
+        })
+
+        p = PROC_PATTERN.match(m['identifier'])
+        if not p:
+            return m
+
+        p = p.groupdict()
+        m['identifier'] = p['identifier']
+        m['pid'] = int(p['pid'])
+        return m
+
+    def serve(self):
+        while True:
+            msg, ancdata, flags, address = self.sock.recvmsg(1024)
+            if not msg:
+                break
+
+            self.context.push(self.parse_message(msg))
+
+
+class CountingContext(object):
+    def __init__(self, expected):
+        self.expected = expected
+        self.received = 0
+        self.truncated = 0
+        self.done = threading.Event()
+
+    def push(self, item):
+        self.push_many([item])
+
+    def push_many(self, items):
+        for item in items:
+            if item and item['message'][-1] != '$':
+                self.truncated += 1
+
+        self.received += len(items)
+        if self.received >= self.expected:
+            self.done.set()
+
+
+def message(seqno):
+    text = 'connect to service share{0} initially as user nobody (uid=65534, gid=65534)'.format(seqno % 100)
+    if seqno % 20 == 0:
+        text = text * 20
+
+    return '<30>Oct  5 12:34:56 smbd[{0}]: {1}$'.format(1000 + seqno % 50, text).encode('utf-8')
+
+
+def send(path, start, count):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM, 0)
+    messages = [message(i) for i in range(start, start + 100)]
+    for i in range(0, count):
+        sock.sendto(messages[i % 100], path)
+
+
+def run(name, cls, args, tmpdir):
+    path = os.path.join(tmpdir, name)
+    context = CountingContext(args.messages)
+    server = cls(path, 0o600, context)
+    server.start()
+
+    per_sender = args.messages // args.senders
+    senders = [
+        multiprocessing.Process(target=send, args=(path, i * per_sender, per_sender))
+        for i in range(0, args.senders)
+    ]
+
+    start = time.perf_counter()
+    for i in senders:
+        i.start()
+
+    context.done.wait(600)
+    elapsed = time.perf_counter() - start
+    for i in senders:
+        i.join()
+
+    print('{0:<10} {1:>10.2f} {2:>12.0f} {3:>10}'.format(name, elapsed, context.received / elapsed, context.truncated))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--senders', type=int, default=2)
+    args = parser.parse_args()
+    args.messages -= args.messages % args.senders
+
+    tmpdir = tempfile.mkdtemp()
+    print('{0} messages from {1} senders'.format(args.messages, args.senders))
+    print('{0:<10} {1:>10} {2:>12} {3:>10}'.format('reader', 'seconds', 'msgs/s', 'truncated'))
+
+    try:
+        run('legacy', LegacySyslogServer, args, tmpdir)
+        run('drain', SyslogServer, args, tmpdir)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,422 @@
+#
+# Copyright 2017 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+import os
+import glob
+import struct
+import pickle
+import logging
+import collections
+from array import array
+
+
+SEGMENT_SIZE = 1024
+ENTRY_OVERHEAD = 512
+DEFAULT_BUFFER_SIZE = 32 * 1024 * 1024
+DEFAULT_SPILL_SIZE = 256 * 1024 * 1024
+SPILL_PREFIX = '/var/tmp/logd.spill'
+SPILL_HEADER = struct.Struct('!Q')
+SPILL_DEAD = 1 << 63
+SPILL_FILES = 4
+INDEXED_FIELDS = ('service', 'priority')
+
+
+logger = logging.getLogger('LogBuffer')
+
+
+def entry_size(item):
+    # Rough estimate of what an entry costs in memory: the dict and its short
+    # values are about constant, the message is what varies
+    return ENTRY_OVERHEAD + len(item.get('message') or '')
+
+
+class Segment(object):
+    """
+    Run of consecutive log entries.
+
+    Besides the entries, a segment keeps what is needed to skip it or to
+    pick entries out of it without looking at all of them: its seqno and
+    timestamp bounds and, for every field in INDEXED_FIELDS, offsets of
+    entries holding each value. `timestamps` is a (min, max) tuple, or False
+    if some timestamps could not be compared.
+    """
+    spilled = False
+
+    def __init__(self):
+        self.entries = []
+        self.size = 0
+        self.first_seqno = None
+        self.last_seqno = None
+        self.timestamps = None
+        self.postings = {f: {} for f in INDEXED_FIELDS}
+
+    @property
+    def count(self):
+        return len(self.entries)
+
+    def append(self, item):
+        size = entry_size(item)
+        offset = len(self.entries)
+        self.entries.append(item)
+        self.size += size
+        if self.first_seqno is None:
+            self.first_seqno = item['seqno']
+
+        self.last_seqno = item['seqno']
+
+        timestamp = item.get('timestamp')
+        if self.timestamps is None:
+            self.timestamps = (timestamp, timestamp) if timestamp is not None else False
+        elif self.timestamps:
+            try:
+                if timestamp > self.timestamps[1]:
+                    self.timestamps = (self.timestamps[0], timestamp)
+                elif timestamp < self.timestamps[0]:
+                    self.timestamps = (timestamp, self.timestamps[1])
+            except TypeError:
+                self.timestamps = False
+
+        for field, postings in self.postings.items():
+            value = item.get(field)
+            offsets = postings.get(value)
+            if offsets is None:
+                offsets = postings[value] = array('H')
+
+            offsets.append(offset)
+
+        return size
+
+    def load(self):
+        return self.entries
+
+
+class SpilledSegment(object):
+    spilled = True
+
+    def __init__(self, spill, offset, length, segment):
+        # Index data stays in memory, so that queries only read segments
+        # holding something they are after
+        self.spill = spill
+        self.offset = offset
+        self.length = length
+        self.count = segment.count
+        self.size = segment.size
+        self.first_seqno = segment.first_seqno
+        self.last_seqno = segment.last_seqno
+        self.timestamps = segment.timestamps
+        self.postings = segment.postings
+
+    def load(self):
+        with open(self.spill.path, 'rb') as f:
+            f.seek(self.offset)
+            return pickle.loads(f.read(self.length))
+
+
+class SpillFile(object):
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self.size = 0
+        self.live = 0
+
+    def write(self, segment):
+        if not self.fd:
+            self.fd = open(self.path, 'ab')
+            self.size = self.fd.tell()
+
+        data = pickle.dumps(segment.entries, pickle.HIGHEST_PROTOCOL)
+        self.fd.write(SPILL_HEADER.pack(len(data)))
+        self.fd.write(data)
+        self.fd.flush()
+
+        offset = self.size + SPILL_HEADER.size
+        self.size = offset + len(data)
+        self.live += 1
+        return SpilledSegment(self, offset, len(data), segment)
+
+    def discard(self, segment):
+        # Marks the record of a flushed or dropped segment dead, so that
+        # recover() skips it
+        try:
+            fd = os.open(self.path, os.O_WRONLY)
+            try:
+                os.pwrite(fd, SPILL_HEADER.pack(segment.length | SPILL_DEAD), segment.offset - SPILL_HEADER.size)
+            finally:
+                os.close(fd)
+        except OSError as err:
+            logger.warning('Cannot mark spilled log entries in {0} as gone: {1}'.format(self.path, err))
+
+    def recover(self):
+        # Rebuilds segment descriptors of a spill file left behind by a
+        # previous logd instance. Dead records are skipped, a torn last
+        # record is ignored.
+        result = []
+        with open(self.path, 'rb') as f:
+            while True:
+                header = f.read(SPILL_HEADER.size)
+                if len(header) < SPILL_HEADER.size:
+                    break
+
+                length, = SPILL_HEADER.unpack(header)
+                offset = f.tell()
+                if length & SPILL_DEAD:
+                    f.seek(length & ~SPILL_DEAD, os.SEEK_CUR)
+                    continue
+
+                try:
+                    entries = pickle.loads(f.read(length))
+                except (EOFError, pickle.UnpicklingError):
+                    break
+
+                if not entries:
+                    continue
+
+                segment = Segment()
+                for i in entries:
+                    segment.append(i)
+
+                self.live += 1
+                result.append(SpilledSegment(self, offset, length, segment))
+
+        self.size = os.path.getsize(self.path)
+        return result
+
+    def close(self):
+        if self.fd:
+            self.fd.close()
+            self.fd = None
+
+    def remove(self):
+        self.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class LogBuffer(object):
+    """
+    Bounded buffer of log entries waiting to be flushed to the datastore.
+
+    Entries are kept in segments of `segment_size` entries. Once the buffer
+    holds more than `max_size` bytes, oldest segments are written out to an
+    append-only spill file and only their location is kept in memory. Once
+    spill files grow past `max_spill_size` bytes, oldest segments are dropped;
+    spill files are rotated so that this frees disk space. Records of
+    flushed or dropped segments are marked dead in their file, so recovery
+    after a restart only brings back what was still pending.
+    Entries are always handed out in seqno order, spilled or not.
+    """
+    def __init__(self, max_size=DEFAULT_BUFFER_SIZE, max_spill_size=DEFAULT_SPILL_SIZE,
+                 spill_prefix=SPILL_PREFIX, segment_size=SEGMENT_SIZE):
+        self.max_size = max_size
+        self.max_spill_size = max_spill_size
+        self.spill_prefix = spill_prefix
+        self.segment_size = segment_size
+        self.segments = collections.deque()
+        self.flushing = collections.deque()
+        self.spill = None
+        self.spill_index = 0
+        self.size = 0
+        self.spill_size = 0
+        self.count = 0
+        self.spilled = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return self.entries(self.snapshot())
+
+    def snapshot(self):
+        # Segments are appended to from ingest threads, so take this under
+        # the same lock as append()
+        return list(self.flushing) + list(self.segments)
+
+    def entries(self, segments):
+        for segment in segments:
+            try:
+                yield from segment.load()
+            except FileNotFoundError:
+                # Flushed and removed in the meantime
+                continue
+
+    def append(self, item):
+        segment = self.segments[-1] if self.segments else None
+        if not segment or segment.spilled or segment.count >= self.segment_size:
+            segment = Segment()
+            self.segments.append(segment)
+
+        self.size += segment.append(item)
+        self.count += 1
+
+        if self.size > self.max_size:
+            self.__spill()
+
+    def recover(self):
+        # Picks up spill files left behind by a previous logd instance and
+        # returns the last seqno found in them, or None
+        segments = []
+        for path in sorted(glob.glob(self.spill_prefix + '.*'), key=lambda p: int(p.rpartition('.')[2])):
+            spill = SpillFile(path)
+            try:
+                recovered = spill.recover()
+            except OSError as err:
+                logger.warning('Cannot recover spilled log entries from {0}: {1}'.format(path, err))
+                continue
+
+            self.spill_index = max(self.spill_index, int(path.rpartition('.')[2]) + 1)
+            if not recovered:
+                spill.remove()
+                continue
+
+            self.spill_size += spill.size
+            segments.extend(recovered)
+            logger.info('Recovered {0} spilled log entries from {1}'.format(sum(s.count for s in recovered), path))
+
+        self.segments.extendleft(reversed(segments))
+        self.count += sum(s.count for s in segments)
+        self.__drop()
+        return max(s.last_seqno for s in segments) if segments else None
+
+    def take(self):
+        # Hands out everything buffered so far, oldest first. The caller has
+        # to either release() the segments once they are stored or give them
+        # back with restore().
+        segments, self.segments = self.segments, collections.deque()
+        self.flushing.extend(segments)
+        self.size = 0
+        self.count = 0
+
+        # New spills go to a fresh file, so that files handed out can be
+        # removed as soon as they are flushed
+        if self.spill:
+            self.__close_spill()
+
+        return segments
+
+    def __unflushing(self, segment):
+        # Segments are mostly released in the order they were taken
+        if self.flushing and self.flushing[0] is segment:
+            self.flushing.popleft()
+        else:
+            self.flushing.remove(segment)
+
+    def release(self, segments):
+        for segment in segments:
+            self.__unflushing(segment)
+            if segment.spilled:
+                self.__release_spilled(segment)
+
+    def restore(self, segments, head=None):
+        # `head` holds what is left of the first segment when part of it got
+        # stored already, and is put back in its place
+        for segment in segments:
+            self.__unflushing(segment)
+
+        if head is not None:
+            if segments[0].spilled:
+                self.__release_spilled(segments[0])
+
+            segments = [head] + list(segments[1:])
+
+        self.segments.extendleft(reversed(segments))
+        self.size += sum(s.size for s in segments if not s.spilled)
+        self.count += sum(s.count for s in segments)
+        if self.size > self.max_size:
+            self.__spill()
+
+    def __spill(self):
+        for segment in list(self.segments):
+            if self.size <= self.max_size:
+                break
+
+            # Never spill the segment currently being appended to
+            if segment.spilled or segment is self.segments[-1]:
+                continue
+
+            index = self.segments.index(segment)
+            try:
+                # Files are rotated, so that dropping oldest segments frees
+                # disk space a whole file at a time
+                if self.spill and self.spill.size >= self.max_spill_size // SPILL_FILES:
+                    self.__close_spill()
+
+                if not self.spill:
+                    self.spill = SpillFile('{0}.{1}'.format(self.spill_prefix, self.spill_index))
+                    self.spill_index += 1
+
+                written = self.spill.size
+                spilled = self.spill.write(segment)
+            except OSError as err:
+                logger.warning('Cannot spill log entries to disk, dropping {0} entries: {1}'.format(segment.count, err))
+                del self.segments[index]
+                self.size -= segment.size
+                self.count -= segment.count
+                self.dropped += segment.count
+                if self.spill:
+                    # Do not append after a possibly torn record
+                    self.__close_spill()
+
+                continue
+
+            self.segments[index] = spilled
+            self.size -= segment.size
+            self.spill_size += self.spill.size - written
+            self.spilled += segment.count
+
+        self.__drop()
+
+    def __drop(self):
+        # spill_size counts bytes of spill files still on disk, which only
+        # goes down once every segment in a file is gone
+        while self.spill_size > self.max_spill_size and self.segments and self.segments[0].spilled:
+            segment = self.segments.popleft()
+            self.count -= segment.count
+            self.dropped += segment.count
+            self.__release_spilled(segment)
+
+    def __close_spill(self):
+        spill, self.spill = self.spill, None
+        spill.close()
+        if spill.live == 0:
+            spill.remove()
+            self.spill_size -= spill.size
+
+    def __release_spilled(self, segment):
+        spill = segment.spill
+        spill.live -= 1
+        if spill.live > 0:
+            spill.discard(segment)
+            return
+
+        if spill is self.spill:
+            self.spill = None
+
+        spill.remove()
+        self.spill_size -= spill.size
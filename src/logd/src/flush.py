@@ -0,0 +1,199 @@
+#
+# Copyright 2017 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from buffer import Segment
+from datastore import DatastoreException, DuplicateKeyException, BulkWriteException
+
+
+FLUSH_RETRIES = 5
+FLUSH_RETRY_DELAY = 1
+
+
+logger = logging.getLogger('LogFlusher')
+
+
+class FlushStats(object):
+    def __init__(self):
+        self.flushes = 0
+        self.batches = 0
+        self.entries = 0
+        self.retries = 0
+        self.failures = 0
+        self.duplicates = 0
+        self.last_seqno = None
+        self.last_flush_at = None
+        self.last_duration = 0
+        self.last_entries = 0
+
+    def __getstate__(self):
+        return {
+            'flushes': self.flushes,
+            'batches': self.batches,
+            'entries': self.entries,
+            'retries': self.retries,
+            'failures': self.failures,
+            'duplicates': self.duplicates,
+            'last_seqno': self.last_seqno,
+            'last_flush_at': self.last_flush_at,
+            'last_duration': self.last_duration,
+            'last_entries': self.last_entries,
+            'last_throughput': self.last_entries / self.last_duration if self.last_duration else 0
+        }
+
+
+class LogFlusher(object):
+    """
+    Moves log entries from a LogBuffer to the log datastore.
+
+    The buffer is swapped out under `lock` in one go and written out one
+    segment per insert_many() call, without holding `lock`, so ingestion
+    is never blocked by the datastore. The next segment is loaded (from the
+    spill file, if it was spilled) while the current one is being written.
+    Failing writes are retried from the first entry not stored, so entries
+    always reach the datastore in seqno order. When retries run out, only
+    the entries not stored yet go back to the buffer.
+    """
+    def __init__(self, buffer, lock, collection='syslog'):
+        self.buffer = buffer
+        self.lock = lock
+        self.collection = collection
+        self.stats = FlushStats()
+        self.written = 0
+        self.loader = ThreadPoolExecutor(1)
+
+    def get_lag(self):
+        # Number of entries not stored yet, buffered or being flushed. Must
+        # run with the lock held.
+        return self.buffer.count + sum(s.count for s in self.buffer.flushing)
+
+    def flush(self, datastore):
+        with self.lock:
+            segments = self.buffer.take()
+
+        started_at = time.monotonic()
+        flushed = 0
+        self.stats.flushes += 1
+        pending = self.loader.submit(segments[0].load) if segments else None
+
+        try:
+            while segments:
+                entries = None
+                entries = pending.result()
+                pending = self.loader.submit(segments[1].load) if len(segments) > 1 else None
+                self.write(datastore, entries)
+                flushed += len(entries)
+
+                with self.lock:
+                    self.buffer.release([segments.popleft()])
+        except (DatastoreException, OSError) as err:
+            self.stats.failures += 1
+            logger.warning('Flush failed, {0} entries left for the next flush: {1}'.format(
+                sum(s.count for s in segments) - self.written, err
+            ))
+
+            head = None
+            if entries is not None and self.written:
+                # Resending the stored part would only hit duplicate keys
+                flushed += self.written
+                head = Segment()
+                for i in entries[self.written:]:
+                    head.append(i)
+
+            with self.lock:
+                self.buffer.restore(list(segments), head)
+        finally:
+            self.stats.last_flush_at = time.time()
+            self.stats.last_duration = time.monotonic() - started_at
+            self.stats.last_entries = flushed
+
+    def write(self, datastore, entries):
+        start = 0
+        retries = 0
+        self.written = 0
+
+        while start < len(entries):
+            try:
+                datastore.insert_many(self.collection, entries[start:] if start else entries, ordered=True)
+                self.stored(entries, start, len(entries))
+                self.stats.batches += 1
+                return
+            except BulkWriteException as err:
+                # Ordered writes stop at the first failure, everything
+                # before it is stored already
+                first = err.errors[0]
+                self.stored(entries, start, start + first['index'])
+                start += first['index']
+                self.written = start
+                if isinstance(first['error'], DuplicateKeyException):
+                    # Stored by an earlier attempt that failed half way
+                    end = self.stored_run(datastore, entries, start)
+                    self.stats.duplicates += end - start
+                    self.stored(entries, start, end)
+                    start = end
+                    self.written = start
+                    continue
+
+                error = first['error']
+            except DatastoreException as err:
+                error = err
+
+            retries += 1
+            self.stats.retries += 1
+            if retries > FLUSH_RETRIES:
+                raise error
+
+            logger.warning('Cannot store log entries, retrying in {0} seconds: {1}'.format(
+                FLUSH_RETRY_DELAY * retries, error
+            ))
+
+            time.sleep(FLUSH_RETRY_DELAY * retries)
+
+        self.stats.batches += 1
+
+    def stored_run(self, datastore, entries, start):
+        # An interrupted ordered write leaves a run of stored entries behind,
+        # find its end with a binary search instead of one insert per entry
+        low, high = start + 1, len(entries)
+        if 'id' not in entries[start]:
+            return low
+
+        while low < high:
+            middle = (low + high) // 2
+            if datastore.exists(self.collection, ('id', '=', entries[middle]['id'])):
+                low = middle + 1
+            else:
+                high = middle
+
+        return low
+
+    def stored(self, entries, start, end):
+        if end > start:
+            self.stats.entries += end - start
+            self.stats.last_seqno = entries[end - 1]['seqno']
@@ -0,0 +1,263 @@
+#
+# Copyright 2017 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+import heapq
+import itertools
+from freenas.utils import query as q
+from buffer import INDEXED_FIELDS
+
+
+RANGE_OPERATORS = ('=', '>', '>=', '<', '<=')
+
+
+class Descending(object):
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+class BufferQuery(object):
+    """
+    Picks candidate entries for a logd.logging.query out of a LogBuffer
+    snapshot without looking at every buffered entry.
+
+    Filter rules on `seqno` and `timestamp` are checked against segment
+    bounds and rules on INDEXED_FIELDS against segment postings, so that
+    segments that cannot match are skipped (and spilled ones never read
+    back). When results are sorted by `seqno` or `timestamp` and limited,
+    segments are walked from the end the sort starts at and only the best
+    `limit` + `offset` matches are kept, skipping segments whose bounds
+    cannot beat them.
+
+    Candidates are a superset of what the query can return from the
+    buffer; the caller still runs them through the full query.
+    """
+    def __init__(self, filter=None, params=None):
+        self.filter = filter or []
+        self.params = params or {}
+        self.lower = {}
+        self.upper = {}
+        self.values = {}
+        self.sort = None
+        self.descending = False
+        self.limit = None
+
+        for rule in self.filter:
+            self._plan_rule(rule)
+
+        self._plan_params()
+
+    def _plan_rule(self, rule):
+        if not isinstance(rule, (list, tuple)) or len(rule) != 3:
+            return
+
+        field, op, value = rule
+        if field in INDEXED_FIELDS:
+            # Unhashable values cannot be looked up, the rule is then left to
+            # the query itself
+            try:
+                if op == '=':
+                    values = {value}
+                elif op == 'in' and isinstance(value, (list, tuple, set, frozenset)):
+                    values = set(value)
+                else:
+                    return
+            except TypeError:
+                return
+
+            self.values[field] = self.values[field] & values if field in self.values else values
+            return
+
+        if field in ('seqno', 'timestamp') and op in RANGE_OPERATORS and value is not None:
+            # Bounds are kept inclusive, the query itself rejects the edges
+            try:
+                if op in ('=', '>', '>='):
+                    if field not in self.lower or value > self.lower[field]:
+                        self.lower[field] = value
+
+                if op in ('=', '<', '<='):
+                    if field not in self.upper or value < self.upper[field]:
+                        self.upper[field] = value
+            except TypeError:
+                pass
+
+    def _plan_params(self):
+        if self.params.get('count'):
+            return
+
+        limit = self.params.get('limit')
+        if self.params.get('single'):
+            limit = 1
+
+        if not limit:
+            return
+
+        self.limit = limit + (self.params.get('offset') or 0)
+        sort = self.params.get('sort')
+        if isinstance(sort, (list, tuple)):
+            if len(sort) != 1:
+                self.limit = None
+                return
+
+            sort = sort[0]
+
+        if not sort:
+            return
+
+        field = sort[1:] if sort.startswith('-') else sort
+        if field not in ('seqno', 'timestamp'):
+            # Sorted on something segments know nothing about
+            self.limit = None
+            return
+
+        self.sort = field
+        self.descending = sort.startswith('-')
+
+    def bounds(self, segment, field):
+        if field == 'seqno':
+            return segment.first_seqno, segment.last_seqno
+
+        return segment.timestamps or (None, None)
+
+    def matches_segment(self, segment):
+        if not segment.count:
+            return False
+
+        try:
+            for field in ('seqno', 'timestamp'):
+                low, high = self.bounds(segment, field)
+                if low is None:
+                    continue
+
+                if field in self.lower and high < self.lower[field]:
+                    return False
+
+                if field in self.upper and low > self.upper[field]:
+                    return False
+        except TypeError:
+            pass
+
+        for field, values in self.values.items():
+            if not any(v in segment.postings[field] for v in values):
+                return False
+
+        return True
+
+    def offsets(self, segment):
+        # Returns sorted offsets of candidate entries, or None for all of them
+        result = None
+        for field, values in self.values.items():
+            postings = segment.postings[field]
+            offsets = set(itertools.chain.from_iterable(postings[v] for v in values if v in postings))
+            result = offsets if result is None else result & offsets
+
+        if result is not None:
+            return sorted(result)
+
+        # Seqnos are consecutive within a segment unless it was recovered
+        # from an older boot with gaps in it
+        if ('seqno' in self.lower or 'seqno' in self.upper) and \
+                segment.last_seqno - segment.first_seqno + 1 == segment.count:
+            try:
+                start = max(0, self.lower.get('seqno', segment.first_seqno) - segment.first_seqno)
+                end = min(segment.count, self.upper.get('seqno', segment.last_seqno) - segment.first_seqno + 1)
+                return range(start, end)
+            except TypeError:
+                pass
+
+        return None
+
+    def candidates(self, segment):
+        try:
+            entries = segment.load()
+        except FileNotFoundError:
+            # Flushed and removed in the meantime
+            return []
+
+        offsets = self.offsets(segment)
+        if offsets is not None:
+            entries = [entries[i] for i in offsets]
+
+        return [i for i in entries if q.matches(i, *self.filter)]
+
+    def run(self, segments):
+        if self.sort and self.limit is not None:
+            try:
+                return self.top(segments)
+            except TypeError:
+                # Sort keys of different types, leave sorting to the query
+                pass
+
+        return self.scan(segments)
+
+    def scan(self, segments):
+        count = 0
+        for segment in segments:
+            if not self.matches_segment(segment):
+                continue
+
+            for i in self.candidates(segment):
+                yield i
+                count += 1
+                if self.limit is not None and count >= self.limit:
+                    return
+
+    def top(self, segments):
+        # Keeps the best `limit` entries in a heap whose smallest item is
+        # the worst one kept. Ties go to entries earlier in the buffer, as
+        # they would with a stable sort over all of them.
+        key = self.sort
+        wrap = (lambda v: v) if self.descending else Descending
+        heap = []
+        counter = itertools.count()
+
+        for segment in (reversed(segments) if self.descending else segments):
+            if len(heap) >= self.limit:
+                low, high = self.bounds(segment, key)
+                if low is not None and wrap(high if self.descending else low) < heap[0][0]:
+                    continue
+
+            if not self.matches_segment(segment):
+                continue
+
+            candidates = self.candidates(segment)
+            for i in (reversed(candidates) if self.descending else candidates):
+                position = next(counter)
+                item = (wrap(i.get(key)), position if self.descending else -position, i)
+                if len(heap) < self.limit:
+                    heapq.heappush(heap, item)
+                elif item[:2] > heap[0][:2]:
+                    heapq.heapreplace(heap, item)
+
+        return [i for _, _, i in sorted(heap, key=lambda i: i[1], reverse=True)]
@@ -0,0 +1,126 @@
+#
+# Copyright 2017 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+import os
+import re
+import socket
+import threading
+from datetime import datetime
+
+
+RCVBUF_MINSIZE = 80 * 1024  # same as in syslogd
+RCVBUF_SIZE = 1024 * 1024
+MAX_MESSAGE_SIZE = 64 * 1024
+RECV_BATCH_SIZE = 256
+SYSLOG_PATTERN = re.compile(r'<(?P<priority>\d+)>(?P<syslog_timestamp>\w+\s+\d+\s+\d+:\d+:\d+) (?P<identifier>[\w\[\]]+): (?P<message>.*)')
+PROC_PATTERN = re.compile(r'(?P<identifier>\w+)\[(?P<pid>\d+)\]')
+MONTHS = {m: i + 1 for i, m in enumerate(('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'))}
+
+
+def parse_syslog_timestamp(value, year):
+    # Parses RFC 3164 timestamps ('Oct  5 12:34:56'), returns None when the
+    # value is malformed
+    try:
+        month, day, clock = value.split()
+        hour, minute, second = clock.split(':')
+        return datetime(year, MONTHS[month], int(day), int(hour), int(minute), int(second))
+    except (KeyError, ValueError):
+        return None
+
+
+class SyslogServer(object):
+    def __init__(self, path, perms, context):
+        super(SyslogServer, self).__init__()
+        self.context = context
+        self.path = path
+        self.perms = perms
+        self.thread = None
+        self.sock = None
+
+        if os.path.exists(path):
+            os.unlink(path)
+
+    def start(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM, 0)
+        self.sock.bind(self.path)
+        os.chmod(self.path, self.perms)
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RCVBUF_SIZE)
+        except OSError:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RCVBUF_MINSIZE)
+
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def parse_message(self, msg, now):
+        m = SYSLOG_PATTERN.match(str(msg, 'utf-8', 'replace'))
+        if not m:
+            return
+
+        m = m.groupdict()
+        m.update({
+            'priority': int(m['priority']),
+            'syslog_timestamp': parse_syslog_timestamp(m['syslog_timestamp'], now.year) or now,
+            'source': 'syslog'
+        })
+
+        if '[' not in m['identifier']:
+            return m
+
+        p = PROC_PATTERN.match(m['identifier'])
+        if not p:
+            return m
+
+        p = p.groupdict()
+        m['identifier'] = p['identifier']
+        m['pid'] = int(p['pid'])
+        return m
+
+    def serve(self):
+        buffer = bytearray(MAX_MESSAGE_SIZE)
+        view = memoryview(buffer)
+
+        while True:
+            length = self.sock.recv_into(buffer)
+            if not length:
+                break
+
+            now = datetime.now()
+            items = [self.parse_message(view[:length], now)]
+
+            # Drain whatever queued up in the meantime, so that a burst is
+            # pushed in one go
+            while len(items) < RECV_BATCH_SIZE:
+                try:
+                    length = self.sock.recv_into(buffer, 0, socket.MSG_DONTWAIT)
+                except BlockingIOError:
+                    break
+
+                if length:
+                    items.append(self.parse_message(view[:length], now))
+
+            self.context.push_many(items)
@@ -0,0 +1,146 @@
+#
+# Copyright 2017 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+import time
+import errno
+import logging
+import threading
+from freenas.dispatcher.client import Client, ClientError
+from freenas.dispatcher.rpc import RpcException
+from freenas.serviced import SERVICED_SOCKET
+
+
+JOB_CACHE_SIZE = 4096
+RECONNECT_INTERVAL = 5
+
+
+logger = logging.getLogger('JobLabelCache')
+
+
+class JobLabelCache(object):
+    """
+    Maps PIDs to labels of the serviced jobs they belong to.
+
+    Answers are cached per PID, including PIDs that belong to no job, and
+    looked up over a single persistent connection to serviced. The same
+    connection delivers job events: a started job evicts its PID and all
+    negative answers, a stopped or failed job evicts every PID mapped to
+    its label. Losing the connection flushes the whole cache, since events
+    may have been missed.
+    """
+    def __init__(self, max_size=JOB_CACHE_SIZE):
+        self.max_size = max_size
+        self.labels = {}
+        self.lock = threading.Lock()
+        self.client = None
+        self.client_lock = threading.Lock()
+        self.failed_at = None
+
+    def get(self, pid):
+        try:
+            return self.labels[pid]
+        except KeyError:
+            pass
+
+        found, label = self.lookup(pid)
+        if found:
+            with self.lock:
+                if len(self.labels) >= self.max_size:
+                    self.labels.clear()
+
+                self.labels[pid] = label
+
+        return label
+
+    def lookup(self, pid):
+        # Returns a (found, label) tuple, found is False when serviced
+        # could not be asked
+        with self.client_lock:
+            client = self.client
+            if not client:
+                if self.failed_at and time.monotonic() - self.failed_at < RECONNECT_INTERVAL:
+                    return False, None
+
+                client = self.connect()
+                if not client:
+                    return False, None
+
+            try:
+                job = client.call_sync('serviced.job.get_by_pid', pid, True)
+                return True, job['Label']
+            except RpcException as err:
+                if err.code == errno.ENOENT:
+                    return True, None
+
+                logger.warning('Cannot get job for PID {0}: {1}'.format(pid, err))
+                return False, None
+
+    def connect(self):
+        # Must run with client_lock held, returns the connected client
+        client = Client()
+        client.on_error(self.on_error)
+        try:
+            client.connect(SERVICED_SOCKET)
+            client.on_event(self.on_event)
+            client.subscribe_events('serviced.job.*')
+        except (RpcException, OSError) as err:
+            logger.warning('Cannot connect to serviced: {0}'.format(err))
+            self.failed_at = time.monotonic()
+            return None
+
+        self.client = client
+        self.failed_at = None
+        return client
+
+    def invalidate(self, label=None):
+        with self.lock:
+            if label is None:
+                self.labels.clear()
+                return
+
+            for pid in [p for p, l in self.labels.items() if l == label]:
+                del self.labels[pid]
+
+    def on_event(self, name, args):
+        if name == 'serviced.job.started':
+            # PIDs get reused, forget whatever was known about this one
+            with self.lock:
+                for pid in [p for p, l in self.labels.items() if l is None or p == args['PID']]:
+                    del self.labels[pid]
+
+            return
+
+        if name in ('serviced.job.stopped', 'serviced.job.error'):
+            self.invalidate(args['Label'])
+
+    def on_error(self, reason, **kwargs):
+        if reason in (ClientError.CONNECTION_CLOSED, ClientError.LOGOUT):
+            # Not taking client_lock here, a lookup holding it may be
+            # waiting on this very connection
+            logger.warning('Connection to serviced lost')
+            self.client = None
+            self.invalidate()
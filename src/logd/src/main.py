@@ -26,12 +26,10 @@
 #####################################################################
 
 import uuid
-import os
 import sys
 import re
 import socket
 import threading
-import collections
 import signal
 import logging
 import itertools
@@ -45,16 +43,20 @@ from bsd import kinfo_getproc
 from bsd import SyslogPriority, SyslogFacility
 from freenas.dispatcher.server import Server
 from freenas.dispatcher.rpc import RpcContext, RpcService, RpcException, generator, get_sender
-from freenas.serviced import ServicedException, checkin, get_job_by_pid
+from freenas.serviced import checkin
 from freenas.utils import query as q
 from freenas.utils.debug import DebugService
+from buffer import LogBuffer, DEFAULT_BUFFER_SIZE, DEFAULT_SPILL_SIZE
+from flush import LogFlusher
+from index import BufferQuery
+from ingest import SyslogServer
+from labels import JobLabelCache
+from stream import LogStreamer
 
 
 FLUSH_INTERVAL = 180
-RCVBUF_MINSIZE = 80 * 1024  # same as in syslogd
-SYSLOG_PATTERN = re.compile(r'<(?P<priority>\d+)>(?P<syslog_timestamp>\w+\s+\d+\s+\d+:\d+:\d+) (?P<identifier>[\w\[\]]+): (?P<message>.*)')
+HOSTNAME_CACHE_INTERVAL = 30
 KLOG_PATTERN = re.compile(r'<(?P<priority>\d+)>(?P<message>.*)')
-PROC_PATTERN = re.compile(r'(?P<identifier>\w+)\[(?P<pid>\d+)\]')
 DEFAULT_SOCKET_ADDRESS = 'unix:///var/run/logd.sock'
 KLOG_PATH = '/dev/klog'
 SYSLOG_SOCKETS = {
@@ -105,6 +107,16 @@ class LoggingService(RpcService):
         entry['source'] = 'rpc'
         self.context.push(entry)
 
+    def subscribe(self, filter=None, params=None):
+        try:
+            return self.context.streamer.subscribe(get_sender(), filter or {}, params or {})
+        except (ValueError, TypeError) as err:
+            raise RpcException(errno.EINVAL, str(err))
+
+    def unsubscribe(self, id):
+        if not self.context.streamer.unsubscribe(get_sender(), id):
+            raise RpcException(errno.ENOENT, 'Subscription {0} not found'.format(id))
+
     @generator
     def query_boots(self, filter=None, params=None):
         if not self.context.datastore:
@@ -118,14 +130,42 @@ class LoggingService(RpcService):
             if self.context.datastore \
             else []
 
+        with self.context.lock:
+            segments = self.context.store.snapshot()
+
         return q.query(
-            itertools.chain(ds_results, self.context.store),
+            itertools.chain(ds_results, BufferQuery(filter, params).run(segments)),
             *(filter or []),
             stream=True,
             **(params or {})
         )
 
 
+class LogdDebugService(DebugService):
+    def __init__(self, context):
+        super(LogdDebugService, self).__init__(builtins={'context': context})
+        self.context = context
+
+    def get_flush_stats(self):
+        flusher = self.context.flusher
+        with self.context.lock:
+            result = {
+                'seqno': self.context.seqno,
+                'lag': flusher.get_lag(),
+                'buffered': self.context.store.count,
+                'buffered_size': self.context.store.size,
+                'spilled': self.context.store.spilled,
+                'dropped': self.context.store.dropped
+            }
+
+        result.update(flusher.stats.__getstate__())
+        result['flush_age'] = time.time() - flusher.stats.last_flush_at if flusher.stats.last_flush_at else None
+        return result
+
+    def get_stream_stats(self):
+        return [s.__getstate__() for s in list(self.context.streamer.subscriptions.values())]
+
+
 class KernelLogReader(object):
     def __init__(self, context):
         self.context = context
@@ -160,58 +200,6 @@ class KernelLogReader(object):
             time.sleep(1)
 
 
-class SyslogServer(object):
-    def __init__(self, path, perms, context):
-        super(SyslogServer, self).__init__()
-        self.context = context
-        self.path = path
-        self.perms = perms
-        self.thread = None
-        self.sock = None
-
-        if os.path.exists(path):
-            os.unlink(path)
-
-    def start(self):
-        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM, 0)
-        self.sock.bind(self.path)
-        os.chmod(self.path, self.perms)
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RCVBUF_MINSIZE)
-        self.thread = threading.Thread(target=self.serve, daemon=True)
-        self.thread.start()
-
-    def parse_message(self, msg):
-        now = datetime.now()
-        m = SYSLOG_PATTERN.match(msg.decode('utf-8', 'replace'))
-        if not m:
-            return
-
-        m = m.groupdict()
-        m.update({
-            'priority': int(m['priority']),
-            'syslog_timestamp': datetime.strptime(m['syslog_timestamp'], '%b %d %H:%M:%S').replace(year=now.year),
-            'source': 'syslog'
-        })
-
-        p = PROC_PATTERN.match(m['identifier'])
-        if not p:
-            return m
-
-        p = p.groupdict()
-        m['identifier'] = p['identifier']
-        m['pid'] = int(p['pid'])
-        return m
-
-    def serve(self):
-        while True:
-            msg, ancdata, flags, address = self.sock.recvmsg(1024)
-            if not msg:
-                break
-
-            item = self.parse_message(msg)
-            self.context.push(item)
-
-
 class SyslogForwarder(object):
     def __init__(self, host, port, context):
         self.host = host
@@ -231,8 +219,13 @@ class SyslogForwarder(object):
 
 class Context(object):
     def __init__(self):
-        self.store = collections.deque()
+        self.store = LogBuffer()
         self.lock = threading.Lock()
+        self.flusher = LogFlusher(self.store, self.lock)
+        self.labels = JobLabelCache()
+        self.streamer = LogStreamer()
+        self.hostname = None
+        self.hostname_at = None
         self.seqno = 0
         self.rpc_server = Server(self)
         self.boot_id = str(uuid.uuid4())
@@ -248,13 +241,22 @@ class Context(object):
         self.started_at = datetime.utcnow()
         self.rpc = RpcContext()
         self.rpc.register_service_instance('logd.logging', LoggingService(self))
-        self.rpc.register_service_instance('logd.debug', DebugService())
+        self.rpc.register_service_instance('logd.debug', LogdDebugService(self))
         self.cv = threading.Condition()
 
     def init_configstore(self):
         ds = datastore.get_datastore()
         self.configstore = datastore.config.ConfigStore(ds)
 
+    def init_buffer(self):
+        self.store.max_size = self.configstore.get('middleware.logd_buffer_size') or DEFAULT_BUFFER_SIZE
+        self.store.max_spill_size = self.configstore.get('middleware.logd_spill_size') or DEFAULT_SPILL_SIZE
+        last_seqno = self.store.recover()
+        if last_seqno is not None:
+            # Keep seqnos growing past recovered entries, so the buffer
+            # stays in seqno order
+            self.seqno = last_seqno + 1
+
     def init_datastore(self):
         try:
             self.datastore = datastore.get_datastore(log=True)
@@ -276,6 +278,7 @@ class Context(object):
         self.server.start(DEFAULT_SOCKET_ADDRESS, transport_options={'permissions': 0o666})
         thread = threading.Thread(target=self.server.serve_forever, name='RPC server thread', daemon=True)
         thread.start()
+        self.streamer.start()
 
     def init_syslog_server(self):
         for path, perm in SYSLOG_SOCKETS.items():
@@ -293,6 +296,7 @@ class Context(object):
         self.flush_thread.start()
 
     def load_configuration(self):
+        self.hostname = None
         syslog_server = self.configstore.get('system.syslog_server')
 
         if not syslog_server:
@@ -314,39 +318,52 @@ class Context(object):
         self.forwarders.append(SyslogForwarder(host, port, self))
 
     def push(self, item):
-        if not item:
-            return
+        self.push_many([item])
 
-        if 'message' not in item or 'priority' not in item:
+    def push_many(self, items):
+        items = [i for i in items if i and 'message' in i and 'priority' in i]
+        if not items:
             return
 
-        if 'timestamp' not in item:
-            item['timestamp'] = datetime.now()
+        for item in items:
+            if 'timestamp' not in item:
+                item['timestamp'] = datetime.now()
 
-        if 'pid' in item:
-            try:
-                job = get_job_by_pid(item['pid'], True)
-                item['service'] = job['Label']
-            except ServicedException:
-                pass
+            if 'pid' in item:
+                label = self.labels.get(item['pid'])
+                if label:
+                    item['service'] = label
 
         with self.lock:
-            priority, facility = parse_priority(item['priority'])
-            item.update({
-                'id': str(uuid.uuid4()),
-                'seqno': self.seqno,
-                'boot_id': self.boot_id,
-                'priority': priority.name,
-                'facility': facility.name if facility else None
-            })
-            self.store.append(item)
-            self.seqno += 1
-
-        self.server.broadcast_event('logd.logging.message', item)
-        self.forward(item)
+            for item in items:
+                priority, facility = parse_priority(item['priority'])
+                item.update({
+                    'id': str(uuid.uuid4()),
+                    'seqno': self.seqno,
+                    'boot_id': self.boot_id,
+                    'priority': priority.name,
+                    'facility': facility.name if facility else None
+                })
+                self.store.append(item)
+                self.seqno += 1
+
+        self.streamer.publish(items)
+        for item in items:
+            self.forward(item)
+
+    def get_hostname(self):
+        now = time.monotonic()
+        if not self.hostname or now - self.hostname_at > HOSTNAME_CACHE_INTERVAL:
+            self.hostname = socket.gethostname()
+            self.hostname_at = now
+
+        return self.hostname
 
     def forward(self, item):
-        hostname = socket.gethostname()
+        if not self.forwarders:
+            return
+
+        hostname = self.get_hostname()
         prio = SyslogPriority.INFO
 
         try:
@@ -364,28 +381,34 @@ class Context(object):
             # Flush immediately after getting wakeup or when timeout expires
             with self.cv:
                 self.cv.wait(FLUSH_INTERVAL)
+                flush = self.flush
+                exiting = self.exiting
 
-                if not self.flush:
-                    continue
+            if not flush:
+                if exiting:
+                    return
 
-                if not self.datastore:
-                    try:
-                        self.init_datastore()
-                        logging.info('Datastore initialized')
-                    except BaseException as err:
-                        logging.warning('Cannot initialize datastore: {0}'.format(err))
-                        logging.warning('Flush skipped')
-                        continue
+                continue
+
+            if not self.datastore:
+                try:
+                    self.init_datastore()
+                    logging.info('Datastore initialized')
+                except BaseException as err:
+                    logging.warning('Cannot initialize datastore: {0}'.format(err))
+                    logging.warning('Flush skipped')
+                    if exiting:
+                        return
 
-                logging.debug('Attempting to flush logs')
-                with self.lock:
-                    for i in self.store:
-                        self.datastore.insert('syslog', i)
+                    continue
 
-                    self.store.clear()
+            # Writing happens outside of the condition variable, so that
+            # toggling flush or signalling does not wait for the datastore
+            logging.debug('Attempting to flush logs')
+            self.flusher.flush(self.datastore)
 
-                if self.exiting:
-                    return
+            if exiting:
+                return
 
     def sigusr1(self, signo, frame):
         with self.cv:
@@ -396,6 +419,7 @@ class Context(object):
     def main(self):
         setproctitle('logd')
         self.init_configstore()
+        self.init_buffer()
         self.init_syslog_server()
         self.init_klog()
         self.init_rpc_server()
@@ -0,0 +1,277 @@
+#
+# Copyright 2017 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+import re
+import time
+import logging
+import threading
+import itertools
+import collections
+from freenas.utils import query as q
+
+
+DEFAULT_BURST_INTERVAL = 0.5
+MIN_BURST_INTERVAL = 0.05
+DEFAULT_QUEUE_SIZE = 10000
+MAX_QUEUE_SIZE = 100000
+QUERY_OPERATORS = ('=', '!=', '>', '<', '>=', '<=', 'in', 'nin', 'contains', 'ncontains', '~')
+QUERY_CLAUSES = ('and', 'or', 'nor')
+PRIORITY_LEVELS = {
+    'EMERG': 0,
+    'ALERT': 1,
+    'CRIT': 2,
+    'ERR': 3,
+    'WARNING': 4,
+    'NOTICE': 5,
+    'INFO': 6,
+    'DEBUG': 7
+}
+
+
+logger = logging.getLogger('LogStreamer')
+
+
+def value_set(value):
+    if value is None:
+        return None
+
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return frozenset(value)
+
+    return frozenset([value])
+
+
+def check_rules(rules):
+    # Filters run on the ingest path, so reject whatever cannot be evaluated
+    # up front rather than on the first matching line
+    if not isinstance(rules, (list, tuple)):
+        raise ValueError('Query has to be a list of rules')
+
+    for rule in rules:
+        if isinstance(rule, (list, tuple)) and len(rule) == 2 and rule[0] in QUERY_CLAUSES:
+            check_rules(rule[1])
+            continue
+
+        if not isinstance(rule, (list, tuple)) or len(rule) != 3 or not isinstance(rule[0], str):
+            raise ValueError('Invalid query rule: {0}'.format(rule))
+
+        field, op, value = rule
+        if op not in QUERY_OPERATORS:
+            raise ValueError('Unsupported query operator {0}'.format(op))
+
+        if op in ('in', 'nin') and not isinstance(value, (list, tuple, set, frozenset)):
+            raise ValueError('Operator {0} needs a list of values'.format(op))
+
+        if op == '~':
+            try:
+                re.compile(value)
+            except (re.error, TypeError) as err:
+                raise ValueError('Invalid pattern for {0}: {1}'.format(field, err))
+
+
+class Subscription(object):
+    """
+    Log stream of a single client connection.
+
+    Lines passing the filter wait in a queue of at most `queue_size` lines
+    until the next burst; when the queue is full the oldest waiting lines
+    are dropped and counted.
+    """
+    def __init__(self, id, connection, filter, params):
+        self.id = id
+        self.connection = connection
+        self.services = value_set(filter.get('service'))
+        self.identifiers = value_set(filter.get('identifier'))
+        self.priority = None
+        self.pattern = None
+        self.query = filter.get('query') or []
+        check_rules(self.query)
+        self.interval = max(MIN_BURST_INTERVAL, float(params.get('interval', DEFAULT_BURST_INTERVAL)))
+        self.queue = collections.deque(maxlen=min(MAX_QUEUE_SIZE, int(params.get('queue_size', DEFAULT_QUEUE_SIZE))))
+        self.deadline = time.monotonic() + self.interval
+        self.sent = 0
+        self.dropped = 0
+
+        if filter.get('priority'):
+            if filter['priority'] not in PRIORITY_LEVELS:
+                raise ValueError('Unknown priority {0}'.format(filter['priority']))
+
+            self.priority = PRIORITY_LEVELS[filter['priority']]
+
+        if filter.get('message'):
+            try:
+                self.pattern = re.compile(filter['message'])
+            except re.error as err:
+                raise ValueError('Invalid message pattern: {0}'.format(err))
+
+    def matches(self, item):
+        # Cheapest checks first, the query and the pattern run last
+        if self.services is not None and item.get('service') not in self.services:
+            return False
+
+        if self.identifiers is not None and item.get('identifier') not in self.identifiers:
+            return False
+
+        if self.priority is not None and PRIORITY_LEVELS.get(item['priority'], 7) > self.priority:
+            return False
+
+        if self.pattern and not (isinstance(item['message'], str) and self.pattern.search(item['message'])):
+            return False
+
+        if self.query and not q.matches(item, *self.query):
+            return False
+
+        return True
+
+    @property
+    def connected(self):
+        # Closed connections are taken off their server's list
+        return self.connection in self.connection.parent.connections
+
+    def offer(self, item):
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+
+        self.queue.append(item)
+
+    def drain(self):
+        # Safe against concurrent offer(), deque operations are atomic
+        items = []
+        for i in range(0, len(self.queue)):
+            items.append(self.queue.popleft())
+
+        return items
+
+    def __getstate__(self):
+        return {
+            'id': self.id,
+            'interval': self.interval,
+            'queue_size': self.queue.maxlen,
+            'queued': len(self.queue),
+            'sent': self.sent,
+            'dropped': self.dropped
+        }
+
+
+class LogStreamer(object):
+    """
+    Delivers log lines to subscribed clients.
+
+    Lines are matched against subscriptions on the ingest path and queued
+    per subscription. A single thread sends each subscription's queue as a
+    'logd.logging.messages' event to its connection every `interval`
+    seconds, and only if there is something to send. Subscriptions are
+    dropped once their connection is closed or fails, or their filter
+    raises an error.
+    """
+    def __init__(self):
+        self.subscriptions = {}
+        self.ids = itertools.count(1)
+        self.cv = threading.Condition()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='Log streamer', daemon=True)
+        self.thread.start()
+
+    def subscribe(self, connection, filter, params):
+        with self.cv:
+            subscription = Subscription(next(self.ids), connection, filter, params)
+            self.subscriptions[subscription.id] = subscription
+            self.cv.notify_all()
+            return subscription.id
+
+    def unsubscribe(self, connection, id):
+        with self.cv:
+            subscription = self.subscriptions.get(id)
+            if subscription and subscription.connection is connection:
+                del self.subscriptions[id]
+                return True
+
+            return False
+
+    def publish(self, items):
+        if not self.subscriptions:
+            return
+
+        for subscription in list(self.subscriptions.values()):
+            # Filters come from clients; one failing must never stop ingestion
+            try:
+                matched = [i for i in items if subscription.matches(i)]
+            except Exception as err:
+                self.drop(subscription, 'filter failed: {0}'.format(err))
+                continue
+
+            for item in matched:
+                subscription.offer(item)
+
+    def run(self):
+        while True:
+            with self.cv:
+                while not self.subscriptions:
+                    self.cv.wait()
+
+                now = time.monotonic()
+                deadline = min(s.deadline for s in self.subscriptions.values())
+                if deadline > now:
+                    self.cv.wait(deadline - now)
+                    continue
+
+                due = [s for s in self.subscriptions.values() if s.deadline <= now]
+
+            for subscription in due:
+                subscription.deadline = now + subscription.interval
+                self.send(subscription)
+
+    def drop(self, subscription, reason):
+        logger.info('Dropping log subscription {0}: {1}'.format(subscription.id, reason))
+        with self.cv:
+            self.subscriptions.pop(subscription.id, None)
+
+    def send(self, subscription):
+        # Checked on every burst, even an empty one, so that subscriptions of
+        # clients gone quietly do not pile up
+        if not subscription.connected:
+            self.drop(subscription, 'connection closed')
+            return
+
+        dropped = subscription.dropped
+        items = subscription.drain()
+        if not items:
+            return
+
+        try:
+            subscription.connection.emit_event('logd.logging.messages', {
+                'id': subscription.id,
+                'messages': items,
+                'dropped': dropped
+            })
+        except Exception as err:
+            self.drop(subscription, err)
+            return
+
+        subscription.sent += len(items)
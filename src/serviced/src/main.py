@@ -529,12 +529,12 @@ class JobService(RpcService):
                 return j.pid == pid
 
             job = first_or_default(fuzzy_match if fuzzy else match, self.context.jobs.values())
-            if job.parent:
-                job = job.parent
-
             if not job:
                 raise RpcException(errno.ENOENT, 'Job for PID {0} not found'.format(pid))
 
+            if job.parent:
+                job = job.parent
+
         return job.__getstate__()
 
     def wait(self, name_or_id, states):